@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from pathlib import Path
+import argparse
+import contextlib
+import csv
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from rasterio import features
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+# The benchmark builds its own data, so it runs from the script location instead of the data workspace
+script_dir = Path(__file__).resolve().parent if "__file__" in globals() else Path.cwd()
+repo_root = script_dir.parents[1]
+
+# === CONFIGURATION ===
+sizes = [512, 1024, 2048]  # Synthetic HUC side lengths in pixels (1 m resolution)
+stages = ["extract", "dataset", "train", "predict", "predict_windowed"]
+output_dir = repo_root / "Benchmarks"        # Results JSON and history CSV
+synthetic_dir = output_dir / "synthetic"     # Generated rasters, polygons, labels, and patches
+wetlands_per_mpx = 150  # Wetland polygons per million pixels
+seed = 42
+repeats = 1  # Runs per case; the fastest is reported
+
+# Workload settings (defaults match NYS_03, NYS_06, and NYS_08)
+patch_size = 128
+crop_margin = 32
+batch_size = 16
+base_filters = 32
+train_steps = 20   # Timed training steps
+warmup_steps = 3   # Untimed steps before timing (allocator and kernel warm-up)
+block_size = 1024  # Core block size for windowed prediction
+device_name = None  # None = cuda, then mps, then cpu
+
+regression_threshold = 0.10  # Flag cases whose throughput dropped by more than this fraction
+tag = None  # Label for this run (None = git revision)
+
+# === Terminal Import Args ===
+# parse_known_args ignores the extra arguments Jupyter passes to the kernel
+parser = argparse.ArgumentParser(description="Benchmark the wetland pipeline on synthetic HUCs")
+parser.add_argument("--sizes", type=int, nargs="+", default=sizes)
+parser.add_argument("--stages", nargs="+", default=stages,
+                    help="Any of: extract, dataset, train, predict, predict_windowed")
+parser.add_argument("--output-dir", type=Path, default=output_dir)
+parser.add_argument("--repeats", type=int, default=repeats)
+parser.add_argument("--batch-size", type=int, default=batch_size)
+parser.add_argument("--base-filters", type=int, default=base_filters)
+parser.add_argument("--train-steps", type=int, default=train_steps)
+parser.add_argument("--device", default=device_name)
+parser.add_argument("--tag", default=tag)
+cli_args, _ = parser.parse_known_args()
+
+sizes = cli_args.sizes
+stages = cli_args.stages
+output_dir = cli_args.output_dir
+synthetic_dir = output_dir / "synthetic"
+repeats = cli_args.repeats
+batch_size = cli_args.batch_size
+base_filters = cli_args.base_filters
+train_steps = cli_args.train_steps
+device_name = cli_args.device
+tag = cli_args.tag
+
+print(f"Sizes: {sizes}")
+print(f"Stages: {stages}")
+print(f"Output: {output_dir}")
+
+
+# In[ ]:
+
+
+# Import from other notebooks
+sys.path.insert(0, str(script_dir))
+
+from NYS_00_patch_extraction import extract_huc_patches
+from NYS_04_dataset import get_dataloaders, find_patch_files, load_and_merge_metadata
+from NYS_05_unet_model import UNet
+import NYS_08_predict_raster as predict_module
+
+
+# In[ ]:
+
+
+# === SYNTHETIC DATA ===
+# Class mapping from NYS_02_rasterize_labels (REVIEW polygons are dropped before rasterizing)
+class_mapping = {
+    'EMW': 1,  # Emergent Wetland
+    'FSW': 2,  # Forested Wetland
+    'SSW': 3,  # Shrub Scrub Wetland
+    'OWW': 4,  # Open Water Wetland
+}
+class_weights = [0.3, 0.3, 0.2, 0.15, 0.05]  # EMW, FSW, SSW, OWW, REVIEW polygon frequencies
+
+# Band names of each raster_inputs entry (written as band descriptions where NYS_03 reads them)
+synthetic_band_names = {
+    "naip": ["r", "g", "b", "nir", "ndvi", "ndwi"],
+    "dem": ["dem"],
+    "chm": ["chm"],
+    "terrain": ["slope_5m", "TPI_5m", "Geomorph_5m"],
+}
+
+crs = "EPSG:26918"  # UTM 18N, 1 m pixels like NAIP
+wetlands_dir = Path("Data/Training_Data/Wetland_Polygons_For_DL")
+labels_dir = Path("Data/Training_Data/DL_HUC_Extracted_Training_Data")
+patch_dir = Path("Data/Patches_v2")
+
+
+def synthetic_huc_id(size):
+    """12-digit HUC id for the synthetic HUC of a given size."""
+    return f"99{size:010d}"
+
+
+def synthetic_path(pattern, name, huc):
+    """File path matching a raster_inputs glob pattern, e.g. "*{huc}*5m.tif" -> "terrain_<huc>_5m.tif"."""
+    path = pattern.replace("{huc}", huc).replace("*", f"{name}_", 1)
+    return Path(path.replace("*", "_"))
+
+
+def smooth_field(rng, height, width, cell=64):
+    """Spatially correlated noise in [0, 1): a coarse random grid, bilinearly upsampled."""
+    coarse = rng.random((height // cell + 2, width // cell + 2), dtype=np.float32)
+    rows, cols = np.arange(height) / cell, np.arange(width) / cell
+    r0, c0 = rows.astype(int), cols.astype(int)
+    fr = (rows - r0).astype(np.float32)[:, None]
+    fc = (cols - c0).astype(np.float32)[None, :]
+    top = coarse[r0][:, c0] * (1 - fc) + coarse[r0][:, c0 + 1] * fc
+    bottom = coarse[r0 + 1][:, c0] * (1 - fc) + coarse[r0 + 1][:, c0 + 1] * fc
+    return top * (1 - fr) + bottom * fr
+
+
+def synthetic_bands(rng, height, width):
+    """
+    Band arrays in realistic ranges, keyed by raster_inputs name.
+
+    Returns:
+        Dict of name -> float32 array (bands, height, width), NaN outside the HUC boundary
+    """
+    def noisy(field, scale):
+        return field + rng.normal(0, scale, field.shape).astype(np.float32)
+
+    vegetation = smooth_field(rng, height, width)
+    red = np.clip(noisy(40 + 120 * (1 - vegetation), 5), 0, 255).round()
+    green = np.clip(noisy(50 + 100 * smooth_field(rng, height, width), 5), 0, 255).round()
+    blue = np.clip(noisy(30 + 90 * smooth_field(rng, height, width), 5), 0, 255).round()
+    nir = np.clip(noisy(60 + 160 * vegetation, 5), 0, 255).round()
+    ndvi = (nir - red) / np.maximum(nir + red, 1)
+    ndwi = (green - nir) / np.maximum(green + nir, 1)
+
+    terrain = smooth_field(rng, height, width, cell=256)
+    bands = {
+        "naip": np.stack([red, green, blue, nir, ndvi, ndwi]),
+        "dem": (100 + 300 * terrain)[None],
+        "chm": np.clip(30 * vegetation * smooth_field(rng, height, width) - 3, 0, None)[None],
+        "terrain": np.stack([
+            45 * smooth_field(rng, height, width, cell=32),
+            noisy(10 * smooth_field(rng, height, width, cell=32) - 5, 0.5),
+            np.floor(1 + 9.99 * smooth_field(rng, height, width, cell=128)),
+        ]),
+    }
+
+    # HUCs are irregular, so the rasters have NoData outside the boundary
+    rows, cols = np.ogrid[:height, :width]
+    outside = ((rows - height / 2) / (height / 2)) ** 2 + ((cols - width / 2) / (width / 2)) ** 2 > 1
+    for data in bands.values():
+        data[:, outside] = np.nan
+    return {name: data.astype(np.float32) for name, data in bands.items()}, outside
+
+
+def write_synthetic_huc(size, seed, raster_inputs):
+    """
+    Write rasters, wetland polygons, and labels for one synthetic HUC (skipped if up to date).
+
+    Args:
+        size: HUC side length in pixels
+        seed: Random seed (combined with size)
+        raster_inputs: Raster configuration whose path patterns and bands are mimicked
+
+    Returns:
+        huc: Synthetic HUC id
+    """
+    huc = synthetic_huc_id(size)
+    marker_path = Path(f"synthetic_{huc}.json")
+    settings = {"size": size, "seed": seed, "wetlands_per_mpx": wetlands_per_mpx}
+    if marker_path.exists() and json.loads(marker_path.read_text()) == settings:
+        return huc
+
+    rng = np.random.default_rng([seed, size])
+    x0, y0 = 500000.0, 4700000.0
+    transform = from_origin(x0, y0, 1.0, 1.0)
+    profile = dict(driver="GTiff", height=size, width=size, crs=crs, transform=transform,
+                   dtype="float32", nodata=np.nan, tiled=True, blockxsize=256, blockysize=256, compress="lzw")
+
+    # === RASTERS ===
+    bands, outside = synthetic_bands(rng, size, size)
+    for raster_cfg in raster_inputs:
+        path = synthetic_path(raster_cfg["path_pattern"], raster_cfg["name"], huc)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = bands[raster_cfg["name"]]
+        with rasterio.open(path, "w", count=len(data), **profile) as dst:
+            dst.write(data)
+            if raster_cfg["bands"] is None:
+                for idx, name in enumerate(synthetic_band_names[raster_cfg["name"]]):
+                    dst.set_band_description(idx + 1, name)
+
+    # === WETLAND POLYGONS ===
+    # Centers inside the HUC boundary, lognormal radii (median ~12 m), NWI-like class mix
+    n_wetlands = max(1, int(wetlands_per_mpx * size * size / 1e6))
+    inside_rows, inside_cols = np.nonzero(~outside)
+    picks = rng.integers(0, len(inside_rows), n_wetlands)
+    radii = np.clip(rng.lognormal(np.log(12), 0.6, n_wetlands), 2, 80)
+    classes = rng.choice(list(class_mapping) + ["REVIEW"], n_wetlands, p=class_weights)
+    geometry = [Point(x0 + c + 0.5, y0 - r - 0.5).buffer(radius, 4)
+                for r, c, radius in zip(inside_rows[picks], inside_cols[picks], radii)]
+    wetlands = gpd.GeoDataFrame({"MOD_CLASS": classes}, geometry=geometry, crs=crs)
+    wetlands_dir.mkdir(parents=True, exist_ok=True)
+    wetlands.to_file(wetlands_dir / f"wetlands_{huc}.gpkg")
+
+    # === LABELS (as in NYS_02) ===
+    wetlands = wetlands[wetlands["MOD_CLASS"] != "REVIEW"]
+    labels = features.rasterize(
+        shapes=zip(wetlands.geometry, wetlands["MOD_CLASS"].map(class_mapping)),
+        out_shape=(size, size),
+        transform=transform,
+        fill=0,
+        dtype=np.uint8,
+    )
+    labels_dir.mkdir(parents=True, exist_ok=True)
+    label_profile = dict(profile, count=1, dtype=np.uint8, nodata=255)
+    with rasterio.open(labels_dir / f"cluster_{size}_huc_{huc}_labels.tif", "w", **label_profile) as dst:
+        dst.write(labels, 1)
+
+    # Patches extracted from the previous version of this HUC are stale
+    for old_patch in patch_dir.glob(f"cluster_{size}_*"):
+        old_patch.unlink()
+
+    marker_path.write_text(json.dumps(settings))
+    return huc
+
+
+# In[ ]:
+
+
+# Patch extraction settings (NYS_03 patch_config defaults). With no normalization rules
+# every band falls back to minmax, which only changes the saved metadata, not the work.
+patch_config = {
+    "patch_size": patch_size,
+    "max_offset": 32,
+    "background_patches": 120,
+    "background_stride": 8,
+    "val_split": 0.2,
+    "random_seed": seed,
+    "raster_inputs": predict_module.raster_inputs,
+    "normalization_rules": {},
+    "store_normalized": False,
+    "compact_storage": False,
+    "storage_rules": None,
+    "stats_hist_bins": 0,
+    "stats_hist_ranges": {},
+}
+
+
+def resolve_device(device_name):
+    """torch.device from a name, or the best available device for None."""
+    if device_name is not None:
+        return torch.device(device_name)
+    return torch.device("cuda" if torch.cuda.is_available() else
+                        "mps" if torch.backends.mps.is_available() else "cpu")
+
+
+def synchronize(device):
+    """Wait for queued device work so timings include it."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def load_patch_metadata(size):
+    """Merged NYS_03 metadata of the synthetic HUC's patches."""
+    files = find_patch_files(patch_dir, cluster_id=size)
+    return load_and_merge_metadata(files["metadata_files"])
+
+
+def bench_extract(huc, size, device_name):
+    """Time NYS_03 patch extraction for one HUC."""
+    patch_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    skipped = extract_huc_patches(huc, size, patch_config, wetlands_dir, patch_dir)
+    seconds = time.perf_counter() - start
+    if skipped is not None:
+        raise RuntimeError(f"Patch extraction skipped HUC {huc}: {skipped['reason']}")
+    metadata = load_patch_metadata(size)
+    return {"seconds": seconds, "items": metadata["n_train"] + metadata["n_val"], "unit": "patches"}
+
+
+def bench_dataset(huc, size, device_name):
+    """Time one epoch of the training DataLoader."""
+    train_loader, _, _ = get_dataloaders(patch_dir, cluster_id=size, batch_size=batch_size)
+    samples = 0
+    start = time.perf_counter()
+    for X, y in train_loader:
+        samples += len(X)
+    return {"seconds": time.perf_counter() - start, "items": samples, "unit": "samples"}
+
+
+def bench_train(huc, size, device_name):
+    """Time train_steps optimizer steps (data loading included), after warmup_steps untimed steps."""
+    device = resolve_device(device_name)
+    torch.manual_seed(seed)
+    train_loader, _, metadata = get_dataloaders(patch_dir, cluster_id=size, batch_size=batch_size)
+
+    model = UNet(metadata["in_channels"], metadata["num_classes"], base_filters=base_filters).to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    model.train()
+
+    def cycle(loader):
+        while True:
+            yield from loader
+
+    batches = cycle(train_loader)
+    samples = 0
+    for step in range(warmup_steps + train_steps):
+        if step == warmup_steps:
+            synchronize(device)
+            start = time.perf_counter()
+        X, y = next(batches)
+        X, y = X.to(device), y.to(device)
+        optimizer.zero_grad(set_to_none=True)
+        loss = criterion(model(X), y)
+        loss.backward()
+        optimizer.step()
+        if step >= warmup_steps:
+            samples += len(X)
+    synchronize(device)
+    return {"seconds": time.perf_counter() - start, "items": samples, "unit": "samples", "device": str(device)}
+
+
+def bench_predict(huc, size, device_name, windowed=False):
+    """Time full-raster prediction of the HUC, in memory or block by block to a GeoTIFF."""
+    device = resolve_device(device_name)
+    metadata = load_patch_metadata(size)
+    torch.manual_seed(seed)
+    model = UNet(metadata["in_channels"], metadata["num_classes"], base_filters=base_filters).to(device)
+    model.eval()
+
+    start = time.perf_counter()
+    if windowed:
+        output_path = Path("Data/Predictions") / f"benchmark_{huc}.tif"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with predict_module.RasterStack(predict_module.raster_inputs, huc, metadata["band_names"]) as stack:
+            predict_module.predict_raster_windowed(
+                model, stack, metadata["normalization"], output_path, None,
+                patch_size, crop_margin, batch_size, device,
+                metadata["num_classes"], metadata["class_names"], block_size=block_size, verbose=False,
+            )
+    else:
+        data, _, _ = predict_module.load_and_stack_rasters(predict_module.raster_inputs, huc, metadata["band_names"])
+        normalized, _ = predict_module.normalize_stack(data, metadata["band_names"], metadata["normalization"], verbose=False)
+        predict_module.predict_raster(
+            model, normalized, patch_size, crop_margin, batch_size, device, metadata["num_classes"]
+        )
+    synchronize(device)
+    return {"seconds": time.perf_counter() - start, "items": size * size / 1e6, "unit": "megapixels",
+            "device": str(device)}
+
+
+def bench_predict_windowed(huc, size, device_name):
+    """Time block-by-block prediction (see bench_predict)."""
+    return bench_predict(huc, size, device_name, windowed=True)
+
+
+stage_functions = {
+    "extract": bench_extract,
+    "dataset": bench_dataset,
+    "train": bench_train,
+    "predict": bench_predict,
+    "predict_windowed": bench_predict_windowed,
+}
+
+
+def run_case(func, kwargs):
+    """Run a benchmark case quietly and attach its memory use (executed in the child process)."""
+    start_rss = peak_rss_mb()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        result = func(**kwargs)
+    result.update(start_rss_mb=start_rss, peak_rss_mb=peak_rss_mb())
+    return result
+
+
+def run_isolated(func, **kwargs):
+    """Run one benchmark case in a fresh process and return its result dict."""
+    # fork so the child inherits the imports and configuration defined in this notebook
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as pool:
+        return pool.submit(run_case, func, kwargs).result()
+
+
+# In[ ]:
+
+
+history_columns = ["timestamp", "tag", "stage", "size", "seconds", "items", "unit",
+                   "throughput", "start_rss_mb", "peak_rss_mb", "device"]
+
+
+def git_revision():
+    """Short git revision of the code being benchmarked ("+dirty" with local changes), or "unknown"."""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=script_dir,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=script_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("+dirty" if status else "")
+
+
+def environment_info():
+    """Versions and hardware that affect the timings."""
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+    }
+
+
+def read_history(history_path):
+    """Rows of the history CSV, or an empty list."""
+    if not history_path.exists():
+        return []
+    with open(history_path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def compare_with_history(results, history, tag, threshold):
+    """
+    Compare throughput with the most recent run of a different revision.
+
+    Args:
+        results: Case dicts of this run (stage, size, throughput, ...)
+        history: Rows from read_history
+        tag: Tag of this run (rows with the same tag are not used as the baseline)
+        threshold: Fractional throughput drop reported as a regression
+
+    Returns:
+        baseline_tag: Tag of the baseline run, or None if there is none
+        comparisons: List of dicts with stage, size, baseline, throughput, change, regression
+    """
+    previous = [row for row in history if row["tag"] != tag]
+    if not previous:
+        return None, []
+    baseline_time = max(row["timestamp"] for row in previous)
+    baseline = {(row["stage"], int(row["size"])): row for row in previous if row["timestamp"] == baseline_time}
+
+    comparisons = []
+    for result in results:
+        row = baseline.get((result["stage"], result["size"]))
+        if row is None:
+            continue
+        change = result["throughput"] / float(row["throughput"]) - 1
+        comparisons.append({
+            "stage": result["stage"],
+            "size": result["size"],
+            "baseline": float(row["throughput"]),
+            "throughput": result["throughput"],
+            "change": change,
+            "regression": change < -threshold,
+        })
+    return baseline[next(iter(baseline))]["tag"], comparisons
+
+
+def save_results(run, output_dir):
+    """
+    Save a run as JSON and append its cases to the history CSV.
+
+    Returns:
+        json_path, history_path
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stamp = run["timestamp"].replace(":", "").replace("-", "")
+    json_path = output_dir / f"benchmark_{run['tag']}_{stamp}.json"
+    with open(json_path, "w") as f:
+        json.dump(run, f, indent=2)
+
+    history_path = output_dir / "benchmark_history.csv"
+    write_header = not history_path.exists()
+    with open(history_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=history_columns, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        for result in run["results"]:
+            writer.writerow({"timestamp": run["timestamp"], "tag": run["tag"], "device": "", **result})
+    return json_path, history_path
+
+
+def print_results(results):
+    """Table of throughput and memory per case."""
+    print(f"\n  {'stage':18s} {'size':>6s} {'seconds':>9s} {'throughput':>22s} {'peak RSS (MB)':>14s}")
+    for result in results:
+        rate = f"{result['throughput']:,.2f} {result['unit']}/s"
+        print(f"  {result['stage']:18s} {result['size']:>6d} {result['seconds']:>9.2f} {rate:>22s} "
+              f"{result['peak_rss_mb']:>14,.0f}")
+
+
+# In[ ]:
+
+
+if __name__ == "__main__" or 'get_ipython' in dir():
+    run_tag = tag or git_revision()
+    output_dir = output_dir.resolve()
+    synthetic_dir = synthetic_dir.resolve()
+    synthetic_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(synthetic_dir)
+    print(f"Revision: {run_tag}")
+    print(f"Working in: {Path.cwd()}")
+
+    results = []
+    for size in sizes:
+        print(f"\n=== {size} x {size} ===")
+        start = time.perf_counter()
+        huc = write_synthetic_huc(size, seed, predict_module.raster_inputs)
+        print(f"Synthetic HUC {huc} ready ({time.perf_counter() - start:.1f}s)")
+
+        # Later stages read the extracted patches, so extract untimed if needed
+        if "extract" not in stages and not list(patch_dir.glob(f"cluster_{size}_metadata_*.json")):
+            run_isolated(bench_extract, huc=huc, size=size, device_name=device_name)
+
+        for stage in [s for s in stage_functions if s in stages]:
+            runs = [run_isolated(stage_functions[stage], huc=huc, size=size, device_name=device_name)
+                    for _ in range(repeats)]
+            result = min(runs, key=lambda r: r["seconds"])
+            result.update(stage=stage, size=size, throughput=result["items"] / result["seconds"])
+            results.append(result)
+            print(f"  {stage:18s} {result['seconds']:8.2f}s  "
+                  f"{result['throughput']:10,.2f} {result['unit']}/s  peak RSS {result['peak_rss_mb']:,.0f} MB")
+
+    print_results(results)
+
+    # Compare with the previous revision before this run is added to the history
+    history = read_history(output_dir / "benchmark_history.csv")
+    baseline_tag, comparisons = compare_with_history(results, history, run_tag, regression_threshold)
+    if baseline_tag is not None:
+        print(f"\nCompared with {baseline_tag}:")
+        for comparison in comparisons:
+            flag = "  REGRESSION" if comparison["regression"] else ""
+            print(f"  {comparison['stage']:18s} {comparison['size']:>6d} {comparison['change']:+7.1%}{flag}")
+
+    run = {
+        "tag": run_tag,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment_info(),
+        "settings": {
+            "sizes": sizes, "stages": stages, "seed": seed, "repeats": repeats,
+            "wetlands_per_mpx": wetlands_per_mpx, "patch_size": patch_size, "crop_margin": crop_margin,
+            "batch_size": batch_size, "base_filters": base_filters, "train_steps": train_steps,
+            "warmup_steps": warmup_steps, "block_size": block_size, "device": device_name,
+        },
+        "results": results,
+        "baseline_tag": baseline_tag,
+        "comparisons": comparisons,
+    }
+    json_path, history_path = save_results(run, output_dir)
+    print(f"\nSaved results to: {json_path}")
+    print(f"Appended to: {history_path}")
+
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from pathlib import Path
+import json
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from sklearn.model_selection import train_test_split
+
+from NYS_04_dataset import compile_normalization, compute_band_stats, encode_patches
+from NYS_00_profiling import NULL_TIMER
+from NYS_00_tile_cache import get_tile_cache
+
+
+# In[ ]:
+
+
+# === HELPER FUNCTIONS: WINDOWED PATCH READS ===
+def patch_in_bounds(center_row, center_col, patch_size, height, width):
+    """Return True where a patch centered at (center_row, center_col) lies inside the raster (scalars or arrays)."""
+    half = patch_size // 2
+    return ((center_row - half >= 0) & (center_row + half <= height) &
+            (center_col - half >= 0) & (center_col + half <= width))
+
+
+def integral_image(mask):
+    """
+    Integral image (summed-area table) of a 2D mask.
+
+    sat[r, c] is the number of True pixels in rows < r and columns < c, so the
+    count over any window is four lookups (see window_sums).
+
+    Returns:
+        sat: int32 array (height + 1, width + 1)
+    """
+    # Cumulative sums written in place, so the only arrays are the mask and sat
+    sat = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int32)
+    np.cumsum(mask, axis=0, dtype=np.int32, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def window_sums(sat, rows, cols, size):
+    """Sum of the integral image's mask over size x size windows with upper-left corners (rows, cols)."""
+    return sat[rows + size, cols + size] - sat[rows, cols + size] - sat[rows + size, cols] + sat[rows, cols]
+
+
+def plan_block_reads(origins, patch_size, strip_rows=512):
+    """
+    Merge patch windows into block reads that are mostly patch pixels.
+
+    Windows are grouped by the strip_rows strip their first row falls in and
+    visited by column. A window joins the current block if the block's bounding
+    box, grown to cover it, is at most twice the pixels of the windows in it;
+    otherwise it starts a new block. Dense windows merge into wide blocks, while
+    scattered windows are read on their own, so a HUC's reads are at most twice
+    its patch pixels and a block has at most strip_rows + patch_size - 1 rows.
+
+    Args:
+        origins: Array (n_patches, 2) of patch (row, col) upper-left corners
+        patch_size: Patch size in pixels
+        strip_rows: Rows per strip
+
+    Returns:
+        order: Patch indexes sorted by block
+        starts: Index into order where each block starts
+        bounds: List of block (row_start, row_stop, col_start, col_stop)
+    """
+    strips = origins[:, 0] // strip_rows
+    order = np.lexsort((origins[:, 1], strips))
+    starts, bounds = [], []
+    block_strip = block_pixels = None
+    for k, (strip, (r, c)) in enumerate(zip(strips[order].tolist(), origins[order].tolist())):
+        if strip == block_strip:
+            r0, r1, c0, c1 = bounds[-1]
+            grown = (min(r0, r), max(r1, r + patch_size), c0, max(c1, c + patch_size))
+            if (grown[1] - grown[0]) * (grown[3] - grown[2]) <= 2 * (block_pixels + patch_size ** 2):
+                bounds[-1] = grown
+                block_pixels += patch_size ** 2
+                continue
+        starts.append(k)
+        bounds.append((r, r + patch_size, c, c + patch_size))
+        block_strip, block_pixels = strip, patch_size ** 2
+    return order, np.array(starts, dtype=np.int64), bounds
+
+
+def read_patch_windows(sources, band_reads, origins, patch_size, strip_rows=512):
+    """
+    Read patch windows with one read per block of nearby windows (see plan_block_reads).
+
+    Each block is read once for all bands. Patches are gathered with one fancy
+    index into a strided view of the block, and their NoData pixels are counted
+    from the block's integral image. Only blocks are read, so I/O scales with
+    the number of patches, not with the HUC area.
+
+    Args:
+        sources: List of open rasterio datasets (read by path through the tile cache)
+        band_reads: Dict of source index -> list of 1-based band indexes to read
+        origins: Array (n_patches, 2) of patch (row, col) upper-left corners, inside the raster
+        patch_size: Patch size in pixels
+        strip_rows: Rows per strip when merging windows into blocks
+
+    Returns:
+        X: float32 array (n_patches, bands, patch_size, patch_size), bands in source order
+        clean: bool array (n_patches,), True where the patch has no NoData
+    """
+    n_bands = sum(len(b) for b in band_reads.values())
+    X = np.empty((len(origins), n_bands, patch_size, patch_size), dtype=np.float32)
+    clean = np.zeros(len(origins), dtype=bool)
+    if len(origins) == 0:
+        return X, clean
+
+    order, starts, bounds = plan_block_reads(origins, patch_size, strip_rows)
+    for members, (r0, r1, c0, c1) in zip(np.split(order, starts[1:]), bounds):
+        window = rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0)
+        block = np.concatenate([get_tile_cache().read(sources[src_idx].name, indexes, window)
+                                for src_idx, indexes in sorted(band_reads.items())])
+        windows = np.lib.stride_tricks.sliding_window_view(block, (patch_size, patch_size), axis=(1, 2))
+        rows, cols = origins[members, 0] - r0, origins[members, 1] - c0
+        X[members] = windows[:, rows, cols].transpose(1, 0, 2, 3)
+        nodata_sat = integral_image(np.isnan(block).any(axis=0))
+        clean[members] = window_sums(nodata_sat, rows, cols, patch_size) == 0
+    return X, clean
+
+
+def background_candidates(labels, patch_size, background_stride, strip_rows=512):
+    """
+    Origins on a background_stride grid whose patch has no wetland label.
+
+    Labels are counted from one integral image per strip of origin rows, so no
+    full-size integral image is built.
+
+    Returns:
+        candidates: int64 array (n_candidates, 2) of (row, col) origins in row-major order
+    """
+    height, width = labels.shape
+    grid_rows = np.arange(0, height - patch_size + 1, background_stride)
+    grid_cols = np.arange(0, width - patch_size + 1, background_stride)
+    grid_rows_per_strip = max(1, strip_rows // background_stride)
+    candidates = []
+    for g in range(0, len(grid_rows), grid_rows_per_strip):
+        strip_grid_rows = grid_rows[g:g + grid_rows_per_strip]
+        top = strip_grid_rows[0]
+        label_sat = integral_image(labels[top:strip_grid_rows[-1] + patch_size] > 0)
+        rows, cols = np.meshgrid(strip_grid_rows - top, grid_cols, indexing="ij")
+        label_free = window_sums(label_sat, rows, cols, patch_size) == 0
+        candidates.append(np.stack([rows[label_free] + top, cols[label_free]], axis=1))
+    return np.concatenate(candidates) if candidates else np.zeros((0, 2), dtype=np.int64)
+
+
+def sample_background_patches(sources, band_reads, labels, patch_size, n_background, background_stride, rng,
+                              strip_rows=512):
+    """
+    Draw background patches uniformly from the grid origins with no wetland label and no NoData.
+
+    Label-free candidates come from the label raster (background_candidates). NoData
+    is only known once pixels are read, so candidates are visited in a random order
+    and read in batches (read_patch_windows), keeping the first n_background without
+    NoData. That is a uniform draw without replacement from all eligible origins,
+    and the pixels read scale with n_background (over the fraction of candidates
+    free of NoData), not with the HUC area. The draw does not depend on strip_rows.
+
+    Args:
+        sources: List of open rasterio datasets (read by path through the tile cache)
+        band_reads: Dict of source index -> list of 1-based band indexes to read
+        labels: Label raster (0 = background), same grid as the sources
+        patch_size: Patch size in pixels
+        n_background: Number of background patches to draw
+        background_stride: Grid spacing of the candidate origins in pixels
+        rng: numpy Generator for the draw
+        strip_rows: Rows per strip for the label integral images and block reads
+
+    Returns:
+        origins: int64 array (n_drawn, 2), n_drawn = n_background unless too few origins are eligible
+        X: float32 array (n_drawn, bands, patch_size, patch_size)
+        n_candidates: Number of label-free origins (NoData is only checked for the ones read)
+    """
+    candidates = background_candidates(labels, patch_size, background_stride, strip_rows)
+    visit = rng.permutation(len(candidates))
+    kept_origins, kept_X = [candidates[:0]], []
+    n_kept = n_visited = 0
+
+    while n_kept < n_background and n_visited < len(candidates):
+        # A quarter more than still needed, since some candidates hold NoData
+        need = n_background - n_kept
+        batch = candidates[visit[n_visited:n_visited + need + need // 4 + 1]]
+        n_visited += len(batch)
+        X, clean = read_patch_windows(sources, band_reads, batch, patch_size, strip_rows)
+        take = np.flatnonzero(clean)[:need]
+        kept_origins.append(batch[take])
+        kept_X.append(X[take])
+        n_kept += len(take)
+
+    n_bands = sum(len(b) for b in band_reads.values())
+    X = np.concatenate(kept_X) if kept_X else np.zeros((0, n_bands, patch_size, patch_size), dtype=np.float32)
+    return np.concatenate(kept_origins), X, len(candidates)
+
+
+# In[ ]:
+
+
+# === HUC PATCH EXTRACTION ===
+# NYS_03 runs extract_huc_patches for every HUC in a cluster; the benchmark
+# calls it directly. All settings come from the config dict (NYS_03 patch_config),
+# so results depend only on the arguments.
+
+def open_huc_rasters(raster_inputs, huc):
+    """
+    Open a HUC's input rasters and resolve their band names.
+
+    Rasters are only opened here; pixels are read later through the tile cache.
+
+    Args:
+        raster_inputs: Raster configuration (name, path_pattern with {huc}, bands)
+        huc: HUC12 id
+
+    Returns:
+        sources: List of open rasterio datasets (close them when done)
+        band_reads: Dict of source index -> list of 1-based band indexes, in band_names order
+        band_names: List of band names
+        transform: Affine transform of the first raster
+    """
+    sources = []
+    band_reads = {}
+    band_names = []
+    transform = None
+
+    try:
+        for raster_cfg in raster_inputs:
+            # Build glob pattern with HUC substitution
+            pattern = raster_cfg["path_pattern"].replace("{huc}", huc)
+            matches = list(Path(".").glob(pattern))
+
+            if not matches:
+                raise FileNotFoundError(f"No files found for {raster_cfg['name']}: {pattern}")
+
+            raster_path = matches[0]
+            print(f"  Opening {raster_cfg['name']}: {raster_path.name}")
+
+            src = rasterio.open(raster_path)
+            sources.append(src)
+
+            # Keep transform from first raster (for coordinate conversion)
+            if transform is None:
+                transform = src.transform
+
+            # Determine band names
+            if raster_cfg["bands"] is not None:
+                # Use manually specified band names
+                names = raster_cfg["bands"]
+            elif src.descriptions and all(src.descriptions):
+                # Read from raster descriptions
+                names = list(src.descriptions)
+            else:
+                # Fallback: generate names like "raster_name_1", "raster_name_2"
+                names = [f"{raster_cfg['name']}_{j+1}" for j in range(src.count)]
+
+            # Validate band count matches
+            if len(names) != src.count:
+                raise ValueError(
+                    f"Band count mismatch for {raster_cfg['name']}: "
+                    f"got {len(names)} names but {src.count} bands"
+                )
+
+            # Register each band individually
+            for idx, name in enumerate(names):
+                if name in band_names:
+                    raise ValueError(f"Duplicate band name: {name}")
+                band_reads.setdefault(len(sources) - 1, []).append(idx + 1)
+                band_names.append(name)
+    except Exception:
+        for src in sources:
+            src.close()
+        raise
+
+    return sources, band_reads, band_names, transform
+
+
+def extract_huc_patches(i, cluster_id, config, wetlands_dir, output_dir,
+                        labels_dir=Path("Data/Training_Data/DL_HUC_Extracted_Training_Data"), timer=None,
+                        strip_rows=512):
+    """
+    Extract, split, and save patches plus metadata for one HUC.
+
+    Uses its own RNG seeded from (random_seed, HUC), so results do not depend on
+    the order HUCs are processed in or on which worker process runs them.
+
+    Args:
+        i: HUC12 id
+        cluster_id: Cluster id in the label and output file names
+        config: Patch settings (NYS_03 patch_config): patch_size, max_offset,
+            background_patches, background_stride, val_split, random_seed,
+            raster_inputs, normalization_rules, store_normalized, compact_storage,
+            storage_rules, stats_hist_bins, stats_hist_ranges
+        wetlands_dir: Directory of the per-HUC wetland GeoPackages
+        output_dir: Directory for the .npy patches and metadata JSON
+        labels_dir: Directory of the NYS_02 label rasters
+        timer: Optional StageTimer for per-stage timings (None = no timing)
+        strip_rows: Rows per strip when merging patch windows into block reads (see
+            plan_block_reads); read sizes and memory use, not the saved patches, depend on it
+
+    Returns:
+        None if the HUC was processed, otherwise a dict describing why it was skipped
+    """
+    timer = timer or NULL_TIMER
+    rng = np.random.default_rng([config["random_seed"], int(i)])
+
+    print(f"\n{'='*60}")
+    print(f"Processing HUC: {i}")
+    print(f"{'='*60}")
+
+    # === OPEN BANDS DYNAMICALLY FROM CONFIGURATION ===
+    with timer.stage("open_rasters"):
+        sources, band_reads, band_names, transform = open_huc_rasters(config["raster_inputs"], i)
+
+    try:
+        return _extract_huc_windows(i, cluster_id, config, Path(wetlands_dir), Path(output_dir),
+                                    Path(labels_dir), timer, strip_rows, rng, sources, band_reads, band_names,
+                                    transform)
+    finally:
+        for src in sources:
+            src.close()
+
+
+def _extract_huc_windows(i, cluster_id, config, wetlands_dir, output_dir, labels_dir, timer, strip_rows, rng,
+                         sources, band_reads, band_names, transform):
+    """Sample patch windows for one HUC, read them from the open sources, and save."""
+    patch_size = config["patch_size"]
+    max_offset = config["max_offset"]
+    background_patches = config["background_patches"]
+    background_stride = config["background_stride"]
+    val_split = config["val_split"]
+    random_seed = config["random_seed"]
+    normalization_rules = config["normalization_rules"]
+    store_normalized = config["store_normalized"]
+    compact_storage = config["compact_storage"]
+    storage_rules = config["storage_rules"]
+    stats_hist_bins = config["stats_hist_bins"]
+    stats_hist_ranges = config["stats_hist_ranges"]
+
+    # === LOAD LABELS AND WETLANDS ===
+    labels_path = labels_dir / f"cluster_{cluster_id}_huc_{i}_labels.tif"
+    wetlands_matches = list(wetlands_dir.glob(f"*{i}*.gpkg"))
+
+    if not wetlands_matches:
+        print(f"  WARNING: No wetlands file found for HUC {i}, skipping...")
+        return {"huc": i, "reason": "No wetlands file found"}
+
+    wetlands_path = wetlands_matches[0]
+
+    with timer.stage("load_labels"):
+        with rasterio.open(labels_path) as src:
+            labels = src.read(1)
+
+        wetlands = gpd.read_file(wetlands_path)
+    print(f"  Wetland polygons in file: {len(wetlands)}")
+
+    # Check if wetlands file is empty
+    if len(wetlands) == 0:
+        print(f"  WARNING: No wetland polygons for HUC {i}, skipping...")
+        return {"huc": i, "reason": "No wetland polygons in file"}
+
+    height, width = labels.shape
+
+    print(f"\nRaster size: {height} x {width}")
+    print(f"Labels shape: {labels.shape}")
+    print(f"Band names ({len(band_names)}): {band_names}")
+
+    # === PLAN WETLAND-CENTERED PATCHES ===
+    # Centroids, pixel coordinates, offsets, and bounds for all polygons at once.
+    # Offsets are drawn as (row, col) pairs in polygon order, the same RNG sequence
+    # as drawing them one polygon at a time.
+    half = patch_size // 2
+    with timer.stage("plan_patches"):
+        centroids = wetlands.geometry.centroid
+        cols, rows = ~transform * (centroids.x.to_numpy(), centroids.y.to_numpy())
+        offsets = rng.integers(-max_offset, max_offset + 1, size=(len(wetlands), 2))
+        center_rows = rows.astype(np.int64) + offsets[:, 0]
+        center_cols = cols.astype(np.int64) + offsets[:, 1]
+        in_bounds = patch_in_bounds(center_rows, center_cols, patch_size, height, width)
+        origins = np.stack([center_rows[in_bounds], center_cols[in_bounds]], axis=1) - half
+
+    # === READ WETLAND-CENTERED PATCHES ===
+    # Only the patch windows are read, merged into block reads, so I/O scales with the
+    # number of patches rather than the HUC area
+    with timer.stage("read_wetland_patches"):
+        wetland_patches_X, clean = read_patch_windows(sources, band_reads, origins, patch_size, strip_rows)
+
+    # Reject wetland patches containing NoData
+    if not clean.all():
+        wetland_patches_X = wetland_patches_X[clean]
+    wetland_origins = [tuple(o) for o in origins[clean].tolist()]
+    skipped_count = len(wetlands) - len(wetland_origins)
+    timer.count("wetland_patches", len(wetland_patches_X))
+    print(f"Wetland-centered patches extracted: {len(wetland_patches_X)}")
+    print(f"Skipped (out of bounds or NaN): {skipped_count}")
+
+    # === RANDOM BACKGROUND PATCHES ===
+    # Origins on a background_stride grid with no wetland pixels and no NoData, drawn
+    # uniformly; only the drawn windows (and rejected NoData ones) are read
+    with timer.stage("sample_background"):
+        background_origins, background_patches_X, n_candidates = sample_background_patches(
+            sources, band_reads, labels, patch_size, background_patches, background_stride, rng, strip_rows
+        )
+    background_origins = [tuple(o) for o in background_origins.tolist()]
+    if len(background_origins) < background_patches:
+        print(f"  WARNING: Only {len(background_origins)} eligible background patches "
+              f"(stride {background_stride}), {background_patches} requested")
+    timer.count("background_patches", len(background_patches_X))
+    timer.count("background_candidates", n_candidates)
+    print(f"Background patches extracted: {len(background_patches_X)}")
+
+    # === COMBINE AND SPLIT ===
+    all_origins = wetland_origins + background_origins
+    all_X = np.concatenate([wetland_patches_X, background_patches_X])
+    all_y = [labels[r0:r0 + patch_size, c0:c0 + patch_size] for r0, c0 in all_origins]
+
+    # Check if we have any patches before proceeding
+    if len(all_X) == 0:
+        print(f"  WARNING: No valid patches extracted for HUC {i}, skipping...")
+        return {
+            "huc": i, 
+            "reason": "No valid patches (all out of bounds or contain NaN)",
+            "wetland_polygons": len(wetlands),
+            "skipped_wetland_patches": skipped_count
+        }
+
+    # Check minimum patches for train/val split
+    min_patches_needed = max(2, int(1 / val_split) + 1)  # Need at least 1 in val set
+    if len(all_X) < min_patches_needed:
+        print(f"  WARNING: Only {len(all_X)} patches for HUC {i}, need at least {min_patches_needed} for split, skipping...")
+        return {
+            "huc": i,
+            "reason": f"Too few patches ({len(all_X)}) for train/val split",
+            "wetland_polygons": len(wetlands)
+        }
+
+    X_array = all_X.astype(np.float32, copy=False)
+    y_array = np.array(all_y, dtype=np.uint8)
+
+    print(f"Total patches: {len(X_array)}")
+    print(f"X shape: {X_array.shape}")
+    print(f"y shape: {y_array.shape}")
+
+    # Train/val split
+    with timer.stage("split"):
+        X_train, X_val, y_train, y_val = train_test_split(
+            X_array, y_array, 
+            test_size=val_split, 
+            random_state=random_seed
+        )
+
+    print(f"\nTrain patches: {len(X_train)}")
+    print(f"Validation patches: {len(X_val)}")
+
+    # === COMPUTE BAND STATISTICS FROM TRAINING DATA ===
+    print("Computing band statistics from training data...")
+    # count/sum/m2 accumulators let load_and_merge_metadata merge HUCs exactly
+    with timer.stage("band_stats"):
+        band_stats = compute_band_stats(X_train, band_names, stats_hist_bins, stats_hist_ranges)
+    for name in band_names:
+        print(f"  {name}: min={band_stats[name]['min']:.3f}, max={band_stats[name]['max']:.3f}")
+
+    # === BUILD NORMALIZATION FROM RULES (with minmax fallback) ===
+    normalization = {}
+    for name in band_names:
+        if name in normalization_rules:
+            # Use predefined rule
+            normalization[name] = normalization_rules[name].copy()
+        else:
+            # Default to minmax normalization using computed stats
+            normalization[name] = {
+                "type": "minmax",
+                "min": band_stats[name]["min"],
+                "max": band_stats[name]["max"]
+            }
+            print(f"  Note: '{name}' not in normalization_rules, using minmax")
+
+    # === PRE-NORMALIZE RULE-BASED BANDS (optional) ===
+    # Fixed rules do not depend on HUC statistics, so those bands can be stored normalized.
+    # minmax bands stay raw because their range is merged across HUCs at training time.
+    prenormalized_bands = []
+    if store_normalized:
+        prenormalized_bands = [name for name in band_names if name in normalization_rules]
+        rule_idx = [band_names.index(name) for name in prenormalized_bands]
+        scale, offset = compile_normalization(prenormalized_bands, normalization)
+        X_train[:, rule_idx] = X_train[:, rule_idx] * scale + offset
+        X_val[:, rule_idx] = X_val[:, rule_idx] * scale + offset
+        print(f"  Stored normalized: {prenormalized_bands}")
+
+    # === COMPACT STORAGE (optional) ===
+    # Bands are packed into uint8/int16 fields; pre-normalized bands stay float32
+    storage = None
+    if compact_storage:
+        rules = {name: rule for name, rule in storage_rules.items() if name not in prenormalized_bands}
+        float_bytes = X_train[0].nbytes
+        X_train, storage = encode_patches(X_train, band_names, rules)
+        X_val, _ = encode_patches(X_val, band_names, rules)
+        print(f"  Compact storage: {X_train.dtype.itemsize:,} bytes/patch (float32: {float_bytes:,})")
+
+    # === SAVE PATCHES ===
+    with timer.stage("save"):
+        np.save(output_dir / f"cluster_{cluster_id}_X_train_{i}_.npy", X_train)
+        np.save(output_dir / f"cluster_{cluster_id}_y_train_{i}_.npy", y_train)
+        np.save(output_dir / f"cluster_{cluster_id}_X_val_{i}_.npy", X_val)
+        np.save(output_dir / f"cluster_{cluster_id}_y_val_{i}_.npy", y_val)
+
+    # === CLASS PIXEL COUNTS (for class weights at training time) ===
+    class_pixel_counts = np.bincount(y_train.ravel(), minlength=5)
+
+    # === SAVE METADATA ===
+    metadata = {
+        "in_channels": len(band_names),
+        "num_classes": 5,
+        # "num_classes": 2,
+        "patch_size": patch_size,
+        "band_names": band_names,
+        "class_names": ["Background", "EMW", "FSW", "SSW", "OWW"],
+        # "class_names": ["Background", "WET"],
+        "n_train": int(len(X_train)),
+        "n_val": int(len(X_val)),
+        "class_pixel_counts": class_pixel_counts.tolist(),  # y_train pixels per class
+        "band_stats": band_stats,
+        "normalization": normalization,
+        "prenormalized_bands": prenormalized_bands,  # Bands saved already normalized
+        "storage": storage,  # Compact dtype/scale/offset per band (None = float32)
+        "raster_inputs": config["raster_inputs"],  # Save config for reproducibility
+    }
+
+    with open(output_dir / f"cluster_{cluster_id}_metadata_{i}.json", "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    print(f"\nSaved patches to {output_dir}")
+    print(f"Saved metadata with band statistics and normalization parameters")
+
+    return None
+
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from pathlib import Path
+import hashlib
+import json
+import os
+
+
+# In[ ]:
+
+
+# === PIPELINE CACHE MANIFEST ===
+# Each stage keeps a JSON manifest of HUC id -> fingerprint of that HUC's inputs
+# and configuration. HUCs whose fingerprint is unchanged and whose outputs still
+# exist are skipped on the next run.
+
+def file_signature(path, checksum=False):
+    """
+    Describe a file's content for change detection.
+
+    Args:
+        path: File path
+        checksum: Hash the file bytes (sha256) instead of using size + mtime.
+            Slower, but survives copies and touch without content changes.
+
+    Returns:
+        Dictionary with path, size, and mtime_ns or sha256
+    """
+    path = Path(path)
+    stat = path.stat()
+    signature = {"path": str(path), "size": stat.st_size}
+
+    if checksum:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        signature["sha256"] = digest.hexdigest()
+    else:
+        signature["mtime_ns"] = stat.st_mtime_ns
+
+    return signature
+
+
+def huc_fingerprint(input_paths, config, checksum=False, signatures=None):
+    """
+    Hash one HUC's input files together with the stage configuration.
+
+    Args:
+        input_paths: Files the HUC's outputs are built from
+        config: JSON-serializable dict of settings that affect the outputs
+        checksum: Passed to file_signature
+        signatures: Optional dict of path -> file_signature, filled as files are
+            signed; share it across HUCs so files they have in common are read once
+
+    Returns:
+        Hex digest string
+    """
+    if signatures is None:
+        signatures = {}
+    for p in input_paths:
+        if str(p) not in signatures:
+            signatures[str(p)] = file_signature(p, checksum)
+    payload = {
+        "inputs": [signatures[p] for p in sorted(str(p) for p in input_paths)],
+        "config": config,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_manifest(manifest_path):
+    """Load a manifest, or return an empty one if it does not exist yet."""
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    """Write a manifest atomically so an interrupted run cannot corrupt it."""
+    manifest_path = Path(manifest_path)
+    tmp_path = manifest_path.with_suffix(manifest_path.suffix + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_up_to_date(manifest, huc_id, fingerprint, output_paths):
+    """True if the HUC was built from the same inputs/config and its outputs still exist."""
+    entry = manifest.get(str(huc_id))
+    return (
+        entry is not None
+        and entry["fingerprint"] == fingerprint
+        and all(Path(p).exists() for p in output_paths)
+    )
+
+
+def record_huc(manifest, huc_id, fingerprint, output_paths, skipped=None):
+    """
+    Record a finished HUC in the manifest.
+
+    Args:
+        manifest: Manifest dict (updated in place)
+        huc_id: HUC id
+        fingerprint: Output of huc_fingerprint
+        output_paths: Files written for the HUC
+        skipped: Optional dict describing why the HUC produced no outputs, kept
+            so later runs can report it without reprocessing
+    """
+    manifest[str(huc_id)] = {
+        "fingerprint": fingerprint,
+        "outputs": [str(p) for p in output_paths],
+        "skipped": skipped,
+    }
+
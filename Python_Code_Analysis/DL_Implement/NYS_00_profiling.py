@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import csv
+import functools
+import json
+import time
+
+import torch
+
+
+# In[ ]:
+
+
+# === STAGE TIMING ===
+# Pipeline functions take an optional timer and wrap their stages in
+# timer.stage("name"). With timer=None they use NULL_TIMER, which does nothing,
+# so instrumentation costs nothing unless a run asks for a report.
+
+class StageTimer:
+    """
+    Wall-clock time and call counts per named stage, plus free-form counters.
+
+    Stages can nest (e.g. "forward" inside "predict_block"); each stage records its
+    own inclusive time. With sync=True the device is synchronized around every
+    stage, so asynchronous CUDA/MPS work is charged to the stage that queued it
+    (slower, but the per-stage split is accurate).
+    """
+
+    def __init__(self, name="run", device=None, sync=False, torch_profiler=None):
+        """
+        Args:
+            name: Run name stored in the report
+            device: torch.device to synchronize when sync=True
+            sync: Synchronize the device at stage boundaries
+            torch_profiler: Optional torch.profiler.profile (see make_torch_profiler);
+                stages are labeled in its trace and step() advances its schedule
+        """
+        self.name = name
+        self.device = device
+        self.sync = sync
+        self.torch_profiler = torch_profiler
+        self.stages = {}  # stage name -> [calls, total_seconds, min_seconds, max_seconds]
+        self.counters = {}
+        self.started = time.perf_counter()
+        self.wall_seconds = None
+
+    def _synchronize(self):
+        if not self.sync or self.device is None:
+            return
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        elif self.device.type == "mps":
+            torch.mps.synchronize()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one call of stage `name`."""
+        self._synchronize()
+        label = torch.profiler.record_function(name) if self.torch_profiler is not None else nullcontext()
+        start = time.perf_counter()
+        try:
+            with label:
+                yield
+                self._synchronize()
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name=None):
+        """Decorator that times every call of a function as stage `name` (default: function name)."""
+        def decorator(func):
+            stage_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, seconds, calls=1):
+        """Record `calls` calls of stage `name` taking `seconds` in total."""
+        entry = self.stages.get(name)
+        if entry is None:
+            self.stages[name] = [calls, seconds, seconds / calls, seconds / calls]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] = min(entry[2], seconds / calls)
+            entry[3] = max(entry[3], seconds / calls)
+
+    def count(self, name, n=1):
+        """Add n to counter `name` (e.g. patches, samples, bytes)."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def step(self):
+        """Mark the end of one iteration (advances the torch.profiler schedule)."""
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def start(self):
+        """Restart the wall clock and start the torch profiler, if any."""
+        self.started = time.perf_counter()
+        if self.torch_profiler is not None:
+            self.torch_profiler.start()
+
+    def stop(self):
+        """Freeze the wall clock and stop the torch profiler, if any."""
+        self.wall_seconds = time.perf_counter() - self.started
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+
+    def merge(self, report):
+        """
+        Add the stages and counters of another timer's report (e.g. from a worker process).
+
+        Merged worker time is summed, so percent_of_wall can exceed 100 for parallel runs.
+        """
+        for name, s in report["stages"].items():
+            entry = self.stages.setdefault(name, [0, 0.0, s["min_ms"] / 1000, s["max_ms"] / 1000])
+            entry[0] += s["calls"]
+            entry[1] += s["total_seconds"]
+            entry[2] = min(entry[2], s["min_ms"] / 1000)
+            entry[3] = max(entry[3], s["max_ms"] / 1000)
+        for name, value in report["counters"].items():
+            self.count(name, value)
+
+    def report(self):
+        """
+        Summarize the run.
+
+        Returns:
+            Dict with name, wall_seconds, stages (calls, total_seconds, mean/min/max
+            in ms, percent_of_wall), and counters
+        """
+        wall = self.wall_seconds if self.wall_seconds is not None else time.perf_counter() - self.started
+        stages = {}
+        for name, (calls, total, min_s, max_s) in sorted(self.stages.items(), key=lambda kv: -kv[1][1]):
+            stages[name] = {
+                "calls": calls,
+                "total_seconds": total,
+                "mean_ms": 1000 * total / calls,
+                "min_ms": 1000 * min_s,
+                "max_ms": 1000 * max_s,
+                "percent_of_wall": 100 * total / wall if wall > 0 else 0.0,
+            }
+        return {"name": self.name, "wall_seconds": wall, "stages": stages, "counters": dict(self.counters)}
+
+    def save(self, path):
+        """
+        Write the report as <path>.json and <path>.csv.
+
+        Returns:
+            json_path, csv_path
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report = self.report()
+
+        json_path = path.with_suffix(".json")
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        csv_path = path.with_suffix(".csv")
+        fields = ["kind", "name", "calls", "total_seconds", "mean_ms", "min_ms", "max_ms", "percent_of_wall", "value"]
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerow({"kind": "wall", "name": report["name"], "total_seconds": report["wall_seconds"]})
+            for name, s in report["stages"].items():
+                writer.writerow({"kind": "stage", "name": name, **s})
+            for name, value in report["counters"].items():
+                writer.writerow({"kind": "counter", "name": name, "value": value})
+
+        return json_path, csv_path
+
+    def print_summary(self):
+        report = self.report()
+        print(f"\nProfile '{report['name']}': {report['wall_seconds']:.2f}s wall")
+        print(f"  {'stage':28s} {'calls':>8s} {'total (s)':>10s} {'mean (ms)':>10s} {'% wall':>7s}")
+        for name, s in report["stages"].items():
+            print(f"  {name:28s} {s['calls']:8d} {s['total_seconds']:10.3f} {s['mean_ms']:10.2f} "
+                  f"{s['percent_of_wall']:7.1f}")
+        for name, value in report["counters"].items():
+            print(f"  {name:28s} {value:>8,}")
+
+
+class _NullTimer:
+    """Timer with the StageTimer interface that records nothing."""
+
+    def stage(self, name):
+        return nullcontext()
+
+    def timed(self, name=None):
+        return lambda func: func
+
+    def add(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def step(self):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def make_torch_profiler(trace_dir, wait=1, warmup=1, active=5, record_shapes=False):
+    """
+    Build a torch.profiler.profile for a StageTimer.
+
+    Profiles `active` iterations after skipping `wait` and warming up for `warmup`
+    (iterations are marked with StageTimer.step), and writes a trace to trace_dir
+    that opens in TensorBoard or chrome://tracing / Perfetto.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(str(trace_dir)),
+        record_shapes=record_shapes,
+    )
+
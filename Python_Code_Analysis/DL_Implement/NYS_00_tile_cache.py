@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import hashlib
+import multiprocessing
+import os
+import threading
+import weakref
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+# In[ ]:
+
+
+# === TILE CACHE ===
+# Raster windows are assembled from cached tiles that align to the GeoTIFF's
+# internal blocks, so overlapping patch and halo reads, and repeated runs in one
+# process, read each block from disk once. Pipeline code reads through
+# get_tile_cache(); set_tile_cache() swaps in a different budget or a
+# SharedTileCache before workers are started.
+
+def tile_shape(src, min_tile):
+    """Tile size for a raster: whole internal blocks, at least min_tile pixels per side."""
+    block_rows, block_cols = src.block_shapes[0]
+    return (min(src.height, block_rows * -(-min_tile // block_rows)),
+            min(src.width, block_cols * -(-min_tile // block_cols)))
+
+
+class TileCache:
+    """
+    LRU cache of raster tiles keyed by (raster path, file size, file mtime, band,
+    tile row, tile col).
+
+    Tiles are stored as float32. Once the cached bytes exceed max_bytes, the least
+    recently used tiles are evicted. The file's size and mtime are part of the key,
+    so a rewritten raster is read again instead of served from stale tiles (which
+    age out of the LRU). hits and misses count tile lookups, one per band and tile
+    a read touches.
+
+    The cache is safe to share between threads: the tile LRU and counters are
+    guarded by a lock, and each thread reads through its own open datasets (an LRU
+    of at most max_sources handles per thread), since a GDAL handle must not be
+    used or closed by two threads at once.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, min_tile=256, max_sources=16):
+        """
+        Args:
+            max_bytes: Cache budget in bytes (0 = read through without caching)
+            min_tile: Minimum tile height/width in pixels (rounded up to whole blocks)
+            max_sources: Maximum number of rasters each thread keeps open
+        """
+        self.max_bytes = int(max_bytes)
+        self.min_tile = min_tile
+        self.max_sources = max_sources
+        self.hits = self.misses = self.evictions = 0
+        self.cached_bytes = 0
+        self._tiles = OrderedDict()
+        self._init_process_state()
+
+    def _init_process_state(self):
+        """Lock and per-thread datasets, which are never shared with another process."""
+        self._tiles_lock = threading.Lock()
+        self._local = threading.local()  # .sources: path -> ((st_size, st_mtime_ns), open dataset)
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # Locks and open datasets are per process; cached tiles are not copied to other processes
+        state = self.__dict__.copy()
+        del state["_tiles_lock"], state["_local"]
+        state.update(_tiles=OrderedDict(), cached_bytes=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
+
+    def _thread_sources(self):
+        if self._pid != os.getpid():
+            # Forked child: GDAL handles and locks must not be shared with the parent
+            self._init_process_state()
+        if not hasattr(self._local, "sources"):
+            self._local.sources = OrderedDict()
+        return self._local.sources
+
+    def _source(self, path):
+        """This thread's open dataset for path and the (st_size, st_mtime_ns) of the file it was opened from."""
+        sources = self._thread_sources()
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = sources.pop(path, None)
+        if cached is not None and cached[0] != version:
+            cached[1].close()  # File was rewritten since it was opened
+            cached = None
+        if cached is None:
+            cached = (version, rasterio.open(path))
+        sources[path] = cached
+        while len(sources) > self.max_sources:
+            _, (_, old) = sources.popitem(last=False)
+            old.close()
+        return cached[1], version
+
+    def _get(self, key):
+        with self._tiles_lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def _put(self, key, tile):
+        if tile.nbytes > self.max_bytes:
+            return
+        with self._tiles_lock:
+            if key in self._tiles:
+                return  # Another thread cached it first
+            self._tiles[key] = tile
+            self.cached_bytes += tile.nbytes
+            while self.cached_bytes > self.max_bytes:
+                _, old = self._tiles.popitem(last=False)
+                self.cached_bytes -= old.nbytes
+                self.evictions += 1
+
+    def _count(self, hits, misses):
+        with self._tiles_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def read(self, path, indexes, window, out=None):
+        """
+        Read a window of some bands of a raster through the cache.
+
+        Args:
+            path: Raster path
+            indexes: 1-based band index or list of band indexes
+            window: rasterio Window inside the raster
+            out: Optional float32 array (len(indexes), height, width) to fill
+
+        Returns:
+            float32 array (len(indexes), window.height, window.width)
+        """
+        path = str(path)
+        src, version = self._source(path)
+        indexes = [indexes] if isinstance(indexes, int) else list(indexes)
+        if self.max_bytes == 0:
+            # Read through: one read of the window, no tiles to assemble or copy
+            return src.read(indexes, window=window, out=out, out_dtype=np.float32)
+        r0, c0 = int(window.row_off), int(window.col_off)
+        r1, c1 = r0 + int(window.height), c0 + int(window.width)
+        if out is None:
+            out = np.empty((len(indexes), r1 - r0, c1 - c0), dtype=np.float32)
+
+        th, tw = tile_shape(src, self.min_tile)
+        hits = misses = 0
+        for ti in range(r0 // th, (r1 - 1) // th + 1):
+            for tj in range(c0 // tw, (c1 - 1) // tw + 1):
+                keys = [(path, *version, band, ti, tj) for band in indexes]
+                tiles = [self._get(key) for key in keys]
+
+                # One read for all bands of the tile that are not cached
+                missing = [b for b, tile in enumerate(tiles) if tile is None]
+                if missing:
+                    tile_window = Window(tj * tw, ti * th, min(tw, src.width - tj * tw), min(th, src.height - ti * th))
+                    data = src.read([indexes[b] for b in missing], window=tile_window, out_dtype=np.float32)
+                    for b, band_data in zip(missing, data):
+                        tiles[b] = band_data.copy()
+                        self._put(keys[b], tiles[b])
+                hits += len(keys) - len(missing)
+                misses += len(missing)
+
+                # Overlap of the window and the tile
+                tr0, tr1 = max(r0, ti * th), min(r1, (ti + 1) * th)
+                tc0, tc1 = max(c0, tj * tw), min(c1, (tj + 1) * tw)
+                for b, tile in enumerate(tiles):
+                    out[b, tr0 - r0:tr1 - r0, tc0 - c0:tc1 - c0] = tile[tr0 - ti * th:tr1 - ti * th,
+                                                                         tc0 - tj * tw:tc1 - tj * tw]
+        self._count(hits, misses)
+        return out
+
+    def stats(self):
+        """Hit/miss counters and cache size as a dict."""
+        with self._tiles_lock:
+            hits, misses, evictions, cached_bytes = self.hits, self.misses, self.evictions, self.cached_bytes
+        lookups = hits + misses
+        return {
+            "hits": int(hits),
+            "misses": int(misses),
+            "evictions": int(evictions),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "cached_mb": cached_bytes / 2**20,
+            "max_mb": self.max_bytes / 2**20,
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"Tile cache: {s['hits']:,} hits, {s['misses']:,} misses ({s['hit_rate']:.0%} hit rate), "
+                f"{s['evictions']:,} evictions, {s['cached_mb']:.0f}/{s['max_mb']:.0f} MB")
+
+    def clear(self):
+        """Drop all cached tiles, close this thread's open rasters, and reset the counters."""
+        self.close_sources()
+        with self._tiles_lock:
+            self._tiles.clear()
+            self.cached_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def close_sources(self):
+        """Close the rasters this thread has open (they are reopened on its next read)."""
+        sources = self._thread_sources()
+        for _, src in sources.values():
+            src.close()
+        sources.clear()
+
+
+class SharedTileCache(TileCache):
+    """
+    TileCache whose tiles live in shared memory, shared by worker processes.
+
+    The cache is a fixed number of tile_size x tile_size float32 slots plus a
+    slot table (key hash, last use, tile shape) and shared hit/miss/eviction
+    counters, all guarded by one lock. Create it in the main process before
+    starting workers; forked workers inherit it and spawned DataLoader workers
+    re-attach to it by name when the dataset is unpickled. Tiles larger than a
+    slot (e.g. wide strips of stripped GeoTIFFs) are read but not cached.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, min_tile=256, tile_size=256, context=None, max_sources=16):
+        """
+        Args:
+            max_bytes: Cache budget in bytes (rounded down to whole slots)
+            min_tile: Minimum tile height/width in pixels (rounded up to whole blocks)
+            tile_size: Slot height/width in pixels
+            context: Start method of the worker processes ("fork", "spawn", or None
+                for the platform default), which the lock must match
+            max_sources: Maximum number of rasters each thread keeps open
+        """
+        super().__init__(max_bytes, min_tile, max_sources)
+        self.tile_size = tile_size
+        self.n_slots = max(1, self.max_bytes // (tile_size * tile_size * 4))
+        self._lock = multiprocessing.get_context(context).Lock()
+        self._shm = shared_memory.SharedMemory(create=True, size=self._layout_bytes())
+        self._attach()
+        self._keys[:] = 0
+        self._last_used[:] = -1
+        self._counters[:] = 0
+        self._finalizer = weakref.finalize(self, _release_shared_memory, self._shm, os.getpid())
+
+    def _layout_bytes(self):
+        return self.n_slots * (self.tile_size * self.tile_size * 4 + 8 + 8 + 8) + 4 * 8
+
+    def _attach(self):
+        """Numpy views of the slot data, slot table, and counters in the shared block."""
+        n, size, buf = self.n_slots, self.tile_size, self._shm.buf
+        offset = 0
+        self._data = np.ndarray((n, size, size), dtype=np.float32, buffer=buf, offset=offset)
+        offset += self._data.nbytes
+        self._keys = np.ndarray(n, dtype=np.int64, buffer=buf, offset=offset)
+        offset += self._keys.nbytes
+        self._last_used = np.ndarray(n, dtype=np.int64, buffer=buf, offset=offset)
+        offset += self._last_used.nbytes
+        self._shapes = np.ndarray((n, 2), dtype=np.int32, buffer=buf, offset=offset)
+        offset += self._shapes.nbytes
+        # hits, misses, evictions, access clock
+        self._counters = np.ndarray(4, dtype=np.int64, buffer=buf, offset=offset)
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items()
+                 if k not in ("_shm", "_data", "_keys", "_last_used", "_shapes", "_counters", "_finalizer",
+                              "_tiles_lock", "_local")}
+        state["_shm_name"] = self._shm.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop("_shm_name")
+        super().__setstate__(state)
+        self._shm = _attach_shared_memory(name)
+        self._attach()
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little", signed=True) or 1  # 0 marks an empty slot
+
+    def _get(self, key):
+        h = self._hash(key)
+        with self._lock:
+            slot = np.flatnonzero(self._keys == h)
+            if not len(slot):
+                return None
+            slot = slot[0]
+            self._counters[3] += 1
+            self._last_used[slot] = self._counters[3]
+            rows, cols = self._shapes[slot]
+            return self._data[slot, :rows, :cols].copy()
+
+    def _put(self, key, tile):
+        if tile.shape[0] > self.tile_size or tile.shape[1] > self.tile_size:
+            return
+        h = self._hash(key)
+        with self._lock:
+            if (self._keys == h).any():
+                return  # Another worker cached it first
+            slot = np.argmin(self._last_used)
+            if self._keys[slot] != 0:
+                self._counters[2] += 1
+            self._counters[3] += 1
+            self._keys[slot] = h
+            self._last_used[slot] = self._counters[3]
+            self._shapes[slot] = tile.shape
+            self._data[slot, :tile.shape[0], :tile.shape[1]] = tile
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self._counters[0] += hits
+            self._counters[1] += misses
+
+    def stats(self):
+        with self._lock:
+            self.hits, self.misses, self.evictions = (int(c) for c in self._counters[:3])
+            used = self._keys != 0
+            self.cached_bytes = int(self._shapes[used].prod(axis=1).sum()) * 4
+        stats = super().stats()
+        stats["max_mb"] = self._data.nbytes / 2**20
+        return stats
+
+    def clear(self):
+        self.close_sources()
+        with self._lock:
+            self._keys[:] = 0
+            self._last_used[:] = -1
+            self._counters[:] = 0
+
+    def close(self):
+        """Release the shared memory (also done when the creating object is garbage collected)."""
+        self._finalizer()
+
+
+def _release_shared_memory(shm, owner_pid):
+    shm.close()
+    if os.getpid() == owner_pid:  # Forked children must not unlink the parent's block
+        shm.unlink()
+
+
+def _attach_shared_memory(name):
+    """Attach to the block created by the parent process (only the creator unlinks it)."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        # Workers share the creator's resource tracker, which already tracks the block
+        return shared_memory.SharedMemory(name=name)
+
+
+_tile_cache = None
+
+
+def get_tile_cache():
+    """The process-wide tile cache (a 512 MB TileCache unless set_tile_cache was called)."""
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = TileCache()
+    return _tile_cache
+
+
+def set_tile_cache(cache):
+    """Replace the process-wide tile cache, e.g. with a larger budget or a SharedTileCache."""
+    global _tile_cache
+    _tile_cache = cache
+    return cache
+
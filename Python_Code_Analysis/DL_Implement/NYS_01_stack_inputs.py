@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from pathlib import Path
+import os
+workdir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/")
+print(workdir)
+os.chdir(workdir)
+current_working_dir = Path.cwd()
+print(f"Current working directory is now: {current_working_dir}")
+
+
+# In[ ]:
+
+
+import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+import geopandas as gpd
+import numpy as np
+import json
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared pipeline cache helpers
+script_dir = Path("Python_Code_Analysis/DL_Implement/")
+sys.path.insert(0, str(script_dir))
+from NYS_00_pipeline_cache import load_manifest, save_manifest, huc_fingerprint, is_up_to_date, record_huc
+
+
+# In[ ]:
+
+
+# === Cluster Import ===
+aoi_hucs = gpd.read_file(args[0], where=f"cluster = '{args[1]}' AND huc12 LIKE '{args[2]}'")
+aoi_hucs
+
+
+# In[ ]:
+
+
+# === CONFIGURATION ===
+
+# Input rasters, in the band order the cube is written (must match NYS_03_create_patches_v2.ipynb)
+raster_inputs = [
+    {
+        "name": "naip",
+        "path_pattern": "Data/NAIP/HUC_NAIP_Processed/*{huc}*.tif",
+        "bands": None,  # Read from raster descriptions (r, g, b, nir, ndvi, ndwi)
+    },
+    {
+        "name": "dem",
+        "path_pattern": "Data/TerrainProcessed/HUC_DEMs/*{huc}.tif",
+        "bands": ["dem"],
+    },
+    {
+        "name": "chm",
+        "path_pattern": "Data/CHMs/HUC_CHMs/*{huc}*.tif",
+        "bands": ["chm"],
+    },
+    {
+        "name": "terrain",
+        "path_pattern": "Data/TerrainProcessed/HUC_TerrainMetrics/*{huc}*5m.tif",
+        "bands": None,  # Read from descriptions (slope_5m, TPI_5m, Geomorph_5m)
+    },
+]
+
+# === CUBE FORMAT ===
+# float32, NoData = NaN, all bands of a pixel stored together (pixel interleave), so one
+# tile read returns every band of a window. Band descriptions hold the band names.
+cube_dir = Path("Data/InputCubes")
+cube_pattern = "Data/InputCubes/huc_{huc}_inputs.tif"  # Used as a raster_inputs path_pattern downstream
+compress = "DEFLATE"  # COG compression (DEFLATE, ZSTD, LZW); floating-point predictor is always on
+blocksize = 256  # Tile size in pixels (the tile cache reads whole tiles)
+overview_resampling = "nearest"  # Overviews are for viewing only; nearest keeps Geomorph classes intact
+block_rows = 1024  # Rows read and written per window while stacking
+
+n_workers = 1  # Worker processes (1 = serial)
+use_cache = True  # Skip HUCs whose input rasters and cube format are unchanged since the last run
+cache_checksum = False  # Detect input changes by file hash instead of size + mtime
+
+cube_dir.mkdir(parents=True, exist_ok=True)
+cube_config = {
+    "raster_inputs": raster_inputs,
+    "compress": compress,
+    "blocksize": blocksize,
+    "overview_resampling": overview_resampling,
+}
+
+
+# In[ ]:
+
+
+def huc_input_paths(huc):
+    """First match of each raster_inputs pattern for a HUC (missing inputs are left out)."""
+    paths = []
+    for raster_cfg in raster_inputs:
+        paths += list(Path(".").glob(raster_cfg["path_pattern"].replace("{huc}", huc)))[:1]
+    return paths
+
+
+def cube_path(huc):
+    return Path(cube_pattern.replace("{huc}", huc))
+
+
+def write_input_cube(huc):
+    """
+    Stack one HUC's input rasters into a single band-interleaved COG.
+
+    Bands are resolved as in NYS_03 (configured names, raster descriptions, or
+    "<name>_<n>") and written in raster_inputs order. Pixel values are copied
+    unchanged as float32, so reading a window of the cube gives the same array
+    as reading and stacking the separate rasters.
+
+    Returns:
+        None if the cube was written, otherwise a dict describing why the HUC was skipped
+    """
+    sources = []
+    band_names = []
+    try:
+        for raster_cfg in raster_inputs:
+            pattern = raster_cfg["path_pattern"].replace("{huc}", huc)
+            matches = list(Path(".").glob(pattern))
+            if not matches:
+                return {"huc": huc, "reason": f"No files found for {raster_cfg['name']}: {pattern}"}
+
+            src = rasterio.open(matches[0])
+            sources.append(src)
+            first = sources[0]
+            if (src.height, src.width) != (first.height, first.width) or src.transform != first.transform:
+                raise ValueError(f"{matches[0].name} is not aligned with {Path(first.name).name}")
+
+            if raster_cfg["bands"] is not None:
+                names = raster_cfg["bands"]
+            elif src.descriptions and all(src.descriptions):
+                names = list(src.descriptions)
+            else:
+                names = [f"{raster_cfg['name']}_{j+1}" for j in range(src.count)]
+            if len(names) != src.count:
+                raise ValueError(
+                    f"Band count mismatch for {raster_cfg['name']}: "
+                    f"got {len(names)} names but {src.count} bands"
+                )
+            for name in names:
+                if name in band_names:
+                    raise ValueError(f"Duplicate band name: {name}")
+                band_names.append(name)
+
+        # === STACK INTO A TILED GTIFF, ONE STRIP AT A TIME ===
+        first = sources[0]
+        out_path = cube_path(huc)
+        tmp_path = out_path.with_name(out_path.stem + "_stacking.tif")
+        profile = {
+            "driver": "GTiff", "height": first.height, "width": first.width, "count": len(band_names),
+            "dtype": "float32", "nodata": np.nan, "crs": first.crs, "transform": first.transform,
+            "tiled": True, "blockxsize": blocksize, "blockysize": blocksize,
+            "interleave": "pixel", "bigtiff": "IF_SAFER",
+        }
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            for r0 in range(0, first.height, block_rows):
+                window = Window(0, r0, first.width, min(block_rows, first.height - r0))
+                dst.write(np.concatenate([src.read(window=window, out_dtype=np.float32) for src in sources]),
+                          window=window)
+            for j, name in enumerate(band_names):
+                dst.set_band_description(j + 1, name)
+            dst.update_tags(band_names=json.dumps(band_names),
+                            sources=json.dumps([Path(src.name).name for src in sources]))
+
+        # === CONVERT TO COG (tiles reordered, overviews added, compressed) ===
+        rasterio.shutil.copy(
+            tmp_path, out_path, driver="COG",
+            compress=compress, predictor="YES", blocksize=blocksize,
+            overview_resampling=overview_resampling, bigtiff="IF_SAFER", num_threads="ALL_CPUS",
+        )
+        tmp_path.unlink()
+        print(f"  {huc}: {len(band_names)} bands -> {out_path} ({out_path.stat().st_size / 2**20:.1f} MB)")
+        return None
+    finally:
+        for src in sources:
+            src.close()
+
+
+# In[ ]:
+
+
+# === STACK ALL HUCS ===
+huc_list = list(aoi_hucs['huc12'])
+
+# Only HUCs whose input rasters or cube format changed are rebuilt
+manifest_path = cube_dir / f"cluster_{args[1]}_inputs_manifest.json"
+manifest = load_manifest(manifest_path)
+fingerprints = {i: huc_fingerprint(huc_input_paths(i), cube_config, cache_checksum) for i in huc_list}
+stale_hucs = [
+    i for i in huc_list
+    if not use_cache
+    or not is_up_to_date(manifest, i, fingerprints[i],
+                         [] if manifest.get(str(i), {}).get("skipped") else [cube_path(i)])
+]
+print(f"HUCs up to date: {len(huc_list) - len(stale_hucs)}, to stack: {len(stale_hucs)}")
+
+if n_workers > 1:
+    # fork so workers inherit the functions and configuration defined in this notebook
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        results = list(pool.map(write_input_cube, stale_hucs))
+else:
+    results = [write_input_cube(i) for i in stale_hucs]
+
+for i, result in zip(stale_hucs, results):
+    record_huc(manifest, i, fingerprints[i], [cube_path(i)] if result is None else [], skipped=result)
+save_manifest(manifest_path, manifest)
+
+skipped_hucs = [manifest[str(i)]["skipped"] for i in huc_list if manifest[str(i)]["skipped"]]
+print(f"\nHUC cubes ready: {len(huc_list) - len(skipped_hucs)}, skipped: {len(skipped_hucs)}")
+for skip in skipped_hucs:
+    print(f"  - {skip['huc']}: {skip['reason']}")
+
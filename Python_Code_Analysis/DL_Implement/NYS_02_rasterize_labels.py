@@ -18,9 +18,19 @@ print(f"Current working directory is now: {current_working_dir}")
 
 import rasterio
 from rasterio import features
+from rasterio.windows import Window
 import geopandas as gpd
+import pandas as pd
+import shapely
 import numpy as np
 import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Shared pipeline cache helpers
+script_dir = Path("Python_Code_Analysis/DL_Implement/")
+sys.path.insert(0, str(script_dir))
+from NYS_00_pipeline_cache import load_manifest, save_manifest, huc_fingerprint, is_up_to_date, record_huc
 
 
 # In[4]:
@@ -45,3 +55,16 @@ class_mapping = {
     'OWW': 4,  # Open Water Wetland
 }
 
+# === CLUSTER MODE ===
+cluster_mode = False  # Load wetlands once and rasterize all HUCs against a shared spatial index
+cluster_wetlands_path = None  # One wetlands layer covering the cluster (None = combine per-HUC files)
+n_workers = 1  # Worker processes for cluster mode (1 = serial)
+block_size = 1024  # Rows/cols rasterized and written per window in cluster mode
+
+# === PIPELINE CACHE ===
+use_cache = True  # Skip HUCs whose inputs and class mapping are unchanged since the last run
+cache_checksum = False  # Detect input changes by file hash instead of size + mtime
+manifest_path = Path(args[4]) / f"cluster_{args[1]}_labels_manifest.json"
+label_config = {"class_mapping": class_mapping, "cluster_mode": cluster_mode}
+manifest = load_manifest(manifest_path)
+
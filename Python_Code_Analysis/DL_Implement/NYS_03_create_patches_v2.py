@@ -20,10 +20,20 @@ import rasterio
 import geopandas as gpd
 import numpy as np
 from pathlib import Path
-from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 import json
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared helpers
+script_dir = Path("Python_Code_Analysis/DL_Implement/")
+sys.path.insert(0, str(script_dir))
+from NYS_00_patch_extraction import extract_huc_patches
+from NYS_00_pipeline_cache import load_manifest, save_manifest, huc_fingerprint, is_up_to_date, record_huc
+from NYS_00_profiling import NULL_TIMER, StageTimer
+from NYS_00_tile_cache import TileCache, set_tile_cache
 
 
 # In[13]:
@@ -42,8 +52,21 @@ ny_hucs
 patch_size = 128
 max_offset = 32  # Random offset from centroid (pixels) to add variety
 background_patches = 120  # Number of random background patches to include
+background_stride = 8  # Spacing (pixels) of candidate background origins (1 = every origin, more memory)
+strip_rows = 512  # Rows per strip when merging patch windows into block reads (bounds the rows per read)
 val_split = 0.2
 random_seed = 42
+n_workers = 1  # Worker processes for patch extraction (1 = serial)
+store_normalized = False  # Save bands with fixed normalization_rules already normalized
+compact_storage = False  # Save bands as uint8/int16 per storage_rules instead of float32 (~2.5x smaller)
+stats_hist_bins = 0  # Fixed-bin histogram bins per band in band_stats (0 = off)
+stats_hist_ranges = {}  # Band name -> (min, max) histogram range, shared by all HUCs
+use_cache = True  # Skip HUCs whose inputs and configuration are unchanged since the last run
+cache_checksum = False  # Detect input changes by file hash instead of size + mtime
+profile = False  # Time each extraction stage per HUC and save output_dir/cluster_<id>_profile.json/.csv
+tile_cache_mb = 0  # Raster tile cache per process (NYS_00_tile_cache); 0 = off, extraction reads each window once
+
+set_tile_cache(TileCache(tile_cache_mb * 2**20))
 
 output_dir = Path("Data/Patches_v2")
 
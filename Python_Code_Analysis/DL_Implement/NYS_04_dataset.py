@@ -9,7 +9,9 @@ import os
 import json
 
 workdir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/")
-os.chdir(workdir)
+# Only switch to the data workspace where it exists (e.g. not for the synthetic benchmark)
+if workdir.exists():
+    os.chdir(workdir)
 print(f"Current working directory: {Path.cwd()}")
 
 # === CONFIGURATION ===
@@ -28,15 +30,276 @@ print(f"  huc_id: {huc_id or 'All HUCs in cluster'}")
 
 
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler, WeightedRandomSampler
 import numpy as np
+import rasterio
+from rasterio.windows import Window
+import sys
+
+# Shared helpers
+script_dir = Path("Python_Code_Analysis/DL_Implement/")
+sys.path.insert(0, str(script_dir))
+from NYS_00_profiling import NULL_TIMER
+from NYS_00_tile_cache import get_tile_cache
 
 
 # In[9]:
 
 
+def compile_normalization(band_names, normalization, prenormalized_bands=()):
+    """
+    Compile per-band normalization rules into scale/offset vectors.
+
+    Every rule is affine, so normalized = X * scale + offset per band:
+    - divide:      scale = 1 / value
+    - shift_scale: scale = 1 / scale, offset = shift / scale
+    - minmax:      scale = 1 / (max - min), offset = -min / (max - min)
+                   (scale = offset = 0 for constant bands)
+
+    Bands listed in prenormalized_bands were normalized before being saved
+    and get scale 1, offset 0.
+
+    Returns:
+        scale, offset: float32 arrays of shape (bands, 1, 1)
+    """
+    scale = np.ones(len(band_names), dtype=np.float64)
+    offset = np.zeros(len(band_names), dtype=np.float64)
+
+    for i, band_name in enumerate(band_names):
+        if band_name in prenormalized_bands:
+            continue
+        norm_params = normalization[band_name]
+
+        if norm_params["type"] == "divide":
+            scale[i] = 1.0 / norm_params["value"]
+        elif norm_params["type"] == "shift_scale":
+            scale[i] = 1.0 / norm_params["scale"]
+            offset[i] = norm_params["shift"] / norm_params["scale"]
+        elif norm_params["type"] == "minmax":
+            min_val = norm_params["min"]
+            max_val = norm_params["max"]
+            if max_val - min_val > 0:
+                scale[i] = 1.0 / (max_val - min_val)
+                offset[i] = -min_val / (max_val - min_val)
+            else:
+                scale[i] = 0.0  # Handle constant bands
+                offset[i] = 0.0
+
+    return (scale.astype(np.float32).reshape(-1, 1, 1),
+            offset.astype(np.float32).reshape(-1, 1, 1))
+
+
+def compile_storage(band_names, storage=None):
+    """
+    Compile the storage encoding of compact patches into decode scale/offset vectors.
+
+    Compact bands are saved as stored = round((X - offset) / scale), so
+    X = stored * scale + offset. Bands without a storage entry (and float32
+    patch files, storage=None) decode with scale 1, offset 0.
+
+    Returns:
+        scale, offset: float32 arrays of shape (bands, 1, 1)
+    """
+    storage = storage or {}
+    scale = [storage[name]["scale"] if name in storage else 1.0 for name in band_names]
+    offset = [storage[name]["offset"] if name in storage else 0.0 for name in band_names]
+    return (np.array(scale, dtype=np.float32).reshape(-1, 1, 1),
+            np.array(offset, dtype=np.float32).reshape(-1, 1, 1))
+
+
+def encode_patches(X, band_names, storage_rules):
+    """
+    Pack float32 patches into a structured array with one compact field per band.
+
+    Bands listed in storage_rules are stored as round((X - offset) / scale) in the
+    rule's dtype (values outside the dtype range are clipped with a warning); other
+    bands stay float32. Each record is one patch, so the saved file can still be
+    memory-mapped and indexed by patch like the float32 layout.
+
+    Args:
+        X: float32 array (n_patches, bands, H, W)
+        band_names: Band names in X order
+        storage_rules: Dict of band name -> {"dtype", "scale", "offset"}
+
+    Returns:
+        records: Structured array (n_patches,) with one (H, W) field per band
+        storage: Dict of band name -> {"dtype", "scale", "offset"} for the metadata
+    """
+    storage = {
+        name: dict(storage_rules.get(name, {"dtype": "float32", "scale": 1.0, "offset": 0.0}))
+        for name in band_names
+    }
+    records = np.empty(len(X), dtype=[(name, storage[name]["dtype"], X.shape[2:]) for name in band_names])
+
+    for b, name in enumerate(band_names):
+        dtype = np.dtype(storage[name]["dtype"])
+        if dtype.kind == "f":
+            records[name] = X[:, b]
+            continue
+        values = np.rint((X[:, b] - storage[name]["offset"]) / storage[name]["scale"])
+        info = np.iinfo(dtype)
+        clipped = np.count_nonzero((values < info.min) | (values > info.max))
+        if clipped:
+            print(f"  WARNING: {clipped} '{name}' values outside the {dtype} range were clipped")
+        records[name] = np.clip(values, info.min, info.max)
+
+    return records, storage
+
+
+def unpack_patches(records):
+    """
+    Widen patches to float32 (n_patches, bands, H, W), without applying the storage scale.
+
+    Accepts float32 patch arrays (returned as-is) or encode_patches records.
+    """
+    if records.dtype.names is None:
+        return np.asarray(records, dtype=np.float32)
+    X = np.empty((len(records), len(records.dtype.names)) + records.dtype[0].shape, dtype=np.float32)
+    for b, name in enumerate(records.dtype.names):
+        X[:, b] = records[name]
+    return X
+
+
+def compute_band_stats(X, band_names, hist_bins=0, hist_ranges=None, chunk_size=64):
+    """
+    Compute mergeable per-band statistics in one streaming pass over X.
+
+    Each band gets count/sum/m2 accumulators (m2 = sum of squared deviations
+    from the mean) plus min/max, so statistics from any number of HUCs can be
+    merged exactly with merge_band_stats. mean and std (population, like
+    np.nanstd) are included for convenience. NaNs are ignored.
+
+    Args:
+        X: Array of shape (N, bands, H, W), may be a memory map
+        band_names: List of band names matching axis 1
+        hist_bins: Number of fixed histogram bins (0 = no histograms)
+        hist_ranges: Dict of band name -> (min, max) histogram range. Only bands
+            listed get a histogram; values outside the range go to the edge bins.
+        chunk_size: Patches processed per step (bounds float64 temporaries)
+
+    Returns:
+        Dictionary of band name -> stats dict
+    """
+    hist_ranges = hist_ranges or {}
+    n_bands = len(band_names)
+    count = np.zeros(n_bands, dtype=np.int64)
+    mean = np.zeros(n_bands)
+    m2 = np.zeros(n_bands)
+    band_min = np.full(n_bands, np.inf)
+    band_max = np.full(n_bands, -np.inf)
+    hists = {name: np.zeros(hist_bins, dtype=np.int64)
+             for name in band_names if hist_bins and name in hist_ranges}
+
+    for start in range(0, len(X), chunk_size):
+        block = np.asarray(X[start:start + chunk_size], dtype=np.float64)
+        valid = ~np.isnan(block)
+
+        # Chunk statistics, vectorized across bands
+        chunk_count = valid.sum(axis=(0, 2, 3))
+        chunk_sum = np.where(valid, block, 0.0).sum(axis=(0, 2, 3))
+        chunk_mean = np.divide(chunk_sum, chunk_count, out=np.zeros(n_bands), where=chunk_count > 0)
+        chunk_m2 = (np.where(valid, block - chunk_mean[:, None, None], 0.0) ** 2).sum(axis=(0, 2, 3))
+        band_min = np.minimum(band_min, np.where(valid, block, np.inf).min(axis=(0, 2, 3)))
+        band_max = np.maximum(band_max, np.where(valid, block, -np.inf).max(axis=(0, 2, 3)))
+
+        # Chan et al. pairwise merge of running and chunk accumulators
+        total = count + chunk_count
+        delta = chunk_mean - mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(total > 0, mean + delta * chunk_count / total, 0.0)
+            m2 = np.where(total > 0, m2 + chunk_m2 + delta ** 2 * count * chunk_count / total, 0.0)
+        count = total
+
+        for name, hist in hists.items():
+            j = band_names.index(name)
+            lo, hi = hist_ranges[name]
+            values = np.clip(block[:, j][valid[:, j]], lo, hi)
+            hist += np.histogram(values, bins=hist_bins, range=(lo, hi))[0]
+
+    band_stats = {}
+    for j, name in enumerate(band_names):
+        n = int(count[j])
+        band_stats[name] = {
+            "min": float(band_min[j]) if n else float("nan"),
+            "max": float(band_max[j]) if n else float("nan"),
+            "mean": float(mean[j]) if n else float("nan"),
+            "std": float(np.sqrt(m2[j] / n)) if n else float("nan"),
+            "count": n,
+            "sum": float(mean[j] * n),
+            "m2": float(m2[j]),
+        }
+        if name in hists:
+            band_stats[name]["hist"] = hists[name].tolist()
+            band_stats[name]["hist_range"] = [float(v) for v in hist_ranges[name]]
+
+    return band_stats
+
+
+def merge_band_stats(stats_list):
+    """
+    Exactly merge one band's statistics from several HUCs.
+
+    Uses the count/sum/m2 accumulators from compute_band_stats; the result has
+    the same keys, so merged statistics can be merged again hierarchically
+    (HUC -> cluster -> state). Histograms are summed when every input has one
+    with the same range and bin count. Older metadata without accumulators
+    falls back to an unweighted average of mean/std.
+
+    Args:
+        stats_list: List of stats dicts for the same band
+
+    Returns:
+        Merged stats dict
+    """
+    merged = {
+        "min": min(s["min"] for s in stats_list),
+        "max": max(s["max"] for s in stats_list),
+    }
+
+    if not all("count" in s for s in stats_list):
+        merged["mean"] = sum(s["mean"] for s in stats_list) / len(stats_list)  # Simple average
+        merged["std"] = sum(s["std"] for s in stats_list) / len(stats_list)    # Approximate
+        return merged
+
+    counts = np.array([s["count"] for s in stats_list], dtype=np.float64)
+    sums = np.array([s["sum"] for s in stats_list])
+    m2s = np.array([s["m2"] for s in stats_list])
+    count = counts.sum()
+    mean = sums.sum() / count if count else float("nan")
+
+    # Chan merge generalized to k groups: M2 = sum(M2_i) + sum(n_i * (mean_i - mean)^2)
+    group_means = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    m2 = m2s.sum() + (counts * (group_means - mean) ** 2).sum() if count else 0.0
+
+    merged.update({
+        "mean": float(mean),
+        "std": float(np.sqrt(m2 / count)) if count else float("nan"),
+        "count": int(count),
+        "sum": float(sums.sum()),
+        "m2": float(m2),
+    })
+
+    hist_ranges = [s.get("hist_range") for s in stats_list]
+    hist_lengths = [len(s.get("hist", [])) for s in stats_list]
+    if hist_ranges[0] is not None and all(r == hist_ranges[0] for r in hist_ranges) \
+            and len(set(hist_lengths)) == 1:
+        merged["hist"] = np.sum([s["hist"] for s in stats_list], axis=0).tolist()
+        merged["hist_range"] = hist_ranges[0]
+
+    return merged
+
+
 class WetlandDataset(Dataset):
-    """PyTorch Dataset for wetland segmentation patches."""
+    """
+    PyTorch Dataset for wetland segmentation patches.
+
+    Each per-HUC .npy file is a shard opened with mmap_mode='r', so startup only
+    reads the file headers and samples are paged in from disk when indexed.
+
+    Shards saved with compact storage (metadata["storage"], see encode_patches)
+    hold uint8/int16 bands; they are widened to float32 per batch and the storage
+    scale/offset is folded into the normalization multiply-add.
+    """
 
     def __init__(self, X_path, y_path, metadata, normalize=True):
         """
@@ -47,44 +310,316 @@ class WetlandDataset(Dataset):
             normalize: Whether to normalize inputs
         """
         # Handle single file or list of files
-        if isinstance(X_path, (list, tuple)):
-            self.X = np.concatenate([np.load(p) for p in X_path], axis=0)
-            self.y = np.concatenate([np.load(p) for p in y_path], axis=0)
-        else:
-            self.X = np.load(X_path)
-            self.y = np.load(y_path)
+        if not isinstance(X_path, (list, tuple)):
+            X_path, y_path = [X_path], [y_path]
+
+        # Memory-map each shard instead of loading and concatenating
+        self.X_path, self.y_path = list(X_path), list(y_path)
+        self._open_shards()
+
+        for p, X, y in zip(X_path, self.X_shards, self.y_shards):
+            if len(X) != len(y):
+                raise ValueError(f"{p}: {len(X)} input patches but {len(y)} label patches")
+
+        # Global index -> (shard, offset within shard) lookup table
+        shard_lengths = [len(X) for X in self.X_shards]
+        self.shard_index = np.repeat(np.arange(len(shard_lengths)), shard_lengths)
+        shard_starts = np.cumsum([0] + shard_lengths)[:-1]
+        self.shard_offset = np.arange(len(self.shard_index)) - np.repeat(shard_starts, shard_lengths)
 
         self.normalize = normalize
         self.metadata = metadata
         self.band_names = metadata["band_names"]
         self.normalization = metadata["normalization"]
 
+        # Compact shards are structured arrays with one field per band
+        X0 = self.X_shards[0]
+        self.compact = X0.dtype.names is not None
+        self.sample_shape = (len(X0.dtype.names),) + X0.dtype[0].shape if self.compact else X0.shape[1:]
+
+        # Compile storage decoding and normalization once into per-band scale/offset vectors
+        decode_scale, decode_offset = compile_storage(self.band_names, metadata.get("storage"))
+        if normalize:
+            scale, offset = compile_normalization(
+                self.band_names, self.normalization, metadata.get("prenormalized_bands", [])
+            )
+            self.scale, self.offset = decode_scale * scale, decode_offset * scale + offset
+        else:
+            self.scale, self.offset = decode_scale, decode_offset
+        self.affine = normalize or self.compact
+
+    def _open_shards(self):
+        self.X_shards = [np.load(p, mmap_mode="r") for p in self.X_path]
+        self.y_shards = [np.load(p, mmap_mode="r") for p in self.y_path]
+
+    def __getstate__(self):
+        # Re-open memory maps in DataLoader workers instead of pickling shard contents
+        state = self.__dict__.copy()
+        del state["X_shards"], state["y_shards"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_shards()
+
     def __len__(self):
-        return len(self.X)
+        return len(self.shard_index)
+
+    def get_batch(self, indices):
+        """
+        Fetch and normalize a whole batch with one fancy-index read per shard.
+
+        Args:
+            indices: Sequence of sample indices
+
+        Returns:
+            X: float32 tensor (batch, bands, H, W)
+            y: int64 tensor (batch, H, W)
+        """
+        indices = np.asarray(indices)
+        shards = self.shard_index[indices]
+        offsets = self.shard_offset[indices]
+
+        X = np.empty((len(indices),) + self.sample_shape, dtype=np.float32)
+        y = np.empty((len(indices),) + self.y_shards[0].shape[1:], dtype=np.int64)
+
+        for shard in np.unique(shards):
+            # Read rows of a shard in file order for sequential page-ins
+            batch_pos = np.flatnonzero(shards == shard)
+            batch_pos = batch_pos[np.argsort(offsets[batch_pos])]
+            X[batch_pos] = unpack_patches(self.X_shards[shard][offsets[batch_pos]])
+            y[batch_pos] = self.y_shards[shard][offsets[batch_pos]]
+
+        X = torch.from_numpy(X)
+        if self.affine:
+            X = torch.addcmul(torch.from_numpy(self.offset), X, torch.from_numpy(self.scale))
+
+        return X, torch.from_numpy(y)
 
     def __getitem__(self, idx):
-        X = self.X[idx].astype(np.float32).copy()
-        y = self.y[idx].astype(np.int64).copy()
-
-        if self.normalize:
-            for i, band_name in enumerate(self.band_names):
-                norm_params = self.normalization[band_name]
-
-                if norm_params["type"] == "divide":
-                    X[i] = X[i] / norm_params["value"]
-                elif norm_params["type"] == "shift_scale":
-                    X[i] = (X[i] + norm_params["shift"]) / norm_params["scale"]
-                elif norm_params["type"] == "minmax":
-                    min_val = norm_params["min"]
-                    max_val = norm_params["max"]
-                    if max_val - min_val > 0:
-                        X[i] = (X[i] - min_val) / (max_val - min_val)
-                    else:
-                        X[i] = 0.0  # Handle constant bands
+        # A list of indices (from a BatchSampler) fetches a whole batch
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self.get_batch(idx)
+
+        shard, offset = self.shard_index[idx], self.shard_offset[idx]
+        y = np.array(self.y_shards[shard][offset], dtype=np.int64)
+
+        if self.compact:
+            X = unpack_patches(self.X_shards[shard][offset:offset + 1])[0]
+            X *= self.scale
+            X += self.offset
+        elif self.normalize:
+            # One multiply-add over all bands (writes a new float32 array, no extra copy)
+            X = np.multiply(self.X_shards[shard][offset], self.scale, dtype=np.float32)
+            X += self.offset
+        else:
+            X = np.array(self.X_shards[shard][offset], dtype=np.float32)
 
         return torch.from_numpy(X), torch.from_numpy(y)
 
 
+def find_huc_rasters(raster_inputs, huc):
+    """
+    Resolve one HUC's input rasters and band names the way NYS_03 does.
+
+    Args:
+        raster_inputs: raster_inputs list from NYS_03 (saved in the patch metadata)
+        huc: HUC id substituted into each path_pattern
+
+    Returns:
+        List of (raster path, band names) in band_names order
+    """
+    rasters = []
+    for raster_cfg in raster_inputs:
+        pattern = raster_cfg["path_pattern"].replace("{huc}", str(huc))
+        matches = list(Path(".").glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No files found for {raster_cfg['name']}: {pattern}")
+
+        with rasterio.open(matches[0]) as src:
+            if raster_cfg["bands"] is not None:
+                names = raster_cfg["bands"]
+            elif src.descriptions and all(src.descriptions):
+                names = list(src.descriptions)
+            else:
+                names = [f"{raster_cfg['name']}_{j+1}" for j in range(src.count)]
+        rasters.append((matches[0], names))
+    return rasters
+
+
+class RasterPatchDataset(Dataset):
+    """
+    Training patches sampled on the fly from the per-HUC source rasters.
+
+    Instead of the fixed patches saved by NYS_03, each fetch reads a fresh
+    patch_size window around a point of a regular grid (every sample_stride
+    pixels), moved by a random jitter of up to half the stride. Index i is grid
+    point i; use sampling_weights() with a WeightedRandomSampler to draw points
+    with per-class weights, so each epoch sees new locations without writing
+    patches to disk.
+
+    Windows of all bands plus labels are read through a tile cache
+    (NYS_00_tile_cache), so overlapping patches reuse reads; pass a
+    SharedTileCache to share one cache between DataLoader workers. NoData
+    (NaN) pixels are set to 0 after
+    normalization, as in NYS_08 prediction; patches with more than
+    max_nodata_fraction NoData are redrawn.
+    """
+
+    def __init__(self, hucs, metadata, cluster_id, normalize=True, sample_stride=16,
+                 labels_pattern="Data/Training_Data/DL_HUC_Extracted_Training_Data/cluster_{cluster}_huc_{huc}_labels.tif",
+                 tile_cache=None, max_nodata_fraction=0.5):
+        """
+        Args:
+            hucs: HUC ids to sample from
+            metadata: Merged patch metadata (band_names, normalization, raster_inputs, patch_size)
+            cluster_id: Cluster id used in labels_pattern
+            normalize: Whether to normalize inputs
+            sample_stride: Grid spacing of the sample points in pixels
+            labels_pattern: Label raster path with {cluster} and {huc} placeholders
+            tile_cache: TileCache to read through (None = the process-wide get_tile_cache())
+            max_nodata_fraction: Redraw patches with a larger NoData fraction
+        """
+        self.metadata = metadata
+        self.band_names = metadata["band_names"]
+        self.patch_size = metadata["patch_size"]
+        self.tile_cache = tile_cache
+        self.max_nodata_fraction = max_nodata_fraction
+
+        # Raw rasters: no storage decoding and no pre-normalized bands
+        if normalize:
+            self.scale, self.offset = compile_normalization(self.band_names, metadata["normalization"])
+        else:
+            # Same (bands, 1, 1) shape as compile_normalization, so get_batch broadcasts per band
+            self.scale = np.ones((len(self.band_names), 1, 1), dtype=np.float32)
+            self.offset = np.zeros((len(self.band_names), 1, 1), dtype=np.float32)
+
+        # Per HUC: (raster path, 1-based band indexes) in band_names order, plus the labels
+        self.hucs, self.huc_rasters, self.label_paths, self.shapes = [], [], [], []
+        grid_huc, grid_row, grid_col, grid_class = [], [], [], []
+        for huc in hucs:
+            rasters = find_huc_rasters(metadata["raster_inputs"], huc)
+            names = [name for _, band_names in rasters for name in band_names]
+            if names != self.band_names:
+                raise ValueError(f"HUC {huc}: raster bands {names} do not match metadata band_names")
+            label_path = Path(labels_pattern.format(cluster=cluster_id, huc=huc))
+
+            # Grid points sit at the centers of sample_stride cells and carry the label there
+            with rasterio.open(label_path) as src:
+                labels = src.read(1)
+            height, width = labels.shape
+            if height < self.patch_size or width < self.patch_size:
+                print(f"  Skipping HUC {huc}: {height} x {width} is smaller than one patch")
+                continue
+            grid = labels[sample_stride // 2::sample_stride, sample_stride // 2::sample_stride]
+            rows, cols = np.indices(grid.shape).reshape(2, -1)
+
+            grid_huc.append(np.full(len(rows), len(self.hucs), dtype=np.int32))
+            grid_row.append((rows * sample_stride + sample_stride // 2).astype(np.int32))
+            grid_col.append((cols * sample_stride + sample_stride // 2).astype(np.int32))
+            grid_class.append(grid.ravel())
+            self.hucs.append(huc)
+            self.huc_rasters.append([(str(path), list(range(1, len(band_names) + 1))) for path, band_names in rasters])
+            self.label_paths.append(str(label_path))
+            self.shapes.append((height, width))
+
+        if not self.hucs:
+            raise ValueError("No HUC rasters large enough to sample patches from")
+        self.grid_huc = np.concatenate(grid_huc)
+        self.grid_row = np.concatenate(grid_row)
+        self.grid_col = np.concatenate(grid_col)
+        self.grid_class = np.concatenate(grid_class)
+        # Grid points of each class, for redrawing patches with too much NoData
+        self.class_points = {c: np.flatnonzero(self.grid_class == c) for c in np.unique(self.grid_class)}
+        self.jitter= sample_stride // 2
+        self._pid = None
+
+    def _start_process(self):
+        """Seed the jitter RNG once per process (torch seeds each DataLoader worker differently)."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.rng = np.random.default_rng(torch.initial_seed())
+
+    def __len__(self):
+        return len(self.grid_huc)
+
+    def sampling_weights(self, class_weights=None):
+        """
+        Per-point weights for a WeightedRandomSampler.
+
+        Args:
+            class_weights: Relative probability of drawing a point of each class
+                (indexed by label), or None to draw every point equally
+
+        Returns:
+            float64 array (len(self),)
+        """
+        if class_weights is None:
+            return np.ones(len(self))
+        class_weights = np.asarray(class_weights, dtype=np.float64)
+        class_counts = np.bincount(self.grid_class, minlength=len(class_weights))
+        # Each class's weight is shared among its points; absent classes get none
+        per_point = np.divide(class_weights, class_counts[:len(class_weights)],
+                              out=np.zeros(len(class_weights)), where=class_counts[:len(class_weights)] > 0)
+        return per_point[self.grid_class]
+
+    def read_window(self, h, row, col, X_out, y_out):
+        """Read the patch with upper-left corner (row, col) of HUC h through the tile cache."""
+        cache = self.tile_cache or get_tile_cache()
+        window = Window(col, row, self.patch_size, self.patch_size)
+        band = 0
+        for path, indexes in self.huc_rasters[h]:
+            cache.read(path, indexes, window, out=X_out[band:band + len(indexes)])
+            band += len(indexes)
+        y_out[:] = cache.read(self.label_paths[h], 1, window)[0]
+
+    def _patch_origin(self, idx):
+        """Jittered upper-left corner of a patch around grid point idx, kept inside the raster."""
+        h = self.grid_huc[idx]
+        height, width = self.shapes[h]
+        row, col = self.grid_row[idx], self.grid_col[idx]
+        if self.jitter:
+            d_row, d_col = self.rng.integers(-self.jitter, self.jitter + 1, size=2)
+            row, col = row + d_row, col + d_col
+        row = min(max(row - self.patch_size // 2, 0), height - self.patch_size)
+        col = min(max(col - self.patch_size // 2, 0), width - self.patch_size)
+        return h, row, col
+
+    def get_batch(self, indices, max_tries=10):
+        """
+        Read, normalize, and NoData-fill a batch of patches around grid points.
+
+        Args:
+            indices: Sequence of grid point indices
+            max_tries: Draws per sample before accepting a patch with too much NoData
+
+        Returns:
+            X: float32 tensor (batch, bands, H, W)
+            y: int64 tensor (batch, H, W)
+        """
+        self._start_process()
+        size = self.patch_size
+        X = np.empty((len(indices), len(self.band_names), size, size), dtype=np.float32)
+        y = np.empty((len(indices), size, size), dtype=np.uint8)
+        for b, idx in enumerate(indices):
+            for attempt in range(max_tries):
+                self.read_window(*self._patch_origin(idx), X[b], y[b])
+                if np.isnan(X[b]).any(axis=0).mean() <= self.max_nodata_fraction:
+                    break
+                # Too much NoData: move to another point of the same class
+                idx = self.rng.choice(self.class_points[self.grid_class[idx]])
+
+        X = torch.addcmul(torch.from_numpy(self.offset), torch.from_numpy(X), torch.from_numpy(self.scale))
+        return torch.nan_to_num_(X, nan=0.0), torch.from_numpy(y.astype(np.int64))
+
+    def __getitem__(self, idx):
+        # A list of indices (from a BatchSampler) fetches a whole batch
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self.get_batch(idx)
+        X, y = self.get_batch([idx])
+        return X[0], y[0]
+
+
 def find_patch_files(data_dir, cluster_id=None, huc_id=None):
     """
     Find patch files based on cluster/HUC configuration.
@@ -139,8 +674,9 @@ def load_and_merge_metadata(metadata_files):
     """
     Load and merge metadata from multiple HUC files.
 
-    For band_stats, computes global min/max across all files.
+    For band_stats, computes global min/max and exact count-weighted mean/std.
     For normalization with minmax, updates to use global stats.
+    Per-HUC class_pixel_counts are summed into one histogram.
     """
     if isinstance(metadata_files, (str, Path)):
         # Single file
@@ -156,22 +692,12 @@ def load_and_merge_metadata(metadata_files):
     # Start with first file as base
     merged = all_metadata[0].copy()
 
-    # Merge band_stats: compute global min/max
+    # Merge band_stats: global min/max and count-weighted mean/std
     band_names = merged["band_names"]
     merged_stats = {}
 
     for band in band_names:
-        mins = [m["band_stats"][band]["min"] for m in all_metadata]
-        maxs = [m["band_stats"][band]["max"] for m in all_metadata]
-        means = [m["band_stats"][band]["mean"] for m in all_metadata]
-        stds = [m["band_stats"][band]["std"] for m in all_metadata]
-
-        merged_stats[band] = {
-            "min": min(mins),
-            "max": max(maxs),
-            "mean": sum(means) / len(means),  # Simple average
-            "std": sum(stds) / len(stds),      # Approximate
-        }
+        merged_stats[band] = merge_band_stats([m["band_stats"][band] for m in all_metadata])
 
     merged["band_stats"] = merged_stats
 
@@ -181,15 +707,41 @@ def load_and_merge_metadata(metadata_files):
             norm["min"] = merged_stats[band]["min"]
             norm["max"] = merged_stats[band]["max"]
 
+    # Pre-normalized bands must agree, since all HUCs share one scale/offset per band
+    prenormalized = [sorted(m.get("prenormalized_bands", [])) for m in all_metadata]
+    if any(p != prenormalized[0] for p in prenormalized):
+        raise ValueError(
+            "HUC metadata files disagree on prenormalized_bands; "
+            "re-run NYS_03 with the same store_normalized setting for all HUCs"
+        )
+
+    # Storage encodings must agree too, since decoding is folded into the shared scale/offset
+    if any(m.get("storage") != all_metadata[0].get("storage") for m in all_metadata):
+        raise ValueError(
+            "HUC metadata files disagree on storage; "
+            "re-run NYS_03 with the same compact_storage setting for all HUCs"
+        )
+
     # Sum up counts
     merged["n_train"] = sum(m["n_train"] for m in all_metadata)
     merged["n_val"] = sum(m["n_val"] for m in all_metadata)
+    if all("class_pixel_counts" in m for m in all_metadata):
+        merged["class_pixel_counts"] = np.sum(
+            [m["class_pixel_counts"] for m in all_metadata], axis=0
+        ).tolist()
+    else:
+        # Older patch files without histograms; class weights fall back to y_train
+        merged.pop("class_pixel_counts", None)
     merged["hucs_included"] = [mf.stem.split("_")[-2] for mf in metadata_files]
 
     return merged
 
 
-def get_dataloaders(data_dir, cluster_id=None, huc_id=None, batch_size=16):
+def get_dataloaders(data_dir, cluster_id=None, huc_id=None, batch_size=16,
+                    batched=True, num_workers=0, pin_memory=False,
+                    persistent_workers=False, prefetch_factor=2, timer=None,
+                    train_from_rasters=False, samples_per_epoch=None, class_sampling_weights=None,
+                    tile_cache=None):
     """
     Create training and validation DataLoaders.
 
@@ -198,47 +750,109 @@ def get_dataloaders(data_dir, cluster_id=None, huc_id=None, batch_size=16):
         cluster_id: Cluster ID to load (None for legacy files)
         huc_id: Specific HUC to load (None for all HUCs in cluster)
         batch_size: Batch size for DataLoaders
+        batched: Fetch each batch with one WetlandDataset.get_batch call instead of
+            batch_size __getitem__ calls plus default collation
+        num_workers: DataLoader worker processes (0 = load in the main process)
+        pin_memory: Pin batches in page-locked memory for faster host-to-GPU copies
+        persistent_workers: Keep workers alive between epochs (needs num_workers > 0)
+        prefetch_factor: Batches prefetched per worker (needs num_workers > 0)
+        timer: Optional StageTimer (NYS_00_profiling) for the setup stages
+        train_from_rasters: Sample training patches on the fly from the source rasters
+            (RasterPatchDataset) instead of the saved patches; validation still uses
+            the saved validation patches
+        samples_per_epoch: Patches drawn per epoch with train_from_rasters
+            (None = as many as the saved training patches)
+        class_sampling_weights: Per-class draw weights for train_from_rasters
+            (see RasterPatchDataset.sampling_weights)
+        tile_cache: TileCache or SharedTileCache for train_from_rasters
+            (None = each process's get_tile_cache())
 
     Returns:
         train_loader, val_loader, metadata
     """
-    files = find_patch_files(data_dir, cluster_id, huc_id)
+    timer = timer or NULL_TIMER
+
+    with timer.stage("loader/find_files"):
+        files = find_patch_files(data_dir, cluster_id, huc_id)
 
     # Load metadata
-    if "metadata" in files:
-        metadata = load_and_merge_metadata(files["metadata"])
-    else:
-        metadata = load_and_merge_metadata(files["metadata_files"])
+    with timer.stage("loader/load_metadata"):
+        if "metadata" in files:
+            metadata = load_and_merge_metadata(files["metadata"])
+        else:
+            metadata = load_and_merge_metadata(files["metadata_files"])
 
     print(f"Found {len(files['X_train'])} training file(s)")
     print(f"Found {len(files['X_val'])} validation file(s)")
 
-    train_dataset = WetlandDataset(
-        files["X_train"],
-        files["y_train"],
-        metadata,
-        normalize=True
-    )
-    val_dataset = WetlandDataset(
-        files["X_val"],
-        files["y_val"],
-        metadata,
-        normalize=True
-    )
-
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=0
-    )
-
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=0
-    )
+    with timer.stage("loader/open_datasets"):
+        if train_from_rasters:
+            if cluster_id is None:
+                raise ValueError("train_from_rasters needs a cluster_id to find the HUC rasters")
+            # Patch files are named cluster_<id>_X_train_<huc>_.npy
+            hucs = [Path(p).stem.split("_")[-2] for p in files["X_train"]]
+            train_dataset = RasterPatchDataset(hucs, metadata, cluster_id, normalize=True, tile_cache=tile_cache)
+        else:
+            train_dataset = WetlandDataset(
+                files["X_train"],
+                files["y_train"],
+                metadata,
+                normalize=True
+            )
+        val_dataset = WetlandDataset(
+            files["X_val"],
+            files["y_val"],
+            metadata,
+            normalize=True
+        )
+    timer.count("train_patches", len(train_dataset))
+    timer.count("val_patches", len(val_dataset))
+
+    loader_kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "persistent_workers": persistent_workers and num_workers > 0,
+        "prefetch_factor": prefetch_factor if num_workers > 0 else None,
+    }
+
+    if train_from_rasters:
+        # A fresh weighted draw of grid points every epoch
+        train_sampler = WeightedRandomSampler(
+            train_dataset.sampling_weights(class_sampling_weights),
+            num_samples=samples_per_epoch or metadata["n_train"],
+        )
+    else:
+        train_sampler = RandomSampler(train_dataset)
+
+    if batched:
+        # BatchSampler yields index lists; batch_size=None hands each list to get_batch as-is
+        train_loader = DataLoader(
+            train_dataset,
+            sampler=BatchSampler(train_sampler, batch_size, drop_last=False),
+            batch_size=None,
+            **loader_kwargs
+        )
+
+        val_loader = DataLoader(
+            val_dataset,
+            sampler=BatchSampler(SequentialSampler(val_dataset), batch_size, drop_last=False),
+            batch_size=None,
+            **loader_kwargs
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            sampler=train_sampler,
+            **loader_kwargs
+        )
+
+        val_loader = DataLoader(
+            val_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            **loader_kwargs
+        )
 
     return train_loader, val_loader, metadata
 
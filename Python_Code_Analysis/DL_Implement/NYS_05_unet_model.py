@@ -138,6 +138,7 @@ if __name__ == "__main__" or 'get_ipython' in dir():
 
 import torch
 import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, fuse_modules
 
 class ConvBlock(nn.Module):
     """Two consecutive conv layers with BatchNorm and ReLU."""
@@ -156,6 +157,10 @@ class ConvBlock(nn.Module):
     def forward(self, x):
         return self.conv(x)
 
+    def fuse_model(self):
+        """Fuse each Conv2d + BatchNorm2d + ReLU into one module (eval mode, for quantization)."""
+        fuse_modules(self.conv, [["0", "1", "2"], ["3", "4", "5"]], inplace=True)
+
 
 class EncoderBlock(nn.Module):
     """ConvBlock followed by MaxPool for downsampling."""
@@ -180,10 +185,11 @@ class DecoderBlock(nn.Module):
             in_channels, out_channels, kernel_size=2, stride=2
         )
         self.conv = ConvBlock(out_channels * 2, out_channels)  # *2 for concatenation
+        self.skip_cat = nn.quantized.FloatFunctional()  # torch.cat that also works on quantized tensors
 
     def forward(self, x, skip):
         x = self.upsample(x)
-        x = torch.cat([x, skip], dim=1)  # Concatenate along channel dimension
+        x = self.skip_cat.cat([x, skip], dim=1)  # Concatenate along channel dimension
         return self.conv(x)
 
 
@@ -219,7 +225,13 @@ class UNet(nn.Module):
         # Final classification layer
         self.final = nn.Conv2d(f, num_classes, kernel_size=1)
 
+        # Float <-> int8 boundaries for static quantization (no-ops in the float model)
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+
     def forward(self, x):
+        x = self.quant(x)
+
         # Encoder
         skip1, x = self.enc1(x)
         skip2, x = self.enc2(x)
@@ -236,7 +248,117 @@ class UNet(nn.Module):
         x = self.dec1(x, skip1)
 
         # Output
-        return self.final(x)
+        return self.dequant(self.final(x))
+
+    def fuse_model(self):
+        """Fuse Conv + BatchNorm + ReLU in every ConvBlock (call on an eval-mode copy)."""
+        for module in self.modules():
+            if isinstance(module, ConvBlock):
+                module.fuse_model()
+
+
+# In[ ]:
+
+
+import copy
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# === INFERENCE EXPORT ===
+def fold_batchnorm(model):
+    """
+    Fold every BatchNorm2d into the Conv2d that feeds it, for inference.
+
+    In eval mode BatchNorm is a fixed per-channel scale and shift, so it can be
+    merged into the preceding convolution's weights and bias. The returned
+    model computes the same outputs with one fewer layer per conv.
+
+    Args:
+        model: Trained UNet (not modified)
+
+    Returns:
+        folded: Copy of the model in eval mode with each BatchNorm2d replaced by Identity
+    """
+    folded = copy.deepcopy(model).eval()
+
+    for module in folded.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        # ConvBlock layers are Conv2d, BatchNorm2d, ReLU, Conv2d, BatchNorm2d, ReLU
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(conv, bn)
+                module[i + 1] = nn.Identity()
+
+    return folded
+
+
+# In[ ]:
+
+
+from torch.ao.quantization import QConfig, default_weight_observer, get_default_qconfig, prepare, convert
+
+# === STATIC INT8 QUANTIZATION ===
+def default_quantized_engine():
+    """Quantized kernel backend for this machine: "x86" where this torch build supports it, else "qnnpack" (ARM)."""
+    return "x86" if "x86" in torch.backends.quantized.supported_engines else "qnnpack"
+
+
+def _prepare_quantization(model, engine):
+    """Fused eval-mode CPU copy of the model with observers inserted for calibration."""
+    qmodel = copy.deepcopy(model).cpu().eval()
+    qmodel.fuse_model()
+
+    qconfig = get_default_qconfig(engine)
+    qmodel.qconfig = qconfig
+    # Quantized ConvTranspose2d only supports per-tensor weight scales
+    for module in qmodel.modules():
+        if isinstance(module, nn.ConvTranspose2d):
+            module.qconfig = QConfig(activation=qconfig.activation, weight=default_weight_observer)
+
+    return prepare(qmodel)
+
+
+def quantize_unet(model, calibration_batches, engine=None):
+    """
+    Post-training static int8 quantization of a trained UNet.
+
+    Fuses Conv + BatchNorm + ReLU, records activation ranges on the calibration
+    batches, and converts weights and activations to int8. The quantized model
+    runs on CPU only.
+
+    Args:
+        model: Trained UNet (not modified)
+        calibration_batches: Iterable of normalized input batches (B, bands, H, W),
+            e.g. a sample of validation patches
+        engine: Quantized kernel backend ("x86" or "fbgemm" on Intel/AMD, "qnnpack" on ARM);
+            None for default_quantized_engine()
+
+    Returns:
+        qmodel: Quantized model in eval mode
+    """
+    engine = engine or default_quantized_engine()
+    torch.backends.quantized.engine = engine
+    qmodel = _prepare_quantization(model, engine)
+
+    with torch.no_grad():
+        for X in calibration_batches:
+            qmodel(X.cpu())
+
+    return convert(qmodel)
+
+
+def build_quantized_unet(in_channels, num_classes, base_filters=32, engine=None):
+    """
+    Uncalibrated int8 UNet with the same structure as quantize_unet's output.
+
+    Load a saved quantized state_dict into it to restore a quantized checkpoint.
+    engine=None uses default_quantized_engine().
+    """
+    engine = engine or default_quantized_engine()
+    torch.backends.quantized.engine = engine
+    qmodel = _prepare_quantization(UNet(in_channels, num_classes, base_filters), engine)
+    return convert(qmodel)
 
 
 # In[6]:
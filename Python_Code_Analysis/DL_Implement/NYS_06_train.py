@@ -1,6 +1,120 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+# In[3]:
+
+
+from pathlib import Path
+import argparse
+import os
+
+workdir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/")
+os.chdir(workdir)
+print(f"Current working directory: {Path.cwd()}")
+
+# === CONFIGURATION ===
+# Must match the output from NYS_03_create_patches_v2.ipynb
+data_dir = Path("Data/Patches_v2")
+cluster_id = 208  # Cluster to load, or None for legacy files
+huc_id = None     # Specific HUC to load, or None to combine all HUCs in cluster
+
+# Training hyperparameters
+num_epochs = 25
+batch_size = 10
+learning_rate = 0.001
+base_filters = 32  # U-Net base filter count
+
+# Data loading
+batched_loading = True  # Fetch and normalize whole batches at once (vs. per-sample collation)
+num_workers = 0         # DataLoader worker processes (0 = load in the main process)
+pin_memory = False      # Page-locked host memory for faster GPU transfers
+persistent_workers = False  # Keep workers alive between epochs
+prefetch_factor = 2     # Batches prefetched per worker
+
+# On-the-fly sampling from the source rasters (NYS_04 RasterPatchDataset)
+train_from_rasters = False     # Draw fresh training windows every epoch instead of the saved patches
+samples_per_epoch = None       # Windows per epoch (None = number of saved training patches)
+class_sampling_weights = None  # Per-class draw weights, e.g. [1, 1, 1, 1, 1]; None = every location equally
+tile_cache_mb = 512            # Raster tile cache budget (NYS_00_tile_cache)
+shared_tile_cache = False      # One cache in shared memory for all DataLoader workers (vs. one per worker)
+
+# Training speed
+mixed_precision = False  # Autocast: bfloat16 on CPU/MPS, float16 + GradScaler on CUDA
+channels_last = False    # NHWC memory format for model weights and inputs
+log_interval = 10        # Batches between loss printouts (each one syncs with the device)
+
+# Profiling
+profile = False        # Per-stage timings (syncs the device at stage boundaries) -> Models/profile_train.json/.csv
+torch_profile = False  # Also record a torch.profiler trace of a few training batches (needs profile)
+
+# === Terminal Import Args ===
+# parse_known_args ignores the extra arguments Jupyter passes to the kernel
+parser = argparse.ArgumentParser(description="Train the wetland U-Net")
+parser.add_argument("--batch-size", type=int, default=batch_size)
+parser.add_argument("--num-epochs", type=int, default=num_epochs)
+parser.add_argument("--num-workers", type=int, default=num_workers)
+parser.add_argument("--pin-memory", action=argparse.BooleanOptionalAction, default=pin_memory)
+parser.add_argument("--persistent-workers", action=argparse.BooleanOptionalAction, default=persistent_workers)
+parser.add_argument("--prefetch-factor", type=int, default=prefetch_factor)
+parser.add_argument("--train-from-rasters", action=argparse.BooleanOptionalAction, default=train_from_rasters)
+parser.add_argument("--samples-per-epoch", type=int, default=samples_per_epoch)
+parser.add_argument("--tile-cache-mb", type=int, default=tile_cache_mb)
+parser.add_argument("--shared-tile-cache", action=argparse.BooleanOptionalAction, default=shared_tile_cache)
+parser.add_argument("--batched-loading", action=argparse.BooleanOptionalAction, default=batched_loading)
+parser.add_argument("--mixed-precision", action=argparse.BooleanOptionalAction, default=mixed_precision)
+parser.add_argument("--channels-last", action=argparse.BooleanOptionalAction, default=channels_last)
+parser.add_argument("--log-interval", type=int, default=log_interval)
+parser.add_argument("--profile", action=argparse.BooleanOptionalAction, default=profile)
+parser.add_argument("--torch-profile", action=argparse.BooleanOptionalAction, default=torch_profile)
+cli_args, _ = parser.parse_known_args()
+
+batch_size = cli_args.batch_size
+num_epochs = cli_args.num_epochs
+num_workers = cli_args.num_workers
+pin_memory = cli_args.pin_memory
+persistent_workers = cli_args.persistent_workers
+prefetch_factor = cli_args.prefetch_factor
+train_from_rasters = cli_args.train_from_rasters
+samples_per_epoch = cli_args.samples_per_epoch
+tile_cache_mb = cli_args.tile_cache_mb
+shared_tile_cache = cli_args.shared_tile_cache
+batched_loading = cli_args.batched_loading
+mixed_precision = cli_args.mixed_precision
+channels_last = cli_args.channels_last
+log_interval = cli_args.log_interval
+profile = cli_args.profile or cli_args.torch_profile
+torch_profile = cli_args.torch_profile
+
+# Output directory for models
+output_dir = Path("Models")
+output_dir.mkdir(exist_ok=True)
+
+print(f"\nData Configuration:")
+print(f"  data_dir: {data_dir}")
+print(f"  cluster_id: {cluster_id}")
+print(f"  huc_id: {huc_id or 'All HUCs in cluster'}")
+print(f"\nTraining Configuration:")
+print(f"  num_epochs: {num_epochs}")
+print(f"  batch_size: {batch_size}")
+print(f"  learning_rate: {learning_rate}")
+print(f"  base_filters: {base_filters}")
+print(f"\nLoader Configuration:")
+print(f"  batched_loading: {batched_loading}")
+print(f"  num_workers: {num_workers}")
+print(f"  pin_memory: {pin_memory}")
+print(f"  persistent_workers: {persistent_workers}")
+print(f"  prefetch_factor: {prefetch_factor}")
+print(f"  train_from_rasters: {train_from_rasters} (samples_per_epoch: {samples_per_epoch}, "
+      f"class_sampling_weights: {class_sampling_weights})")
+print(f"  tile_cache_mb: {tile_cache_mb} (shared: {shared_tile_cache})")
+print(f"\nSpeed Configuration:")
+print(f"  mixed_precision: {mixed_precision}")
+print(f"  channels_last: {channels_last}")
+print(f"  log_interval: {log_interval}")
+print(f"  profile: {profile} (torch.profiler: {torch_profile})")
+print(f"  output_dir: {output_dir}")
+
+
 # In[4]:
 
 
@@ -11,6 +125,7 @@ import numpy as np
 import json
 import time
 import sys
+import resource
 
 # Add script directory to Python path
 script_dir = Path("Python_Code_Analysis/DL_Implement/")
@@ -19,6 +134,18 @@ sys.path.insert(0, str(script_dir))
 # Import modules
 from NYS_04_dataset import get_dataloaders, find_patch_files, load_and_merge_metadata
 from NYS_05_unet_model import UNet
+from NYS_00_profiling import NULL_TIMER, StageTimer, make_torch_profiler
+from NYS_00_tile_cache import TileCache, SharedTileCache, set_tile_cache
+
+# === PROFILING ===
+# Created before loading so the loader setup is part of the report; main() adds the device
+timer = StageTimer("train", sync=True) if profile else None
+
+# === TILE CACHE ===
+# Created before the DataLoader workers start, so a shared cache is inherited by all of them
+tile_cache = set_tile_cache(
+    SharedTileCache(tile_cache_mb * 2**20) if shared_tile_cache else TileCache(tile_cache_mb * 2**20)
+)
 
 # === LOAD DATA ===
 print("Loading data...")
@@ -26,7 +153,17 @@ train_loader, val_loader, metadata = get_dataloaders(
     data_dir, 
     cluster_id=cluster_id, 
     huc_id=huc_id, 
-    batch_size=batch_size
+    batch_size=batch_size,
+    batched=batched_loading,
+    num_workers=num_workers,
+    pin_memory=pin_memory,
+    persistent_workers=persistent_workers,
+    prefetch_factor=prefetch_factor,
+    timer=timer,
+    train_from_rasters=train_from_rasters,
+    samples_per_epoch=samples_per_epoch,
+    class_sampling_weights=class_sampling_weights,
+    tile_cache=tile_cache
 )
 
 print(f"\nDataset Summary:")
@@ -39,29 +176,237 @@ if "hucs_included" in metadata:
     print(f"  HUCs included: {metadata['hucs_included']}")
 
 
+# In[5]:
+
+
+def get_amp_settings(device, mixed_precision):
+    """
+    Pick the autocast dtype and gradient scaler for a device.
+
+    Args:
+        device: torch.device used for training
+        mixed_precision: Enable mixed precision (False returns fp32 settings)
+
+    Returns:
+        amp_dtype: Autocast dtype, or None for fp32
+        scaler: GradScaler for fp16 on CUDA, otherwise None
+    """
+    if not mixed_precision:
+        return None, None
+    if device.type == "cuda":
+        return torch.float16, torch.amp.GradScaler("cuda")
+    # bfloat16 keeps the fp32 exponent range, so no loss scaling is needed
+    return torch.bfloat16, None
+
+
+def reset_peak_memory(device):
+    """Reset the CUDA peak memory counter (CPU peak RSS cannot be reset)."""
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """Peak allocated CUDA memory, or peak process RSS on CPU/MPS, in MB."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def train_one_epoch(model, train_loader, criterion, optimizer, device,
+                    amp_dtype=None, scaler=None, channels_last=False, log_interval=10, timer=None):
+    """
+    Train for one epoch and return average loss and samples seen.
+
+    Args:
+        model: Model to train
+        train_loader: Training DataLoader
+        criterion: Loss function
+        optimizer: Optimizer
+        device: torch.device to train on
+        amp_dtype: Autocast dtype (None = full fp32)
+        scaler: GradScaler for fp16 training (None = unscaled backward)
+        channels_last: Feed inputs in channels_last memory format
+        log_interval: Batches between progress updates (the only host syncs)
+        timer: Optional StageTimer; times data loading, host-to-device copies,
+            forward, backward, and optimizer stages per batch
+
+    Returns:
+        Average training loss
+        Number of samples trained on (with train_from_rasters, the samples drawn
+        this epoch rather than the length of the dataset)
+    """
+    model.train()
+    running_loss = torch.zeros((), device=device)
+    n_samples = 0
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    timer = timer or NULL_TIMER
+
+    batches = iter(train_loader)
+    for batch_idx in range(len(train_loader)):
+        with timer.stage("train/data"):
+            X, y = next(batches)
+        n_samples += len(X)
+        timer.count("train/samples", len(X))
+
+        with timer.stage("train/h2d"):
+            X = X.to(device, non_blocking=True, memory_format=memory_format)
+            y = y.to(device, non_blocking=True)
+
+        # Forward pass
+        optimizer.zero_grad(set_to_none=True)
+        with timer.stage("train/forward"):
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(X)
+            loss = criterion(outputs.float(), y)
+
+        # Backward pass
+        with timer.stage("train/backward"):
+            if scaler is not None:
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+        with timer.stage("train/optimizer"):
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+
+        # Accumulate on-device to avoid a host sync every batch
+        running_loss += loss.detach()
+        timer.step()
+
+        # Progress update every log_interval batches
+        if (batch_idx + 1) % log_interval == 0:
+            print(f"    Batch {batch_idx + 1}/{len(train_loader)}, Loss: {loss.item():.4f}")
+
+    return running_loss.item() / len(train_loader), n_samples
+
+
+def confusion_metrics(conf_matrix, class_names):
+    """
+    Derive accuracy, IoU and F1 from a confusion matrix.
+
+    Args:
+        conf_matrix: (num_classes, num_classes) array, rows = true class, cols = predicted
+        class_names: List of class names
+
+    Returns:
+        Dictionary with overall_acc, mean_iou, and per-class class_acc/class_iou/class_f1
+    """
+    conf_matrix = np.asarray(conf_matrix, dtype=np.float64)
+    true_pos = np.diag(conf_matrix)
+    total_true = conf_matrix.sum(axis=1)  # Pixels of each class (recall denominator)
+    total_pred = conf_matrix.sum(axis=0)  # Pixels predicted as each class
+
+    # Classes absent from both labels and predictions score 0.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acc = np.nan_to_num(true_pos / total_true)
+        iou = np.nan_to_num(true_pos / (total_true + total_pred - true_pos))
+        f1 = np.nan_to_num(2 * true_pos / (total_true + total_pred))
+
+    present = total_true > 0
+
+    return {
+        "overall_acc": float(true_pos.sum() / max(conf_matrix.sum(), 1)),
+        "mean_iou": float(iou[present].mean()) if present.any() else 0.0,
+        "class_acc": {name: float(a) for name, a in zip(class_names, acc)},
+        "class_iou": {name: float(v) for name, v in zip(class_names, iou)},
+        "class_f1": {name: float(v) for name, v in zip(class_names, f1)},
+    }
+
+
+def validate(model, val_loader, criterion, device, metadata, amp_dtype=None, channels_last=False, timer=None):
+    """
+    Validate and return loss plus confusion-matrix metrics.
+
+    Args:
+        timer: Optional StageTimer for the data, h2d, forward, and metrics stages
+
+    Returns:
+        avg_loss: Average validation loss
+        metrics: Output of confusion_metrics, plus the raw confusion_matrix
+    """
+    model.eval()
+    num_classes = metadata["num_classes"]
+    class_names = metadata["class_names"]
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    timer = timer or NULL_TIMER
+
+    # Accumulate loss and confusion matrix on-device; one host sync per epoch
+    running_loss = torch.zeros((), device=device)
+    conf_matrix = torch.zeros(num_classes * num_classes, dtype=torch.int64, device=device)
+
+    with torch.no_grad():
+        batches = iter(val_loader)
+        for _ in range(len(val_loader)):
+            with timer.stage("val/data"):
+                X, y = next(batches)
+            timer.count("val/samples", len(X))
+
+            with timer.stage("val/h2d"):
+                X = X.to(device, non_blocking=True, memory_format=memory_format)
+                y = y.to(device, non_blocking=True)
+
+            with timer.stage("val/forward"):
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = model(X)
+                loss = criterion(outputs.float(), y)
+                running_loss += loss
+
+            with timer.stage("val/metrics"):
+                # Get predictions
+                preds = torch.argmax(outputs, dim=1)
+
+                # Row = true class, column = predicted class
+                conf_matrix += torch.bincount(
+                    (y * num_classes + preds).flatten(), minlength=num_classes * num_classes
+                )
+
+    avg_loss = running_loss.item() / len(val_loader)
+    conf_matrix = conf_matrix.reshape(num_classes, num_classes).cpu().numpy()
+
+    metrics = confusion_metrics(conf_matrix, class_names)
+    metrics["confusion_matrix"] = conf_matrix
+
+    return avg_loss, metrics
+
+
 # In[6]:
 
 
-def compute_class_weights(data_dir, cluster_id, huc_id, class_names):
-    """Compute class weights from training data using inverse frequency."""
-    files = find_patch_files(data_dir, cluster_id, huc_id)
+def compute_class_weights(data_dir, cluster_id, huc_id, class_names, metadata=None):
+    """
+    Compute class weights from training data using inverse frequency.
+
+    Uses the class_pixel_counts histogram from the metadata when available
+    (written per HUC by NYS_03 and summed by load_and_merge_metadata), and
+    only falls back to reading y_train files for older patch sets.
+    """
+    if metadata is not None and "class_pixel_counts" in metadata:
+        print("Using class pixel counts from metadata...")
+        counts = np.asarray(metadata["class_pixel_counts"], dtype=np.int64)
+    else:
+        files = find_patch_files(data_dir, cluster_id, huc_id)
 
-    print("Loading y_train files for class weight computation...")
-    y_train_list = [np.load(f) for f in files['y_train']]
-    y_train = np.concatenate(y_train_list, axis=0)
-    print(f"  Combined y_train shape: {y_train.shape}")
+        print("Counting y_train pixels for class weight computation...")
+        counts = np.zeros(len(class_names), dtype=np.int64)
+        for f in files['y_train']:
+            counts += np.bincount(np.load(f, mmap_mode="r").ravel(), minlength=len(class_names))
 
-    # Count pixels per class
-    classes, counts = np.unique(y_train, return_counts=True)
     total = counts.sum()
 
-    # Compute inverse frequency weights
+    # Compute inverse frequency weights (classes absent from training get weight 0)
     frequencies = counts / total
-    weights = 1.0 / frequencies
-    weights = weights / weights.min()  # Normalize so smallest weight is 1.0
+    weights = np.zeros(len(counts))
+    present = counts > 0
+    weights[present] = 1.0 / frequencies[present]
+    weights = weights / weights[present].min()  # Normalize so smallest weight is 1.0
 
     print("\nClass distribution and weights:")
-    for c, count, w in zip(classes, counts, weights):
+    for c, (count, w) in enumerate(zip(counts, weights)):
         pct = count / total * 100
         print(f"  {class_names[c]}: {count:,} pixels ({pct:.2f}%) -> weight: {w:.2f}")
 
@@ -74,9 +419,15 @@ def main():
                           "mps" if torch.backends.mps.is_available() else "cpu")
     print(f"Using device: {device}")
 
+    if timer is not None:
+        timer.device = device
+        if torch_profile:
+            timer.torch_profiler = make_torch_profiler(output_dir / "torch_profile")
+            timer.torch_profiler.start()
+
     # === COMPUTE CLASS WEIGHTS ===
     class_weights = compute_class_weights(
-        data_dir, cluster_id, huc_id, metadata["class_names"]
+        data_dir, cluster_id, huc_id, metadata["class_names"], metadata
     )
 
     # === CREATE MODEL ===
@@ -87,6 +438,10 @@ def main():
         base_filters=base_filters
     )
     model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    amp_dtype, scaler = get_amp_settings(device, mixed_precision)
+    print(f"Autocast dtype: {amp_dtype or 'float32'}, channels_last: {channels_last}")
 
     total_params = sum(p.numel() for p in model.parameters())
     print(f"Total parameters: {total_params:,}")
@@ -101,34 +456,64 @@ def main():
     print("=" * 60)
 
     best_val_loss = float('inf')
-    history = {'train_loss': [], 'val_loss': [], 'val_acc': []}
+    history = {'train_loss': [], 'val_loss': [], 'val_acc': [], 'val_miou': [],
+               'val_class_iou': [], 'val_class_f1': [],
+               'train_samples_per_sec': [], 'val_samples_per_sec': [],
+               'epoch_time': [], 'peak_memory_mb': []}
+    n_val = len(val_loader.dataset)
 
     for epoch in range(num_epochs):
+        reset_peak_memory(device)
         epoch_start = time.time()
         print(f"\nEpoch {epoch + 1}/{num_epochs}")
         print("-" * 40)
 
         # Train
-        train_loss = train_one_epoch(model, train_loader, criterion, optimizer, device)
+        train_loss, n_train = train_one_epoch(
+            model, train_loader, criterion, optimizer, device,
+            amp_dtype=amp_dtype, scaler=scaler,
+            channels_last=channels_last, log_interval=log_interval, timer=timer
+        )
+        train_time = time.time() - epoch_start
 
         # Validate
-        val_loss, val_acc, class_acc = validate(model, val_loader, criterion, device, metadata)
+        val_start = time.time()
+        val_loss, val_metrics = validate(
+            model, val_loader, criterion, device, metadata,
+            amp_dtype=amp_dtype, channels_last=channels_last, timer=timer
+        )
+        val_acc, val_miou = val_metrics["overall_acc"], val_metrics["mean_iou"]
+        val_time = time.time() - val_start
 
         epoch_time = time.time() - epoch_start
+        peak_memory = peak_memory_mb(device)
+        train_throughput = n_train / train_time
+        val_throughput = n_val / val_time
 
         # Log results
         print(f"\n  Train Loss: {train_loss:.4f}")
         print(f"  Val Loss:   {val_loss:.4f}")
         print(f"  Val Acc:    {val_acc:.4f}")
+        print(f"  Val mIoU:   {val_miou:.4f}")
         print(f"  Time:       {epoch_time:.1f}s")
-        print("  Per-class accuracy:")
-        for name, acc in class_acc.items():
-            print(f"    {name}: {acc:.4f}")
+        print(f"  Peak mem:   {peak_memory:.0f} MB")
+        print(f"  Throughput: {train_throughput:.1f} train / {val_throughput:.1f} val samples/sec")
+        print("  Per-class accuracy / IoU / F1:")
+        for name in metadata["class_names"]:
+            print(f"    {name}: {val_metrics['class_acc'][name]:.4f} / "
+                  f"{val_metrics['class_iou'][name]:.4f} / {val_metrics['class_f1'][name]:.4f}")
 
         # Save history
         history['train_loss'].append(train_loss)
         history['val_loss'].append(val_loss)
         history['val_acc'].append(val_acc)
+        history['val_miou'].append(val_miou)
+        history['val_class_iou'].append(val_metrics['class_iou'])
+        history['val_class_f1'].append(val_metrics['class_f1'])
+        history['train_samples_per_sec'].append(train_throughput)
+        history['val_samples_per_sec'].append(val_throughput)
+        history['epoch_time'].append(epoch_time)
+        history['peak_memory_mb'].append(peak_memory)
 
         # Save best model
         if val_loss < best_val_loss:
@@ -139,12 +524,15 @@ def main():
                 'optimizer_state_dict': optimizer.state_dict(),
                 'val_loss': val_loss,
                 'val_acc': val_acc,
+                'val_miou': val_miou,
                 'metadata': metadata,
                 'config': {
                     'cluster_id': cluster_id,
                     'huc_id': huc_id,
                     'base_filters': base_filters,
                     'learning_rate': learning_rate,
+                    'mixed_precision': mixed_precision,
+                    'channels_last': channels_last,
                 }
             }, output_dir / "best_model.pth")
             print("  [Saved new best model]")
@@ -156,17 +544,32 @@ def main():
         'optimizer_state_dict': optimizer.state_dict(),
         'val_loss': val_loss,
         'val_acc': val_acc,
+        'val_miou': val_miou,
         'metadata': metadata,
         'config': {
             'cluster_id': cluster_id,
             'huc_id': huc_id,
             'base_filters': base_filters,
             'learning_rate': learning_rate,
+            'mixed_precision': mixed_precision,
+            'channels_last': channels_last,
         }
     }, output_dir / "final_model.pth")
 
     np.save(output_dir / "training_history.npy", history)
 
+    if timer is not None:
+        timer.stop()
+        timer.print_summary()
+        json_path, csv_path = timer.save(output_dir / "profile_train")
+        print(f"Saved profile to: {json_path}, {csv_path}")
+        if torch_profile:
+            print(f"Saved torch.profiler trace to: {output_dir / 'torch_profile'}")
+
+    if train_from_rasters:
+        # Counters cover all workers only with shared_tile_cache; otherwise the main process
+        print(tile_cache.summary())
+
     print("\n" + "=" * 60)
     print("Training complete!")
     print(f"Best validation loss: {best_val_loss:.4f}")
@@ -178,3 +581,9 @@ def main():
 # Run training (comment out to prevent execution)
 history = main()
 
+
+# In[ ]:
+
+
+
+
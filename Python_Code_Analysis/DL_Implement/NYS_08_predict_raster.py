@@ -0,0 +1,1118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[2]:
+
+
+import torch
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+from rasterio import Affine
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import json
+import time
+from pathlib import Path
+import sys
+from tqdm import tqdm
+import matplotlib.pyplot as plt
+from matplotlib.colors import ListedColormap
+
+
+# In[3]:
+
+
+# Import model and utilities
+script_dir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/Python_Code_Analysis/DL_Implement")
+sys.path.insert(0, str(script_dir))
+
+from NYS_04_dataset import find_patch_files, load_and_merge_metadata
+from NYS_05_unet_model import UNet, fold_batchnorm, build_quantized_unet
+from NYS_00_profiling import NULL_TIMER, StageTimer
+from NYS_00_tile_cache import TileCache, get_tile_cache, set_tile_cache
+
+
+# In[16]:
+
+
+# Raster input configuration (must match NYS_03_create_patches_v2.ipynb)
+raster_inputs = [
+    {
+        "name": "naip",
+        "path_pattern": "Data/NAIP/HUC_NAIP_Processed/*{huc}*.tif",
+        "bands": None,  # Read from raster descriptions
+    },
+    {
+        "name": "dem",
+        "path_pattern": "Data/TerrainProcessed/HUC_DEMs/*{huc}.tif",
+        "bands": ["dem"],
+    },
+    {
+        "name": "chm",
+        "path_pattern": "Data/CHMs/HUC_CHMs/*{huc}*.tif",
+        "bands": ["chm"],
+    },
+    {
+        "name": "terrain",
+        "path_pattern": "Data/TerrainProcessed/HUC_TerrainMetrics/*{huc}*5m.tif",
+        "bands": None,  # Read from descriptions
+    },
+]
+
+# === PRE-STACKED INPUT CUBES (optional) ===
+# NYS_01_stack_inputs writes each HUC's bands into one band-interleaved COG with the
+# same band names and order, so one file and one read per window replace the rasters above
+use_input_cubes = False
+if use_input_cubes:
+    raster_inputs = [{"name": "cube", "path_pattern": "Data/InputCubes/huc_{huc}_inputs.tif", "bands": None}]
+
+print(f"Configured {len(raster_inputs)} raster inputs")
+
+
+# In[17]:
+
+
+def load_and_stack_rasters(raster_inputs, huc_id, expected_bands, tile_cache=None):
+    """
+    Load rasters and stack them in the expected band order.
+
+    Args:
+        raster_inputs: List of raster configuration dicts
+        huc_id: HUC ID to substitute in path patterns
+        expected_bands: List of band names in expected order (from metadata)
+        tile_cache: TileCache to read through (None = the process-wide get_tile_cache())
+
+    Returns:
+        stacked_data: numpy array (bands, height, width)
+        profile: rasterio profile for output
+        band_names: List of band names as loaded
+    """
+    bands = {}
+    band_names = []
+    profile = None
+    tile_cache = tile_cache or get_tile_cache()
+
+    for raster_cfg in raster_inputs:
+        pattern = raster_cfg["path_pattern"].replace("{huc}", huc_id)
+        matches = list(Path(".").glob(pattern))
+
+        if not matches:
+            raise FileNotFoundError(f"No files found for {raster_cfg['name']}: {pattern}")
+
+        raster_path = matches[0]
+        print(f"  Loading {raster_cfg['name']}: {raster_path.name}")
+
+        with rasterio.open(raster_path) as src:
+            data = tile_cache.read(raster_path, list(range(1, src.count + 1)), Window(0, 0, src.width, src.height))
+
+            # Store profile from first raster for output
+            if profile is None:
+                profile = src.profile.copy()
+
+            # Determine band names
+            if raster_cfg["bands"] is not None:
+                names = raster_cfg["bands"]
+            elif src.descriptions and all(src.descriptions):
+                names = list(src.descriptions)
+            else:
+                names = [f"{raster_cfg['name']}_{j+1}" for j in range(src.count)]
+
+            # Store each band
+            for idx, name in enumerate(names):
+                bands[name] = data[idx]
+                band_names.append(name)
+                print(f"    - {name}: shape {data[idx].shape}")
+
+    # Stack in expected order (matching training)
+    print(f"\nStacking bands in training order: {expected_bands}")
+    stacked_list = []
+    for band_name in expected_bands:
+        if band_name not in bands:
+            raise ValueError(f"Expected band '{band_name}' not found in loaded rasters")
+        stacked_list.append(bands[band_name])
+
+    stacked_data = np.stack(stacked_list, axis=0)
+
+    return stacked_data, profile, expected_bands
+
+
+# In[18]:
+
+
+def normalize_stack(data, band_names, normalization, verbose=True):
+    """
+    Normalize a raster stack using training normalization parameters.
+    Handles NaN/NoData values by tracking them separately.
+
+    Args:
+        data: numpy array (bands, height, width)
+        band_names: List of band names
+        normalization: Dict of normalization parameters from metadata
+        verbose: Print NoData count and per-band ranges
+
+    Returns:
+        normalized: Normalized data array (float32) with NaN filled to 0
+        nodata_mask: Boolean mask where True = NoData (any band has NaN)
+    """
+    normalized = data.astype(np.float32).copy()
+
+    # Create NoData mask (True where ANY band has NaN)
+    nodata_mask = np.any(np.isnan(data), axis=0)
+    if verbose:
+        nan_count = np.sum(nodata_mask)
+        total_pixels = nodata_mask.size
+        print(f"NoData pixels: {nan_count:,} ({100*nan_count/total_pixels:.1f}%)\n")
+
+    for i, band_name in enumerate(band_names):
+        norm_params = normalization[band_name]
+
+        if norm_params["type"] == "divide":
+            normalized[i] = normalized[i] / norm_params["value"]
+        elif norm_params["type"] == "shift_scale":
+            normalized[i] = (normalized[i] + norm_params["shift"]) / norm_params["scale"]
+        elif norm_params["type"] == "minmax":
+            min_val = norm_params["min"]
+            max_val = norm_params["max"]
+            if max_val - min_val > 0:
+                normalized[i] = (normalized[i] - min_val) / (max_val - min_val)
+            else:
+                normalized[i] = 0.0
+
+        # Report stats ignoring NaN
+        if verbose:
+            band_min = np.nanmin(normalized[i])
+            band_max = np.nanmax(normalized[i])
+            print(f"  {band_name}: [{band_min:.3f}, {band_max:.3f}]")
+
+    # Fill NaN with 0 for model input (mask will track these locations)
+    normalized = np.nan_to_num(normalized, nan=0.0)
+
+    return normalized, nodata_mask
+
+
+# In[ ]:
+
+
+INFERENCE_BACKENDS = ("eager", "folded", "torchscript", "compile", "onnx")
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session with the model call interface used by predict_padded.
+
+    Takes a torch batch on any device, runs it on the CPU execution provider,
+    and returns the logits as a torch tensor on the input's device.
+    """
+
+    def __init__(self, model, example_input, onnx_path, num_threads=None):
+        """
+        Args:
+            model: Model to export (typically BatchNorm-folded, in eval mode)
+            example_input: Example batch (B, bands, patch_size, patch_size); batch size stays dynamic
+            onnx_path: Path to write the exported .onnx file
+            num_threads: ONNX Runtime intra-op threads (None = torch.get_num_threads())
+        """
+        import onnxruntime as ort  # Optional dependency, only needed for this backend
+
+        onnx_path = Path(onnx_path)
+        onnx_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.onnx.export(
+            model.cpu(), (example_input.cpu(),), str(onnx_path),
+            input_names=["input"], output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        )
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        self.onnx_path = onnx_path
+
+    def eval(self):
+        return self
+
+    def __call__(self, batch_tensor):
+        logits = self.session.run(None, {"input": batch_tensor.cpu().numpy()})[0]
+        return torch.from_numpy(logits).to(batch_tensor.device)
+
+
+def build_inference_backend(model, backend, device, patch_size, onnx_path="Models/unet_folded.onnx"):
+    """
+    Prepare a trained model for prediction with the given backend.
+
+    Every backend except "eager" first folds BatchNorm into the preceding convs.
+
+    Args:
+        model: Trained UNet in eval mode
+        backend: One of INFERENCE_BACKENDS
+            "eager": the model as is
+            "folded": BatchNorm folded, eager PyTorch
+            "torchscript": folded, traced, frozen, and optimized for inference
+            "compile": folded and compiled with torch.compile
+            "onnx": folded, exported to ONNX, and run with ONNX Runtime (CPU)
+        device: PyTorch device
+        patch_size: Patch size the model will be called with (used for tracing/export)
+        onnx_path: Where to write the .onnx file for the "onnx" backend
+
+    Returns:
+        Callable model: eval() and model(batch) -> logits, like the eager model
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {INFERENCE_BACKENDS}")
+    if backend == "eager":
+        return model
+
+    folded = fold_batchnorm(model).to(device)
+    if backend == "folded":
+        return folded
+
+    in_channels = next(m for m in folded.modules() if isinstance(m, torch.nn.Conv2d)).in_channels
+    example_input = torch.zeros(2, in_channels, patch_size, patch_size, device=device)
+
+    if backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(folded, example_input)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    if backend == "compile":
+        return torch.compile(folded)
+    return OnnxModel(folded, example_input, onnx_path)
+
+
+# In[19]:
+
+
+def create_gaussian_weight_map(size, sigma_fraction=0.3):
+    """
+    Create a 2D Gaussian weight map - high in center, tapering to edges.
+
+    Args:
+        size: Size of the square weight map
+        sigma_fraction: Sigma as fraction of size (larger = flatter, smaller = more peaked)
+
+    Returns:
+        weight_map: 2D numpy array of shape (size, size)
+    """
+    center = size / 2
+    sigma = size * sigma_fraction
+
+    y, x = np.ogrid[:size, :size]
+    # Offset by 0.5 to center the Gaussian on pixel centers
+    dist_sq = (x - center + 0.5)**2 + (y - center + 0.5)**2
+    weight_map = np.exp(-dist_sq / (2 * sigma**2))
+
+    return weight_map.astype(np.float32)
+
+
+def predict_padded(model, padded, height, width, patch_size, crop_margin, batch_size, device, num_classes,
+                   verbose=True, timer=None):
+    """
+    Run overlapping center-crop prediction on an already padded array.
+
+    Pixel (r, c) of the output corresponds to padded[:, r + crop_margin, c + crop_margin],
+    and the padded array must extend far enough past (height, width) for the last
+    row/column of patches (see predict_raster for the padding rule).
+
+    Blending happens on the device: the Gaussian-weighted center crops of each batch
+    are scatter-added into a flat accumulator with index_add_, and the blended
+    probabilities are copied back to the host once at the end.
+
+    Args:
+        model: Trained PyTorch model
+        padded: Padded, normalized input array (bands, padded_h, padded_w)
+        height, width: Size of the output region
+        patch_size: Size of prediction patches (e.g., 128)
+        crop_margin: Pixels to discard from each edge (e.g., 32 means use center 64x64)
+        batch_size: Number of patches per batch
+        device: PyTorch device
+        num_classes: Number of output classes
+        verbose: Print grid size and show a progress bar
+        timer: Optional StageTimer for the gather, h2d, forward, blend, and d2h stages
+
+    Returns:
+        probabilities: Array of class probabilities (num_classes, height, width)
+    """
+    timer = timer or NULL_TIMER
+    _, padded_h, padded_w = padded.shape
+    center_size = patch_size - 2 * crop_margin
+    stride = center_size // 2
+
+    # Grid positions - step by stride for overlapping coverage
+    row_positions = np.arange(0, padded_h - patch_size + 1, stride)
+    col_positions = np.arange(0, padded_w - patch_size + 1, stride)
+    grid_rows, grid_cols = np.meshgrid(
+        np.arange(len(row_positions)), np.arange(len(col_positions)), indexing="ij"
+    )
+    grid_rows, grid_cols = grid_rows.ravel(), grid_cols.ravel()
+    total_patches = len(grid_rows)
+
+    if verbose:
+        print(f"Grid: {len(row_positions)} rows x {len(col_positions)} cols = {total_patches} patches")
+
+    # Strided view of every patch; a batch is gathered with one fancy-index copy
+    patch_view = np.lib.stride_tricks.sliding_window_view(
+        padded, (patch_size, patch_size), axis=(1, 2)
+    )[:, ::stride, ::stride]
+
+    # Accumulator covers every center crop and is cropped to (height, width) at the end.
+    # The center of the patch at padded (row, col) starts at (row, col) in output space.
+    acc_h = int(row_positions[-1]) + center_size
+    acc_w = int(col_positions[-1]) + center_size
+    prob_sum = torch.zeros((num_classes, acc_h * acc_w), dtype=torch.float32, device=device)
+    weight_sum = torch.zeros(acc_h * acc_w, dtype=torch.float32, device=device)
+
+    # Create Gaussian weight map for the center region
+    weight_map = torch.from_numpy(create_gaussian_weight_map(center_size, sigma_fraction=0.3)).to(device)
+
+    # Flat accumulator offsets of each patch's center crop, relative to its origin
+    center_idx = torch.arange(center_size, device=device)
+    crop_offsets = (center_idx[:, None] * acc_w + center_idx[None, :]).ravel()
+    origins = torch.from_numpy(row_positions[grid_rows] * acc_w + col_positions[grid_cols]).to(device)
+
+    # Process in batches
+    model.eval()
+    with torch.no_grad():
+        for batch_start in tqdm(range(0, total_patches, batch_size), desc="Predicting", disable=not verbose):
+            batch_end = min(batch_start + batch_size, total_patches)
+
+            # Gather patches (bands, B, P, P) -> (B, bands, P, P)
+            with timer.stage("gather"):
+                patches = patch_view[:, grid_rows[batch_start:batch_end], grid_cols[batch_start:batch_end]]
+                batch_tensor = torch.from_numpy(np.ascontiguousarray(patches.transpose(1, 0, 2, 3)))
+            with timer.stage("h2d"):
+                batch_tensor = batch_tensor.to(device)
+            timer.count("patches", batch_end - batch_start)
+
+            # Predict and keep the Gaussian-weighted center of each patch
+            with timer.stage("forward"):
+                outputs = model(batch_tensor)
+
+            with timer.stage("blend"):
+                probs = torch.softmax(outputs, dim=1)
+                center_probs = probs[:, :, crop_margin:crop_margin+center_size, crop_margin:crop_margin+center_size]
+                center_probs = center_probs * weight_map
+
+                # Scatter-add all center crops of the batch into the accumulator
+                index = (origins[batch_start:batch_end, None] + crop_offsets[None, :]).ravel()
+                prob_sum.index_add_(1, index, center_probs.permute(1, 0, 2, 3).reshape(num_classes, -1))
+                weight_sum.index_add_(0, index, weight_map.ravel().repeat(batch_end - batch_start))
+
+    # Normalize by accumulated weights and copy back to the host once
+    with timer.stage("d2h"):
+        probabilities = prob_sum / torch.clamp(weight_sum, min=1e-8)  # Avoid division by zero
+        probabilities = probabilities.view(num_classes, acc_h, acc_w)[:, :height, :width]
+        return probabilities.cpu().numpy()
+
+
+def predict_raster(model, data, patch_size, crop_margin, batch_size, device, num_classes, backend="eager",
+                   timer=None):
+    """
+    Predict on a full raster using overlapping center-crop with Gaussian blending.
+
+    Uses center portion of each patch prediction to avoid edge artifacts,
+    with overlapping centers blended using Gaussian weights for smooth transitions.
+
+    Args:
+        model: Trained PyTorch model
+        data: Normalized input array (bands, height, width)
+        patch_size: Size of prediction patches (e.g., 128)
+        crop_margin: Pixels to discard from each edge (e.g., 32 means use center 64x64)
+        batch_size: Number of patches per batch
+        device: PyTorch device
+        num_classes: Number of output classes
+        backend: Inference backend (see build_inference_backend)
+        timer: Optional StageTimer (NYS_00_profiling) for per-stage timings
+
+    Returns:
+        predictions: Array of predicted class labels (height, width)
+        probabilities: Array of class probabilities (num_classes, height, width)
+    """
+    timer = timer or NULL_TIMER
+    _, height, width = data.shape
+    center_size = patch_size - 2 * crop_margin
+
+    # Overlap centers by 50% - step by half the center size
+    stride = center_size // 2
+
+    # Pad input with reflection to ensure full coverage of all pixels
+    # Need enough padding so edge pixels can be in the center of a patch
+    pad_h = crop_margin + (stride - (height % stride)) % stride + center_size
+    pad_w = crop_margin + (stride - (width % stride)) % stride + center_size
+
+    with timer.stage("pad"):
+        padded = np.pad(
+            data, 
+            ((0, 0), (crop_margin, pad_h), (crop_margin, pad_w)), 
+            mode='reflect'
+        )
+    _, padded_h, padded_w = padded.shape
+
+    print(f"Raster size: {height} x {width}")
+    print(f"Padded size: {padded_h} x {padded_w}")
+    print(f"Patch size: {patch_size}, Center size: {center_size}, Stride: {stride}")
+    print(f"Crop margin: {crop_margin}, Overlap: {center_size - stride} pixels (50%)")
+    print(f"Backend: {backend}")
+
+    model = build_inference_backend(model, backend, device, patch_size)
+
+    probabilities = predict_padded(
+        model, padded, height, width, patch_size, crop_margin,
+        batch_size, device, num_classes, timer=timer
+    )
+
+    # Get final predictions
+    with timer.stage("argmax"):
+        predictions = np.argmax(probabilities, axis=0).astype(np.uint8)
+
+    return predictions, probabilities
+
+
+# In[ ]:
+
+
+def reflect_indices(start, stop, size):
+    """
+    Map pixel indices in [start, stop) onto [0, size) using reflect padding.
+
+    Matches np.pad(..., mode='reflect'), so windows that hang over the raster
+    edge get the same values as a padded full-raster array.
+    """
+    idx = np.arange(start, stop)
+    if size == 1:
+        return np.zeros_like(idx)
+    period = 2 * (size - 1)
+    idx = np.abs(idx) % period
+    return np.where(idx >= size, period - idx, idx)
+
+
+class RasterStack:
+    """
+    Windowed reader over the input rasters of one HUC, in training band order.
+
+    Resolves band names the same way as load_and_stack_rasters, but only reads
+    the windows that are requested, through the tile cache so halos shared by
+    neighbouring blocks are read once. Each raster is opened once for its
+    metadata and closed again; reads open it by path through the tile cache,
+    which keeps a bounded number of datasets open, so a stack (or a mosaic of
+    many stacks) holds no file handles of its own.
+    """
+
+    def __init__(self, raster_inputs, huc_id, expected_bands, tile_cache=None):
+        """
+        Args:
+            raster_inputs: List of raster configuration dicts
+            huc_id: HUC ID to substitute in path patterns
+            expected_bands: List of band names in expected order (from metadata)
+            tile_cache: TileCache to read through (None = the process-wide get_tile_cache())
+        """
+        self.band_names = list(expected_bands)
+        self.tile_cache = tile_cache
+        self.paths = []
+        self.profile = None
+        band_lookup = {}
+
+        for raster_cfg in raster_inputs:
+            pattern = raster_cfg["path_pattern"].replace("{huc}", huc_id)
+            matches = list(Path(".").glob(pattern))
+
+            if not matches:
+                raise FileNotFoundError(f"No files found for {raster_cfg['name']}: {pattern}")
+
+            with rasterio.open(matches[0]) as src:
+                self.paths.append(str(matches[0]))
+
+                if self.profile is None:
+                    self.profile = src.profile.copy()
+                    self.height, self.width = src.height, src.width
+                    self.transform = src.transform
+                elif (src.height, src.width) != (self.height, self.width):
+                    raise ValueError(
+                        f"Raster {matches[0].name} is {src.height} x {src.width}, "
+                        f"expected {self.height} x {self.width}"
+                    )
+
+                # Determine band names
+                if raster_cfg["bands"] is not None:
+                    names = raster_cfg["bands"]
+                elif src.descriptions and all(src.descriptions):
+                    names = list(src.descriptions)
+                else:
+                    names = [f"{raster_cfg['name']}_{j+1}" for j in range(src.count)]
+
+            for idx, name in enumerate(names):
+                band_lookup[name] = (len(self.paths) - 1, idx + 1)
+
+        # For each source, which 1-based bands to read and where they go in the stack
+        self.reads = {}
+        for out_idx, band_name in enumerate(self.band_names):
+            if band_name not in band_lookup:
+                raise ValueError(f"Expected band '{band_name}' not found in loaded rasters")
+            src_idx, band_idx = band_lookup[band_name]
+            self.reads.setdefault(src_idx, ([], []))
+            self.reads[src_idx][0].append(band_idx)
+            self.reads[src_idx][1].append(out_idx)
+
+    def read(self, row_start, row_stop, col_start, col_stop):
+        """
+        Read rows [row_start, row_stop) and cols [col_start, col_stop) of the stack.
+
+        Indices outside the raster are filled by reflection, as in predict_raster.
+
+        Returns:
+            data: float32 array (bands, row_stop - row_start, col_stop - col_start)
+        """
+        rows = reflect_indices(row_start, row_stop, self.height)
+        cols = reflect_indices(col_start, col_stop, self.width)
+        r0, c0 = rows.min(), cols.min()
+        window = Window(c0, r0, cols.max() - c0 + 1, rows.max() - r0 + 1)
+
+        tile_cache = self.tile_cache or get_tile_cache()
+        data = np.empty((len(self.band_names), len(rows), len(cols)), dtype=np.float32)
+        for src_idx, (band_indexes, out_indexes) in self.reads.items():
+            block = tile_cache.read(self.paths[src_idx], band_indexes, window)
+            data[out_indexes] = block[:, rows - r0][:, :, cols - c0]
+        return data
+
+    def close(self):
+        """Nothing to release (the tile cache owns the open datasets); kept so stacks are interchangeable."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def predict_block(model, stack, normalization, r0, c0, r1, c1,
+                  patch_size, crop_margin, batch_size, device, num_classes, timer=None):
+    """
+    Predict the core block [r0, r1) x [c0, c1) of a stack.
+
+    The block is predicted from a window that includes a halo, so every pixel
+    receives the same overlapping center crops (and the same reflect padding at
+    the stack edges) as in predict_raster over the whole stack. An optional
+    StageTimer records the read, normalize, and predict_padded stages.
+
+    Returns:
+        core_preds: uint8 class array for the block (NoData = 255)
+        core_probs: float32 probabilities (num_classes, rows, cols), NaN at NoData
+    """
+    timer = timer or NULL_TIMER
+    center_size = patch_size - 2 * crop_margin
+    stride = center_size // 2
+
+    # Centers that start up to (center_size - stride) pixels before a block still overlap it
+    lead = center_size - stride
+
+    # Sub-problem covering the block plus its lead-in, padded like predict_raster
+    sub_r0 = max(0, r0 - lead)
+    sub_c0 = max(0, c0 - lead)
+    sub_h = r1 - sub_r0
+    sub_w = c1 - sub_c0
+    pad_h = crop_margin + (stride - (sub_h % stride)) % stride + center_size
+    pad_w = crop_margin + (stride - (sub_w % stride)) % stride + center_size
+
+    with timer.stage("read"):
+        window_data = stack.read(
+            sub_r0 - crop_margin, r1 + pad_h,
+            sub_c0 - crop_margin, c1 + pad_w,
+        )
+    with timer.stage("normalize"):
+        normalized, nodata_mask = normalize_stack(
+            window_data, stack.band_names, normalization, verbose=False
+        )
+    probs = predict_padded(
+        model, normalized, sub_h, sub_w, patch_size, crop_margin,
+        batch_size, device, num_classes, verbose=False, timer=timer
+    )
+
+    # Keep only the core block
+    core_r = slice(r0 - sub_r0, r0 - sub_r0 + (r1 - r0))
+    core_c = slice(c0 - sub_c0, c0 - sub_c0 + (c1 - c0))
+    core_probs = probs[:, core_r, core_c]
+    core_nodata = nodata_mask[crop_margin:, crop_margin:][core_r, core_c]
+
+    core_preds = np.argmax(core_probs, axis=0).astype(np.uint8)
+    core_preds[core_nodata] = 255
+    core_probs[:, core_nodata] = np.nan
+
+    return core_preds, core_probs
+
+
+def tiled_output_profiles(profile, num_classes):
+    """Tiled GeoTIFF profiles for the class (uint8) and probability (float32) outputs."""
+    out_profile = profile.copy()
+    out_profile.update(
+        driver="GTiff",
+        dtype=rasterio.uint8,
+        count=1,
+        compress='lzw',
+        nodata=255,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        BIGTIFF="IF_SAFER",
+    )
+    prob_profile = out_profile.copy()
+    prob_profile.update(dtype=rasterio.float32, count=num_classes, nodata=np.nan)
+    return out_profile, prob_profile
+
+
+def predict_raster_windowed(model, stack, normalization, output_path, prob_path,
+                            patch_size, crop_margin, batch_size, device,
+                            num_classes, class_names, block_size=1024, verbose=True, backend="eager",
+                            timer=None):
+    """
+    Predict a raster block by block and write results straight to tiled GeoTIFFs.
+
+    Each core block is predicted from a window that includes a halo, so every
+    output pixel receives the same overlapping center crops (and the same
+    reflect padding at the raster edges) as in predict_raster.
+
+    Args:
+        model: Trained PyTorch model
+        stack: RasterStack to read input windows from
+        normalization: Dict of normalization parameters from metadata
+        output_path: Path for the predicted class GeoTIFF (uint8, NoData = 255)
+        prob_path: Path for the probability GeoTIFF, or None to skip it
+        patch_size, crop_margin, batch_size: Prediction parameters
+        device: PyTorch device
+        num_classes: Number of output classes
+        class_names: Class names for probability band descriptions
+        block_size: Core block size in pixels (multiple of the patch stride)
+        verbose: Print progress (disable when several rasters are predicted concurrently)
+        backend: Inference backend (see build_inference_backend)
+        timer: Optional StageTimer (NYS_00_profiling) for per-stage timings
+
+    Returns:
+        class_counts: Array of predicted pixel counts per class (excluding NoData)
+    """
+    timer = timer or NULL_TIMER
+    height, width = stack.height, stack.width
+    center_size = patch_size - 2 * crop_margin
+    stride = center_size // 2
+    if block_size % stride != 0:
+        raise ValueError(f"block_size ({block_size}) must be a multiple of the stride ({stride})")
+
+    out_profile, prob_profile = tiled_output_profiles(stack.profile, num_classes)
+    model = build_inference_backend(model, backend, device, patch_size)
+
+    blocks = [(r, c) for r in range(0, height, block_size) for c in range(0, width, block_size)]
+    if verbose:
+        print(f"Raster size: {height} x {width}")
+        print(f"Block size: {block_size} (+ halo), {len(blocks)} blocks")
+
+    class_counts = np.zeros(num_classes, dtype=np.int64)
+    prob_dst = rasterio.open(prob_path, 'w', **prob_profile) if prob_path is not None else None
+
+    try:
+        with rasterio.open(output_path, 'w', **out_profile) as dst:
+            dst.set_band_description(1, "wetland_class")
+            if prob_dst is not None:
+                for i, class_name in enumerate(class_names):
+                    prob_dst.set_band_description(i + 1, f"prob_{class_name}")
+
+            for r0, c0 in tqdm(blocks, desc="Predicting blocks", disable=not verbose):
+                r1 = min(r0 + block_size, height)
+                c1 = min(c0 + block_size, width)
+
+                core_preds, core_probs = predict_block(
+                    model, stack, normalization, r0, c0, r1, c1,
+                    patch_size, crop_margin, batch_size, device, num_classes, timer=timer
+                )
+                timer.count("blocks")
+                class_counts += np.bincount(core_preds.ravel(), minlength=256)[:num_classes]
+
+                window = Window(c0, r0, c1 - c0, r1 - r0)
+                with timer.stage("write"):
+                    dst.write(core_preds, 1, window=window)
+                    if prob_dst is not None:
+                        prob_dst.write(core_probs, window=window)
+    finally:
+        if prob_dst is not None:
+            prob_dst.close()
+
+    if verbose:
+        print(f"Saved predictions to: {output_path}")
+        if prob_path is not None:
+            print(f"Saved probabilities to: {prob_path}")
+
+    return class_counts
+
+
+# In[ ]:
+
+
+class MosaicStack:
+    """
+    Windowed reader over several HUCs' rasters as one virtual extent.
+
+    Every HUC must share the CRS and pixel size of the first one and sit on the
+    same pixel grid. Pixels covered by more than one HUC take the first HUC's
+    value; pixels covered by none are NaN (NoData). Outside the mosaic, reads
+    reflect like RasterStack.
+    """
+
+    def __init__(self, raster_inputs, huc_ids, expected_bands):
+        """
+        Args:
+            raster_inputs: List of raster configuration dicts
+            huc_ids: HUC IDs to include in the mosaic
+            expected_bands: List of band names in expected order (from metadata)
+        """
+        self.band_names = list(expected_bands)
+        self.stacks = []
+        offsets = []
+
+        try:
+            for huc_id in huc_ids:
+                stack = RasterStack(raster_inputs, huc_id, expected_bands)
+                self.stacks.append(stack)
+                base = self.stacks[0]
+
+                if stack.profile["crs"] != base.profile["crs"]:
+                    raise ValueError(f"HUC {huc_id} CRS {stack.profile['crs']} != {base.profile['crs']}")
+                if (stack.transform.a, stack.transform.e) != (base.transform.a, base.transform.e):
+                    raise ValueError(f"HUC {huc_id} pixel size differs from HUC {huc_ids[0]}")
+
+                # Pixel offset of this HUC's origin on the first HUC's grid
+                col_off = (stack.transform.c - base.transform.c) / base.transform.a
+                row_off = (stack.transform.f - base.transform.f) / base.transform.e
+                if not (np.isclose(col_off, round(col_off)) and np.isclose(row_off, round(row_off))):
+                    raise ValueError(f"HUC {huc_id} is not aligned to the pixel grid of HUC {huc_ids[0]}")
+                offsets.append((int(round(row_off)), int(round(col_off))))
+        except Exception:
+            self.close()
+            raise
+
+        min_row = min(r for r, _ in offsets)
+        min_col = min(c for _, c in offsets)
+        self.offsets = [(r - min_row, c - min_col) for r, c in offsets]
+        self.height = max(r + s.height for (r, _), s in zip(self.offsets, self.stacks))
+        self.width = max(c + s.width for (_, c), s in zip(self.offsets, self.stacks))
+        self.transform = self.stacks[0].transform * Affine.translation(min_col, min_row)
+
+        self.profile = self.stacks[0].profile.copy()
+        self.profile.update(height=self.height, width=self.width, transform=self.transform)
+
+    def _read_inside(self, row_start, row_stop, col_start, col_stop):
+        """Read an in-bounds window, stitched from every HUC it overlaps."""
+        data = np.full(
+            (len(self.band_names), row_stop - row_start, col_stop - col_start), np.nan, dtype=np.float32
+        )
+        filled = np.zeros(data.shape[1:], dtype=bool)
+
+        for (row_off, col_off), stack in zip(self.offsets, self.stacks):
+            # Intersection of the request with this HUC, in mosaic coordinates
+            r0, r1 = max(row_start, row_off), min(row_stop, row_off + stack.height)
+            c0, c1 = max(col_start, col_off), min(col_stop, col_off + stack.width)
+            if r0 >= r1 or c0 >= c1:
+                continue
+
+            block = stack.read(r0 - row_off, r1 - row_off, c0 - col_off, c1 - col_off)
+            target = (slice(r0 - row_start, r1 - row_start), slice(c0 - col_start, c1 - col_start))
+
+            # First HUC wins where HUCs overlap; NaN pixels can still be filled by later HUCs
+            take = ~filled[target] & ~np.isnan(block).any(axis=0)
+            data[(slice(None),) + target][:, take] = block[:, take]
+            filled[target] |= take
+
+        return data
+
+    def read(self, row_start, row_stop, col_start, col_stop):
+        """
+        Read rows [row_start, row_stop) and cols [col_start, col_stop) of the mosaic.
+
+        Indices outside the mosaic are filled by reflection, as in predict_raster.
+
+        Returns:
+            data: float32 array (bands, row_stop - row_start, col_stop - col_start)
+        """
+        rows = reflect_indices(row_start, row_stop, self.height)
+        cols = reflect_indices(col_start, col_stop, self.width)
+        r0, c0 = rows.min(), cols.min()
+        data = self._read_inside(r0, rows.max() + 1, c0, cols.max() + 1)
+        return data[:, rows - r0][:, :, cols - c0]
+
+    def close(self):
+        for stack in self.stacks:
+            stack.close()
+        self.stacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _init_mosaic_worker(raster_inputs, huc_ids, expected_bands, predict_args, torch_threads):
+    """
+    Set up a worker: its own MosaicStack (rasterio handles are not fork-safe),
+    the prediction arguments, and a share of the torch threads.
+    """
+    global _worker_stack, _worker_args
+    torch.set_num_threads(torch_threads)
+    _worker_stack = MosaicStack(raster_inputs, huc_ids, expected_bands)
+    _worker_args = predict_args
+
+
+def _predict_block_row(r0):
+    """Predict every block in the block row starting at r0 of the worker's mosaic."""
+    stack, args = _worker_stack, _worker_args
+    block_size = args["block_size"]
+    r1 = min(r0 + block_size, stack.height)
+    row_results = []
+    for c0 in range(0, stack.width, block_size):
+        c1 = min(c0 + block_size, stack.width)
+        core_preds, core_probs = predict_block(
+            args["model"], stack, args["normalization"], r0, c0, r1, c1,
+            args["patch_size"], args["crop_margin"], args["batch_size"],
+            args["device"], args["num_classes"]
+        )
+        row_results.append((c0, core_preds, core_probs))
+    return r0, row_results
+
+
+def predict_mosaic(model, raster_inputs, huc_ids, normalization, band_names, output_path, prob_path,
+                   patch_size, crop_margin, batch_size, device, num_classes, class_names,
+                   block_size=1024, n_workers=1, backend="eager"):
+    """
+    Predict several HUCs as one seamless mosaic and write a single tiled GeoTIFF.
+
+    Args:
+        model: Trained PyTorch model
+        raster_inputs: Raster configuration
+        huc_ids: HUC IDs covered by the mosaic
+        normalization: Dict of normalization parameters from metadata
+        band_names: Band names in training order
+        output_path: Path for the predicted class GeoTIFF (uint8, NoData = 255)
+        prob_path: Path for the probability GeoTIFF, or None to skip it
+        patch_size, crop_margin, batch_size: Prediction parameters
+        device: PyTorch device
+        num_classes: Number of output classes
+        class_names: Class names for probability band descriptions
+        block_size: Core block size in pixels (multiple of the patch stride)
+        n_workers: Worker processes, each predicting whole block rows (1 = in-process).
+            Workers are forked with a copy of the model, so use them on CPU.
+        backend: Inference backend (see build_inference_backend), built once before forking
+
+    Returns:
+        class_counts: Array of predicted pixel counts per class (excluding NoData)
+    """
+    stride = (patch_size - 2 * crop_margin) // 2
+    if block_size % stride != 0:
+        raise ValueError(f"block_size ({block_size}) must be a multiple of the stride ({stride})")
+    if n_workers > 1 and device.type != "cpu":
+        raise ValueError("n_workers > 1 forks the model into worker processes and requires device='cpu'")
+
+    with MosaicStack(raster_inputs, huc_ids, band_names) as mosaic:
+        height, width = mosaic.height, mosaic.width
+        out_profile, prob_profile = tiled_output_profiles(mosaic.profile, num_classes)
+
+    row_starts = list(range(0, height, block_size))
+    print(f"Mosaic of {len(huc_ids)} HUCs: {height} x {width}")
+    print(f"Block size: {block_size} (+ halo), {len(row_starts)} block rows, {n_workers} worker(s)")
+
+    # Passed to workers through the fork, so the model is never pickled
+    predict_args = {
+        "model": build_inference_backend(model, backend, device, patch_size), "normalization": normalization, "patch_size": patch_size,
+        "crop_margin": crop_margin, "batch_size": batch_size, "device": device,
+        "num_classes": num_classes, "block_size": block_size,
+    }
+    init_args = (raster_inputs, huc_ids, band_names, predict_args)
+
+    class_counts = np.zeros(num_classes, dtype=np.int64)
+    prob_dst = rasterio.open(prob_path, 'w', **prob_profile) if prob_path is not None else None
+
+    try:
+        with rasterio.open(output_path, 'w', **out_profile) as dst:
+            dst.set_band_description(1, "wetland_class")
+            if prob_dst is not None:
+                for i, class_name in enumerate(class_names):
+                    prob_dst.set_band_description(i + 1, f"prob_{class_name}")
+
+            if n_workers > 1:
+                # fork so workers inherit the model and notebook functions; the parent only writes
+                torch_threads = max(1, torch.get_num_threads() // n_workers)
+                pool = ProcessPoolExecutor(
+                    max_workers=n_workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_mosaic_worker,
+                    initargs=init_args + (torch_threads,),
+                )
+                row_results = pool.map(_predict_block_row, row_starts)
+            else:
+                pool = None
+                _init_mosaic_worker(*init_args, torch.get_num_threads())
+                row_results = map(_predict_block_row, row_starts)
+
+            try:
+                for r0, blocks in tqdm(row_results, total=len(row_starts), desc="Predicting block rows"):
+                    for c0, core_preds, core_probs in blocks:
+                        window = Window(c0, r0, core_preds.shape[1], core_preds.shape[0])
+                        dst.write(core_preds, 1, window=window)
+                        if prob_dst is not None:
+                            prob_dst.write(core_probs, window=window)
+                        class_counts += np.bincount(core_preds.ravel(), minlength=256)[:num_classes]
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+                else:
+                    _worker_stack.close()
+    finally:
+        if prob_dst is not None:
+            prob_dst.close()
+
+    print(f"Saved mosaic predictions to: {output_path}")
+    if prob_path is not None:
+        print(f"Saved mosaic probabilities to: {prob_path}")
+
+    return class_counts
+
+
+# In[ ]:
+
+
+def predict_huc_batch(huc_list, model, raster_inputs, metadata, 
+                      patch_size, crop_margin, batch_size, device, output_dir, backend="eager"):
+    """
+    Predict wetland classes for multiple HUCs.
+
+    Args:
+        huc_list: List of HUC IDs to predict
+        model: Trained model
+        raster_inputs: Raster configuration
+        metadata: Training metadata
+        patch_size, crop_margin, batch_size: Prediction parameters
+        device: PyTorch device
+        output_dir: Output directory for predictions
+        backend: Inference backend (see build_inference_backend), built once for all HUCs
+
+    Returns:
+        results: Dict with HUC IDs as keys, output paths as values
+    """
+    results = {}
+    model = build_inference_backend(model, backend, device, patch_size)
+
+    for huc_id in huc_list:
+        print(f"\n{'='*60}")
+        print(f"Processing HUC: {huc_id}")
+        print(f"{'='*60}")
+
+        try:
+            # Load rasters
+            input_data, profile, _ = load_and_stack_rasters(
+                raster_inputs, huc_id, metadata["band_names"]
+            )
+
+            # Normalize (returns data and nodata_mask)
+            normalized, nodata_mask = normalize_stack(
+                input_data, metadata["band_names"], metadata["normalization"]
+            )
+
+            # Predict
+            predictions, probabilities = predict_raster(
+                model, normalized, patch_size, crop_margin, 
+                batch_size, device, metadata["num_classes"]
+            )
+
+            # Apply NoData mask
+            predictions[nodata_mask] = 255
+
+            # Save
+            output_path = output_dir / f"prediction_{huc_id}.tif"
+            out_profile = profile.copy()
+            out_profile.update(dtype=rasterio.uint8, count=1, compress='lzw', nodata=255)
+
+            with rasterio.open(output_path, 'w', **out_profile) as dst:
+                dst.write(predictions, 1)
+
+            results[huc_id] = str(output_path)
+            print(f"Saved: {output_path}")
+
+        except Exception as e:
+            print(f"ERROR processing {huc_id}: {e}")
+            results[huc_id] = f"ERROR: {e}"
+
+    return results
+
+# Example: predict all HUCs in cluster
+# Uncomment to run batch prediction:
+
+# all_hucs = ["041402011002", "041402011004", "041402011005"]  # Add HUC IDs
+# results = predict_huc_batch(
+#     all_hucs, model, raster_inputs, metadata,
+#     patch_size, crop_margin, batch_size, device, output_dir
+# )
+# print("\nBatch prediction complete!")
+# for huc, path in results.items():
+#     print(f"  {huc}: {path}")
+
+
+# In[ ]:
+
+
+def benchmark_backends(model, backends, in_channels, patch_size, batch_size, device,
+                       n_batches=20, warmup=3, atol=1e-3):
+    """
+    Time each inference backend on random batches and compare it with the eager model.
+
+    Args:
+        model: Trained UNet in eval mode
+        backends: Backend names to benchmark (see INFERENCE_BACKENDS)
+        in_channels: Number of input bands
+        patch_size: Patch size
+        batch_size: Patches per batch
+        device: PyTorch device
+        n_batches: Timed batches per backend
+        warmup: Untimed batches first (torch.compile compiles here)
+        atol: Maximum absolute logit difference from eager to count as a match
+
+    Returns:
+        results: List of dicts with backend, build_seconds, patches_per_sec,
+            max_abs_diff, and matches (or error if the backend failed to build or run)
+    """
+    generator = torch.Generator().manual_seed(0)
+    batch = torch.randn(batch_size, in_channels, patch_size, patch_size, generator=generator).to(device)
+    with torch.no_grad():
+        reference = model(batch)
+
+    results = []
+    for backend in backends:
+        try:
+            start = time.perf_counter()
+            backend_model = build_inference_backend(model, backend, device, patch_size)
+            build_seconds = time.perf_counter() - start
+
+            with torch.no_grad():
+                for _ in range(warmup):
+                    outputs = backend_model(batch)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(n_batches):
+                    outputs = backend_model(batch)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start
+        except Exception as e:
+            results.append({"backend": backend, "error": f"{type(e).__name__}: {e}"})
+            continue
+
+        max_abs_diff = (outputs.float() - reference).abs().max().item()
+        results.append({
+            "backend": backend,
+            "build_seconds": build_seconds,
+            "patches_per_sec": n_batches * batch_size / elapsed,
+            "max_abs_diff": max_abs_diff,
+            "matches": max_abs_diff <= atol,
+        })
+    return results
+
+
+# In[ ]:
+
+
+
+
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+import rasterio
+from rasterio import Affine
+import torch
+
+
+# In[ ]:
+
+
+workdir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/")
+os.chdir(workdir)
+print(f"Current working directory: {Path.cwd()}")
+
+# === CONFIGURATION ===
+# Model and metadata settings (must match training)
+data_dir = Path("Data/Patches_v2")
+cluster_id = 208
+huc_id = None  # None to merge all HUCs in cluster
+model_path = workdir / "Models/best_model.pth"
+
+# Prediction settings (same as NYS_08_predict_raster.ipynb)
+patch_size = 128
+crop_margin = 32
+batch_size = 16  # Patches per model call, filled from every running job
+block_size = 1024  # Core block size in pixels (multiple of the patch stride)
+backend = "eager"  # eager, folded, torchscript, compile, or onnx (see NYS_08 "Inference Backends")
+write_probabilities = False  # Also write a probability GeoTIFF per job by default
+
+# Server settings
+host = "127.0.0.1"
+port = 8765
+max_wait_ms = 10.0  # How long the batcher waits for more patches before running a partial batch
+job_workers = 4     # Jobs read and blend concurrently; their patches share the batcher
+
+# Output
+output_dir = Path("Data/Predictions")
+
+# === Terminal Import Args ===
+# parse_known_args ignores the extra arguments Jupyter passes to the kernel
+parser = argparse.ArgumentParser(description="Serve wetland U-Net predictions over HTTP")
+parser.add_argument("--host", default=host)
+parser.add_argument("--port", type=int, default=port)
+parser.add_argument("--model-path", type=Path, default=model_path)
+parser.add_argument("--output-dir", type=Path, default=output_dir)
+parser.add_argument("--batch-size", type=int, default=batch_size)
+parser.add_argument("--block-size", type=int, default=block_size)
+parser.add_argument("--backend", default=backend, help="eager, folded, torchscript, compile, or onnx")
+parser.add_argument("--max-wait-ms", type=float, default=max_wait_ms)
+parser.add_argument("--job-workers", type=int, default=job_workers)
+parser.add_argument("--write-probabilities", action=argparse.BooleanOptionalAction, default=write_probabilities)
+cli_args, _ = parser.parse_known_args()
+
+host = cli_args.host
+port = cli_args.port
+model_path = cli_args.model_path
+output_dir = cli_args.output_dir
+batch_size = cli_args.batch_size
+block_size = cli_args.block_size
+backend = cli_args.backend
+max_wait_ms = cli_args.max_wait_ms
+job_workers = cli_args.job_workers
+write_probabilities = cli_args.write_probabilities
+
+output_dir.mkdir(parents=True, exist_ok=True)
+
+print(f"Model: {model_path}")
+print(f"Serving on http://{host}:{port}")
+print(f"Backend: {backend}, batch size: {batch_size}, max wait: {max_wait_ms} ms, job workers: {job_workers}")
+print(f"Output directory: {output_dir}")
+
+
+# In[ ]:
+
+
+# Import from other notebooks
+script_dir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/Python_Code_Analysis/DL_Implement")
+sys.path.insert(0, str(script_dir))
+
+from NYS_04_dataset import find_patch_files, load_and_merge_metadata
+from NYS_05_unet_model import UNet, build_quantized_unet
+from NYS_08_predict_raster import (
+    raster_inputs, RasterStack, MosaicStack, predict_raster_windowed,
+    build_inference_backend,
+)
+
+
+# In[ ]:
+
+
+# Queue item that stops the batcher thread (None in _carry means nothing is carried)
+_STOP = object()
+
+
+class PatchBatcher:
+    """
+    Drop-in model wrapper that coalesces patch batches from concurrent callers.
+
+    Callers block in __call__ until their slice of the output is ready. A single
+    thread owns the model: it takes whole requests off the queue until adding
+    the next one would exceed batch_size or max_wait_ms has passed since the
+    first one, runs them as one batch, and splits the outputs back out.
+    """
+
+    def __init__(self, model, batch_size, max_wait_ms=10.0):
+        """
+        Args:
+            model: Trained PyTorch model, already on its device and in eval mode
+            batch_size: Maximum patches per model call
+            max_wait_ms: Time to wait for more patches before running a partial batch
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.patches = 0
+        self.batches = 0
+        self.busy_seconds = 0.0
+        self._carry = None
+        self._thread = threading.Thread(target=self._run, name="patch-batcher", daemon=True)
+        self._thread.start()
+
+    def eval(self):
+        # predict_padded calls model.eval(); the wrapped model is already in eval mode
+        return self
+
+    def __call__(self, batch_tensor):
+        future = Future()
+        self.requests.put((batch_tensor, future))
+        return future.result()
+
+    def _next_request(self, timeout):
+        if self._carry is not None:
+            request, self._carry = self._carry, None
+            return request
+        return self.requests.get(timeout=timeout)
+
+    def _run(self):
+        while True:
+            request = self._next_request(timeout=None)
+            if request is _STOP:
+                break
+
+            # Fill the batch until it is full or the oldest request has waited max_wait
+            batch, n_patches = [request], len(request[0])
+            deadline = time.perf_counter() + self.max_wait
+            while n_patches < self.batch_size:
+                try:
+                    request = self._next_request(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is _STOP or n_patches + len(request[0]) > self.batch_size:
+                    self._carry = request  # Starts the next batch (or stops the thread)
+                    break
+                batch.append(request)
+                n_patches += len(request[0])
+
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    outputs = self.model(torch.cat([x for x, _ in batch]))
+                for (x, future), out in zip(batch, torch.split(outputs, [len(x) for x, _ in batch])):
+                    future.set_result(out)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+            with self.lock:
+                self.patches += n_patches
+                self.batches += 1
+                self.busy_seconds += time.perf_counter() - start
+
+    def stats(self):
+        """Throughput counters since the batcher started."""
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                "pending_requests": self.requests.qsize(),
+                "patches": self.patches,
+                "batches": self.batches,
+                "mean_batch_fill": self.patches / (self.batches * self.batch_size) if self.batches else 0.0,
+                "model_busy_fraction": self.busy_seconds / elapsed if elapsed > 0 else 0.0,
+                "patches_per_second": self.patches / elapsed if elapsed > 0 else 0.0,
+                "patches_per_busy_second": self.patches / self.busy_seconds if self.busy_seconds > 0 else 0.0,
+            }
+
+    def close(self):
+        self.requests.put(_STOP)
+        self._thread.join()
+
+
+# In[ ]:
+
+
+class WindowStack:
+    """
+    View of a rectangular window of a stack, with the stack's read interface.
+
+    Reads past the window edge come from the surrounding stack, so pixels near
+    a bbox edge are predicted with real context instead of reflect padding.
+    """
+
+    def __init__(self, stack, bbox):
+        """
+        Args:
+            stack: RasterStack or MosaicStack to read from
+            bbox: (minx, miny, maxx, maxy) in the stack's CRS
+        """
+        minx, miny, maxx, maxy = bbox
+        inverse = ~stack.transform
+        cols, rows = zip(*(inverse * (x, y) for x in (minx, maxx) for y in (miny, maxy)))
+
+        # Snap outward to whole pixels and clip to the stack
+        self.row_off = max(0, int(np.floor(min(rows))))
+        self.col_off = max(0, int(np.floor(min(cols))))
+        self.height = min(stack.height, int(np.ceil(max(rows)))) - self.row_off
+        self.width = min(stack.width, int(np.ceil(max(cols)))) - self.col_off
+        if self.height <= 0 or self.width <= 0:
+            raise ValueError(f"bbox {list(bbox)} does not overlap the rasters")
+
+        self.stack = stack
+        self.band_names = stack.band_names
+        self.transform = stack.transform * Affine.translation(self.col_off, self.row_off)
+        self.profile = stack.profile.copy()
+        self.profile.update(height=self.height, width=self.width, transform=self.transform)
+
+    def read(self, row_start, row_stop, col_start, col_stop):
+        return self.stack.read(
+            row_start + self.row_off, row_stop + self.row_off,
+            col_start + self.col_off, col_stop + self.col_off,
+        )
+
+    def close(self):
+        self.stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PredictionService:
+    """
+    Job queue in front of a warm model.
+
+    Jobs run on a thread pool; each one streams its raster through
+    predict_raster_windowed with the shared PatchBatcher as the model.
+    """
+
+    def __init__(self, batcher, metadata, device, output_dir, patch_size, crop_margin,
+                 block_size=1024, job_workers=4, write_probabilities=False):
+        """
+        Args:
+            batcher: PatchBatcher wrapping the loaded model
+            metadata: Training metadata (band_names, normalization, num_classes, class_names)
+            device: PyTorch device the model runs on
+            output_dir: Directory for prediction GeoTIFFs
+            patch_size, crop_margin: Prediction parameters
+            block_size: Core block size in pixels (multiple of the patch stride)
+            job_workers: Jobs predicted concurrently
+            write_probabilities: Default for jobs that do not set "probabilities"
+        """
+        self.batcher = batcher
+        self.metadata = metadata
+        self.device = device
+        self.output_dir = Path(output_dir)
+        self.patch_size = patch_size
+        self.crop_margin = crop_margin
+        self.block_size = block_size
+        self.write_probabilities = write_probabilities
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix="job")
+
+    def submit(self, request):
+        """
+        Validate a job request and queue it.
+
+        Args:
+            request: Dict with "huc" or "hucs", and optionally "bbox",
+                "name" (output file stem), and "probabilities" (bool)
+
+        Returns:
+            job: Job status dict
+        """
+        hucs = request.get("hucs") or ([request["huc"]] if request.get("huc") else [])
+        if not isinstance(hucs, list) or not hucs or not all(isinstance(h, str) for h in hucs):
+            raise ValueError('Job needs "huc" (string) or "hucs" (list of strings)')
+        bbox = request.get("bbox")
+        if bbox is not None and (len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]):
+            raise ValueError('"bbox" must be [minx, miny, maxx, maxy]')
+
+        job_id = next(self._ids)
+        default_name = f"prediction_{hucs[0]}" if len(hucs) == 1 and bbox is None else f"prediction_job{job_id}"
+        name = Path(request.get("name") or default_name).name
+        write_probs = request.get("probabilities", self.write_probabilities)
+
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "hucs": hucs,
+            "bbox": bbox,
+            "output_path": str(self.output_dir / f"{name}.tif"),
+            "prob_path": str(self.output_dir / f"{name}_probabilities.tif") if write_probs else None,
+            "submitted": time.time(),
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+        self._executor.submit(self._run_job, job)
+        return dict(job)
+
+    def _open_stack(self, job):
+        band_names = self.metadata["band_names"]
+        if len(job["hucs"]) == 1:
+            stack = RasterStack(raster_inputs, job["hucs"][0], band_names)
+        else:
+            stack = MosaicStack(raster_inputs, job["hucs"], band_names)
+        if job["bbox"] is None:
+            return stack
+        try:
+            return WindowStack(stack, job["bbox"])
+        except Exception:
+            stack.close()
+            raise
+
+    def _run_job(self, job):
+        with self.lock:
+            job.update(status="running", started=time.time())
+        try:
+            with self._open_stack(job) as stack:
+                class_counts = predict_raster_windowed(
+                    self.batcher, stack, self.metadata["normalization"],
+                    job["output_path"], job["prob_path"],
+                    self.patch_size, self.crop_margin, self.batcher.batch_size, self.device,
+                    self.metadata["num_classes"], self.metadata["class_names"],
+                    block_size=self.block_size, verbose=False,
+                )
+                shape = [stack.height, stack.width]
+            with self.lock:
+                job.update(
+                    status="done",
+                    shape=shape,
+                    class_counts=dict(zip(self.metadata["class_names"], class_counts.tolist())),
+                )
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                job.update(status="failed", error=f"{type(e).__name__}: {e}")
+        finally:
+            with self.lock:
+                job["finished"] = time.time()
+                job["seconds"] = round(job["finished"] - job["started"], 3)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list_jobs(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def stats(self):
+        """Job queue depth and batcher throughput."""
+        with self.lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+        stats = {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+        stats["queue_depth"] = stats["queued"]
+        stats.update(self.batcher.stats())
+        return stats
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+# In[ ]:
+
+
+def make_handler(service):
+    """Build a request handler class bound to a PredictionService."""
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            if parts == ["stats"]:
+                self._send_json(200, service.stats())
+            elif parts == ["jobs"]:
+                self._send_json(200, service.list_jobs())
+            elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                job = service.get(int(parts[1]))
+                if job is None:
+                    self._send_json(404, {"error": f"No job {parts[1]}"})
+                else:
+                    self._send_json(200, job)
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path.strip("/") != "jobs":
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                job = service.submit(request)
+            except (ValueError, TypeError, AttributeError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(202, job)
+
+        def log_message(self, format, *args):
+            pass  # Job status is available from /jobs instead of per-request logs
+
+    return PredictionHandler
+
+
+# In[ ]:
+
+
+def load_model(model_path, device):
+    """
+    Load the trained U-Net and its training metadata.
+
+    Uses the metadata saved in the checkpoint, and falls back to merging the
+    patch metadata files (as in NYS_08) for older checkpoints. Int8 checkpoints
+    from NYS_10_quantize_model are loaded on the CPU regardless of device.
+
+    Returns:
+        model: UNet on device (CPU if quantized) in eval mode
+        metadata: Training metadata
+        checkpoint: Loaded checkpoint dict
+    """
+    checkpoint = torch.load(model_path, map_location="cpu")
+    metadata = checkpoint.get("metadata")
+    if metadata is None:
+        files = find_patch_files(data_dir, cluster_id, huc_id)
+        metadata = load_and_merge_metadata(files["metadata_files"])
+
+    base_filters = checkpoint.get("config", {}).get("base_filters", 32)
+    if "quantization" in checkpoint:
+        device = torch.device("cpu")
+        model = build_quantized_unet(
+            metadata["in_channels"], metadata["num_classes"], base_filters,
+            engine=checkpoint["quantization"]["engine"],
+        )
+    else:
+        model = UNet(metadata["in_channels"], metadata["num_classes"], base_filters=base_filters)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model = model.to(device)
+    model.eval()
+    return model, metadata, checkpoint
+
+
+# In[ ]:
+
+
+if __name__ == "__main__" or 'get_ipython' in dir():
+    device = torch.device("cuda" if torch.cuda.is_available() else
+                          "mps" if torch.backends.mps.is_available() else "cpu")
+    print(f"Using device: {device}")
+
+    model, metadata, checkpoint = load_model(model_path, device)
+    if "quantization" in checkpoint:
+        device = torch.device("cpu")
+        print(f"Quantized checkpoint ({checkpoint['quantization']['engine']}), using CPU")
+    print(f"Loaded model from epoch {checkpoint['epoch'] + 1}")
+    print(f"Bands: {metadata['band_names']}")
+
+    inference_model = build_inference_backend(model, backend, device, patch_size)
+    batcher = PatchBatcher(inference_model, batch_size, max_wait_ms)
+    service = PredictionService(
+        batcher, metadata, device, output_dir, patch_size, crop_margin,
+        block_size=block_size, job_workers=job_workers, write_probabilities=write_probabilities,
+    )
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Listening on http://{host}:{port} (Ctrl+C / interrupt the kernel to stop)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping server")
+    finally:
+        server.server_close()
+        service.shutdown()
+        batcher.close()
+        print(json.dumps(service.stats(), indent=2))
+
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+from pathlib import Path
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+workdir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/")
+os.chdir(workdir)
+print(f"Current working directory: {Path.cwd()}")
+
+# === CONFIGURATION ===
+# Must match the training data used for the model
+data_dir = Path("Data/Patches_v2")
+cluster_id = 208
+huc_id = None  # None to use all HUCs in cluster
+model_path = Path("Models/best_model.pth")
+quantized_path = Path("Models/best_model_int8.pth")
+
+# Quantization settings
+engine = None               # Quantized kernels: "x86"/"fbgemm" on Intel/AMD, "qnnpack" on ARM; None picks for this machine
+calibration_patches = 256   # Validation patches used to record activation ranges
+eval_patches = 512          # Held-out validation patches for the fp32 vs int8 comparison
+batch_size = 16
+seed = 0
+
+# === Terminal Import Args ===
+# parse_known_args ignores the extra arguments Jupyter passes to the kernel
+parser = argparse.ArgumentParser(description="Quantize the wetland U-Net to int8")
+parser.add_argument("--model-path", type=Path, default=model_path)
+parser.add_argument("--quantized-path", type=Path, default=quantized_path)
+parser.add_argument("--engine", default=engine)
+parser.add_argument("--calibration-patches", type=int, default=calibration_patches)
+parser.add_argument("--eval-patches", type=int, default=eval_patches)
+parser.add_argument("--batch-size", type=int, default=batch_size)
+cli_args, _ = parser.parse_known_args()
+
+model_path = cli_args.model_path
+quantized_path = cli_args.quantized_path
+engine = cli_args.engine
+calibration_patches = cli_args.calibration_patches
+eval_patches = cli_args.eval_patches
+batch_size = cli_args.batch_size
+
+print(f"Model: {model_path}")
+print(f"Quantized output: {quantized_path}")
+print(f"Engine: {engine or 'auto'}, calibrationpatches: {calibration_patches}, eval patches: {eval_patches}")
+
+
+# In[ ]:
+
+
+# Import from other notebooks
+script_dir = Path("/Users/Anthony/Data and Analysis Local/NYS_Wetlands_DL/Python_Code_Analysis/DL_Implement")
+sys.path.insert(0, str(script_dir))
+
+from NYS_04_dataset import WetlandDataset, find_patch_files, load_and_merge_metadata
+from NYS_05_unet_model import UNet, default_quantized_engine, quantize_unet
+
+
+# In[ ]:
+
+
+def split_validation_indices(n_val, calibration_patches, eval_patches, seed=0):
+    """
+    Shuffle validation indices and split them into calibration and evaluation sets.
+
+    If the validation set is too small for both, evaluation reuses all patches.
+
+    Returns:
+        calibration_indices, eval_indices: Arrays of validation patch indices
+    """
+    order = np.random.default_rng(seed).permutation(n_val)
+    calibration_indices = order[:calibration_patches]
+    eval_indices = order[calibration_patches:calibration_patches + eval_patches]
+    if len(eval_indices) == 0:
+        print("Validation set too small for a held-out evaluation split; evaluating on all patches")
+        eval_indices = order[:eval_patches]
+    return calibration_indices, eval_indices
+
+
+def iter_batches(dataset, indices, batch_size):
+    """Yield (X, y) batches of a WetlandDataset, one get_batch call per batch."""
+    for start in range(0, len(indices), batch_size):
+        yield dataset.get_batch(indices[start:start + batch_size])
+
+
+def class_iou(conf_matrix):
+    """Per-class IoU from a confusion matrix (rows = true, cols = predicted); NaN for absent classes."""
+    conf_matrix = conf_matrix.astype(np.float64)
+    true_pos = np.diag(conf_matrix)
+    union = conf_matrix.sum(axis=0) + conf_matrix.sum(axis=1) - true_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, true_pos / union, np.nan)
+
+
+def evaluate_model(model, dataset, indices, batch_size, num_classes):
+    """
+    Run a model over validation patches on CPU.
+
+    Returns:
+        conf_matrix: (num_classes, num_classes) confusion matrix against the labels
+        preds: uint8 predicted classes for every patch (for agreement checks)
+        patches_per_sec: Model throughput (excludes data loading)
+    """
+    conf_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    preds = []
+    model_seconds = 0.0
+
+    with torch.no_grad():
+        for X, y in iter_batches(dataset, indices, batch_size):
+            start = time.perf_counter()
+            outputs = model(X)
+            model_seconds += time.perf_counter() - start
+
+            batch_preds = torch.argmax(outputs, dim=1)
+            conf_matrix += torch.bincount(
+                (y * num_classes + batch_preds).flatten(), minlength=num_classes * num_classes
+            ).reshape(num_classes, num_classes).numpy()
+            preds.append(batch_preds.numpy().astype(np.uint8))
+
+    return conf_matrix, np.concatenate(preds), len(indices) / model_seconds
+
+
+def compare_quantized(fp32_model, int8_model, dataset, indices, batch_size, class_names):
+    """
+    Compare fp32 and int8 models on the same validation patches.
+
+    Returns:
+        report: Dict with patches/sec of each model, the speedup, pixel agreement,
+            and per-class IoU for both models with the int8 - fp32 drift
+    """
+    num_classes = len(class_names)
+    fp32_conf, fp32_preds, fp32_rate = evaluate_model(fp32_model, dataset, indices, batch_size, num_classes)
+    int8_conf, int8_preds, int8_rate = evaluate_model(int8_model, dataset, indices, batch_size, num_classes)
+    fp32_iou, int8_iou = class_iou(fp32_conf), class_iou(int8_conf)
+
+    def to_dict(values):
+        return {name: None if np.isnan(v) else float(v) for name, v in zip(class_names, values)}
+
+    return {
+        "eval_patches": len(indices),
+        "fp32_patches_per_sec": fp32_rate,
+        "int8_patches_per_sec": int8_rate,
+        "speedup": int8_rate / fp32_rate,
+        "pixel_agreement": float((fp32_preds == int8_preds).mean()),
+        "fp32_miou": float(np.nanmean(fp32_iou)),
+        "int8_miou": float(np.nanmean(int8_iou)),
+        "fp32_class_iou": to_dict(fp32_iou),
+        "int8_class_iou": to_dict(int8_iou),
+        "class_iou_drift": to_dict(int8_iou - fp32_iou),
+    }
+
+
+# In[ ]:
+
+
+if __name__ == "__main__" or 'get_ipython' in dir():
+    # Load the fp32 model on CPU (quantized kernels are CPU-only, so compare like for like)
+    checkpoint = torch.load(model_path, map_location="cpu")
+    files = find_patch_files(data_dir, cluster_id, huc_id)
+    metadata = checkpoint.get("metadata") or load_and_merge_metadata(
+        files["metadata"] if "metadata" in files else files["metadata_files"]
+    )
+    base_filters = checkpoint.get("config", {}).get("base_filters", 32)
+
+    model = UNet(metadata["in_channels"], metadata["num_classes"], base_filters=base_filters)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+
+    val_dataset = WetlandDataset(files["X_val"], files["y_val"], metadata, normalize=True)
+    calibration_indices, eval_indices = split_validation_indices(
+        len(val_dataset), calibration_patches, eval_patches, seed
+    )
+    print(f"Validation patches: {len(val_dataset)} "
+          f"({len(calibration_indices)} calibration, {len(eval_indices)} evaluation)")
+
+    # Calibrate and convert; the checkpoint records the engine actually used
+    engine = engine or default_quantized_engine()
+    start = time.perf_counter()
+    calibration_batches = (X for X, _ in iter_batches(val_dataset, calibration_indices, batch_size))
+    qmodel = quantize_unet(model, calibration_batches, engine=engine)
+    print(f"Quantized in {time.perf_counter() - start:.1f}s")
+
+    # Throughput and accuracy drift
+    report = compare_quantized(model, qmodel, val_dataset, eval_indices, batch_size, metadata["class_names"])
+    print(f"\nThroughput: fp32 {report['fp32_patches_per_sec']:.1f} patches/sec, "
+          f"int8 {report['int8_patches_per_sec']:.1f} patches/sec ({report['speedup']:.2f}x)")
+    print(f"Pixel agreement with fp32: {report['pixel_agreement']:.4f}")
+    print(f"mIoU: fp32 {report['fp32_miou']:.4f}, int8 {report['int8_miou']:.4f}")
+    print(f"\n{'class':12s} {'fp32 IoU':>9s} {'int8 IoU':>9s} {'drift':>8s}")
+    for name in metadata["class_names"]:
+        if report["fp32_class_iou"][name] is None:
+            print(f"{name:12s} {'-':>9s} {'-':>9s} {'-':>8s}")
+            continue
+        print(f"{name:12s} {report['fp32_class_iou'][name]:9.4f} {report['int8_class_iou'][name]:9.4f} "
+              f"{report['class_iou_drift'][name]:+8.4f}")
+
+    # Save in the training checkpoint layout; "quantization" marks it for NYS_08/NYS_09
+    torch.save({
+        "epoch": checkpoint.get("epoch", 0),
+        "model_state_dict": qmodel.state_dict(),
+        "val_loss": checkpoint.get("val_loss"),
+        "val_acc": checkpoint.get("val_acc"),
+        "val_miou": checkpoint.get("val_miou"),
+        "metadata": metadata,
+        "config": {**checkpoint.get("config", {}), "base_filters": base_filters},
+        "quantization": {
+            "engine": engine,
+            "source_checkpoint": str(model_path),
+            "calibration_patches": len(calibration_indices),
+            "report": report,
+        },
+    }, quantized_path)
+    print(f"\nSaved quantized model to: {quantized_path}")
+